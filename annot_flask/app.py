@@ -1,18 +1,100 @@
 #app.py flask app
+import time
+STARTUP_STARTED = time.time()  # Taken before the imports, so the reported startup time covers them
+
 import os
-import cv2
-import torch
-from flask import Flask, request, jsonify, send_from_directory, url_for
+from flask import Flask, Response, g, request, jsonify, send_from_directory, stream_with_context, url_for
 from flask_cors import CORS
-from sam2.build_sam import build_sam2_video_predictor
+from werkzeug.datastructures import MultiDict
 import numpy as np
-import sys
+import json
+import logging
 import threading
-from modules.Annotation import AnnotationModule
+from collections import Counter
+from modules.Annotation import STATE_LOADING, STATE_FAILED, PROPAGATION_DIRECTIONS
+from modules.SparsePropagation import KEYFRAME_MODES, DEFAULT_KEYFRAME_MODE, DEFAULT_KEYFRAME_STRIDE, DEFAULT_SPARSE_QUALITY
+from modules.Sessions import SessionManager, DEFAULT_SESSION_ID, validate_session_id, MODEL_LOADING, MODEL_READY
+from modules.Jobs import JobManager, JobCancelled
+from modules.FeatureCache import FeatureCache, model_cache_key
+from modules.InferenceProfile import InferenceProfile, DEFAULT_MODEL_SIZE
+from modules.InferenceWorker import InferenceWorker
+from modules.DatasetExport import DATASET_FORMATS, DEFAULT_DATASET_FORMAT
+from modules.VideoExport import DEFAULT_VIDEO_CODEC, DEFAULT_VIDEO_QUALITY, video_extension
+from modules.MaskEncoding import MASK_FORMATS, DEFAULT_MASK_FORMAT, encode_mask, decode_mask
+from modules.Metrics import metrics
+from modules.Uploads import UploadStore, UploadOffsetError
+from modules.Thumbnails import thumbnail_width
 
 # Set directories for uploads and frames
 UPLOAD_FOLDER = 'uploads/'
 FRAME_FOLDER = 'frames/'
+SESSION_FOLDER = 'sessions/'
+JOB_FOLDER = 'jobs/'
+FEATURE_CACHE_FOLDER = 'feature_cache/'
+
+# Decode uploaded videos straight into the SAM2 frame tensor instead of extracting every frame as JPEG
+IN_MEMORY_FRAMES = os.environ.get('ANNOT_IN_MEMORY_FRAMES', '1') == '1'
+
+# Longest side of the extracted frames (and of the predicted masks), None keeps the source resolution
+MAX_FRAME_RESOLUTION = int(os.environ['ANNOT_MAX_FRAME_RESOLUTION']) if os.environ.get('ANNOT_MAX_FRAME_RESOLUTION') else None
+
+# Number of frames kept in memory per session when frames are loaded lazily, 0 loads every frame up front
+FRAME_WINDOW_SIZE = int(os.environ.get('ANNOT_FRAME_WINDOW', 0))
+
+# How long prompt calls wait for a loading inference state before answering 503
+STATE_READY_TIMEOUT = float(os.environ.get('ANNOT_STATE_READY_TIMEOUT', 30))
+
+# Largest frame range /masks returns in one response
+MAX_MASK_FRAMES_PER_REQUEST = int(os.environ.get('ANNOT_MAX_MASK_FRAMES', 500))
+
+# Memory the inference states of all sessions may use before idle ones are offloaded to disk
+SESSION_MEMORY_BUDGET_MB = int(os.environ.get('ANNOT_SESSION_MEMORY_MB', 8192))
+
+# Image-encoder features kept in memory, and on disk, to skip the backbone for frames seen before
+FEATURE_CACHE_MEMORY_MB = int(os.environ.get('ANNOT_FEATURE_CACHE_MB', 1024))
+FEATURE_CACHE_DISK_MB = int(os.environ.get('ANNOT_FEATURE_CACHE_DISK_MB', 20480))
+
+# Inference profile: SAM2 model size (tiny, small, base_plus or large), device (cpu, cuda, mps or auto),
+# autocast precision (fp32, bf16 or fp16, defaults to bf16 on CUDA and fp32 elsewhere), torch.compile mode
+# of the image encoder (empty to not compile), CPU threads (0 keeps torch's default) and warm-up passes
+MODEL_SIZE = os.environ.get('ANNOT_MODEL_SIZE', DEFAULT_MODEL_SIZE)
+DEVICE = os.environ.get('ANNOT_DEVICE', 'auto')
+PRECISION = os.environ.get('ANNOT_PRECISION') or None
+COMPILE_MODE = os.environ.get('ANNOT_COMPILE', '')
+NUM_THREADS = int(os.environ.get('ANNOT_NUM_THREADS', 0))
+WARMUP_RUNS = int(os.environ.get('ANNOT_WARMUP_RUNS', 1))
+
+# Load and warm up the model on a background thread, so the server answers (and /ready reports progress)
+# while it loads
+BACKGROUND_MODEL_LOADING = os.environ.get('ANNOT_BACKGROUND_MODEL_LOADING', '1') == '1'
+
+# Number of frame URLs per page of the /upload response and of /frames
+FRAME_PAGE_SIZE = int(os.environ.get('ANNOT_FRAME_PAGE_SIZE', 100))
+
+# How long browsers may cache frames, thumbnails and sprite sheets requested with their version
+FRAME_CACHE_MAX_AGE = int(os.environ.get('ANNOT_FRAME_CACHE_MAX_AGE', 365 * 24 * 3600))
+
+# Every frame encoded for a prompt or a propagation, in any session, goes through one inference worker, which
+# batches the requests arriving within ANNOT_INFERENCE_BATCH_WINDOW_MS of each other, up to
+# ANNOT_INFERENCE_MAX_BATCH frames per forward pass. A maximum of 0 disables the worker, every prompt and
+# propagation then runs the encoder on its own thread.
+INFERENCE_BATCH_WINDOW_MS = float(os.environ.get('ANNOT_INFERENCE_BATCH_WINDOW_MS', 5))
+INFERENCE_MAX_BATCH = int(os.environ.get('ANNOT_INFERENCE_MAX_BATCH', 8))
+
+# Run Flask's debugger. The reloader stays off either way: it would import the app, and load the model, twice.
+FLASK_DEBUG = os.environ.get('ANNOT_FLASK_DEBUG', '1') == '1'
+
+# Memory the undo/redo snapshots of a session may keep alive beyond its inference state
+HISTORY_MEMORY_MB = int(os.environ.get('ANNOT_HISTORY_MEMORY_MB', 256))
+
+# Unfinished chunked uploads are discarded after this many hours without a new chunk
+UPLOAD_TTL_HOURS = float(os.environ.get('ANNOT_UPLOAD_TTL_HOURS', 24))
+
+# Log level of the app and the modules, DEBUG also logs the prompts and mask statistics of every prediction
+LOG_LEVEL = os.environ.get('ANNOT_LOG_LEVEL', 'INFO').upper()
+
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('annot')
 
 # Initilize the Flask app
 app = Flask(__name__)
@@ -25,57 +107,522 @@ if not os.path.exists(UPLOAD_FOLDER):
 if not os.path.exists(FRAME_FOLDER):
     os.makedirs(FRAME_FOLDER)
 
-# Initialize the Annotation module
+# Initialize the session manager, which shares one SAM2 predictor between all annotation sessions
 current_dir = os.path.dirname(__file__)
-sam2_checkpoint = os.path.join(current_dir, '..', 'sam2_hiera_large.pt')
-model_cfg = os.path.join(current_dir, '..', 'sam2_hiera_l.yaml')
-device = "cpu"
-annotator = AnnotationModule(model_cfg, sam2_checkpoint, device=device)
+inference_profile = InferenceProfile(MODEL_SIZE, model_folder=os.path.join(current_dir, '..'),
+                                     model_cfg=os.environ.get('ANNOT_MODEL_CFG'),
+                                     checkpoint=os.environ.get('ANNOT_CHECKPOINT'), device=DEVICE,
+                                     precision=PRECISION, compile_mode=COMPILE_MODE,
+                                     num_threads=NUM_THREADS or None, warmup_runs=WARMUP_RUNS)
+sam2_checkpoint = inference_profile.checkpoint
+model_cfg = inference_profile.model_cfg
+device = inference_profile.device
+feature_cache = FeatureCache(FEATURE_CACHE_FOLDER,
+                             model_cache_key(model_cfg, sam2_checkpoint, inference_profile.cache_variant()),
+                             max_memory_bytes=FEATURE_CACHE_MEMORY_MB * 1024 * 1024,
+                             max_disk_bytes=FEATURE_CACHE_DISK_MB * 1024 * 1024)
 
-# Route to handle video upload
-import threading
+# Background jobs (propagation, video export) run on a small thread pool and persist their results
+job_manager = JobManager(JOB_FOLDER, max_workers=int(os.environ.get('ANNOT_JOB_WORKERS', 2)))
 
-@app.route('/upload', methods=['POST'])
-def upload_video():
-    if 'video' not in request.files:
-        return jsonify({'error': 'No video file provided'}), 400
-    
-    video = request.files['video']
-    video_path = os.path.join(UPLOAD_FOLDER, video.filename)
-    video.save(video_path)
+inference_worker = InferenceWorker(inference_profile.autocast, batch_window=INFERENCE_BATCH_WINDOW_MS / 1000,
+                                   max_batch_size=INFERENCE_MAX_BATCH,
+                                   num_threads=NUM_THREADS or None) if INFERENCE_MAX_BATCH > 0 else None
+session_manager = SessionManager(model_cfg, sam2_checkpoint, device=device,
+                                 memory_budget_bytes=SESSION_MEMORY_BUDGET_MB * 1024 * 1024,
+                                 offload_folder=SESSION_FOLDER, feature_cache=feature_cache,
+                                 inference_profile=inference_profile, load_in_background=BACKGROUND_MODEL_LOADING,
+                                 history_memory_bytes=HISTORY_MEMORY_MB * 1024 * 1024,
+                                 inference_worker=inference_worker, job_manager=job_manager)
+
+# Uploaded videos are stored once per content hash, together with the frames extracted from them
+upload_store = UploadStore(UPLOAD_FOLDER, upload_ttl=UPLOAD_TTL_HOURS * 3600)
 
-    # Extract frames using AnnotationModule
-    annotator.video_to_frames(video_path)
-    print(f"video_path: {video_path}")
+# Gauges read when /metrics is scraped, next to the stage and request latency histograms
+metrics.register_gauge('sessions', 'Number of annotation sessions.', lambda: len(session_manager.sessions))
+metrics.register_gauge('session_memory_bytes', 'Estimated memory of the resident inference states.',
+                       lambda: sum(session_manager.memory_usage().values()))
+metrics.register_gauge('jobs', 'Number of background jobs per status.',
+                       lambda: Counter(job.status for job in job_manager.list()), label='status')
+metrics.register_gauge('uploads_in_progress', 'Number of unfinished chunked uploads.',
+                       lambda: len(upload_store.uploads))
+metrics.register_gauge('feature_cache_lookups', 'Image feature cache lookups per result.',
+                       lambda: {result: feature_cache.get_stats()[result] for result in ('memory_hits', 'disk_hits', 'misses')},
+                       label='result')
+metrics.register_gauge('feature_cache_bytes', 'Size of the image feature cache per tier.',
+                       lambda: {tier: feature_cache.get_stats()[f'{tier}_bytes'] for tier in ('memory', 'disk')},
+                       label='tier')
+if inference_worker is not None:
+    metrics.register_gauge('inference_queue_depth', 'Frames waiting for the inference worker.',
+                           inference_worker.queue_depth)
+    metrics.register_gauge('inference_batches', 'Encoder forward passes of the inference worker per batch size.',
+                           lambda: dict(inference_worker.batch_sizes), label='size')
+
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    metrics.begin_request()
+
+@app.after_request
+def add_request_timing(response):
+    """
+    Record the request latency and report the pipeline stages that ran while handling it in a Server-Timing header.
+    """
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    timings = metrics.end_request()
+    timings['total'] = (elapsed, 1)
+    response.headers['Server-Timing'] = metrics.server_timing(timings)
+
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe_request(endpoint, request.method, response.status_code, elapsed)
+    return response
+
+def get_session_id():
+    """
+    Read the session ID from the 'X-Session-ID' header, the 'session_id' query parameter or the JSON body.
+    Clients that don't send one all share the default session. Raises ValueError for IDs not matching
+    SESSION_ID_PATTERN, which check_session_id answers with a 400 before any route runs.
+    """
+    session_id = request.headers.get('X-Session-ID') or request.args.get('session_id')
+    if session_id is None:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            session_id = data.get('session_id')
+    return validate_session_id(str(session_id or DEFAULT_SESSION_ID))
+
+@app.before_request
+def check_session_id():
+    """
+    Reject requests whose session ID, sent by the client or in the URL, could escape the offload folder.
+    """
+    try:
+        get_session_id()
+        if request.view_args and 'session_id' in request.view_args:
+            validate_session_id(request.view_args['session_id'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+def get_annotator():
+    """
+    Return the AnnotationModule of the session making the current request. The session is pinned until the
+    request ends (see release_sessions), so its inference state is not offloaded while the request uses it.
+    """
+    session_id = get_session_id()
+    annotator = session_manager.get(session_id, pin=True)
+    g.setdefault('pinned_sessions', []).append(session_id)
+    return annotator
+
+@app.teardown_request
+def release_sessions(exception=None):
+    """
+    Unpin the sessions get_annotator pinned. Streamed responses are torn down once the stream ends.
+    """
+    for session_id in g.pop('pinned_sessions', []):
+        session_manager.release(session_id)
+
+def get_mask_format(data=None):
+    """
+    Read the mask wire format negotiated by the client, either from the 'mask_format'
+    query parameter or from the JSON body. Defaults to the legacy nested list format.
+    """
+    mask_format = request.args.get('mask_format')
+    if mask_format is None and data:
+        mask_format = data.get('mask_format')
+    mask_format = mask_format or DEFAULT_MASK_FORMAT
+
+    if mask_format not in MASK_FORMATS:
+        raise ValueError(f"Unknown mask_format '{mask_format}', expected one of {list(MASK_FORMATS)}")
+    return mask_format
+
+def get_export_options(data):
+    """
+    Read the video export options from the JSON body: 'codec', 'quality' (0-100), 'fps' (defaults to the
+    rate of the extracted frames) and 'contours'.
+    """
+    codec = data.get('codec', DEFAULT_VIDEO_CODEC)
+    video_extension(codec)  # Raises ValueError for unknown codecs
+
+    quality = int(data.get('quality', DEFAULT_VIDEO_QUALITY))
+    if not 0 <= quality <= 100:
+        raise ValueError("quality must be between 0 and 100")
+
+    fps = data.get('fps')
+    return {
+        'codec': codec,
+        'quality': quality,
+        'fps': float(fps) if fps else None,
+        'contours': bool(data.get('contours', False))
+    }
+
+def get_dataset_options(data):
+    """
+    Read the dataset export options from the JSON body: 'format' (one of DATASET_FORMATS) and
+    'include_images' (also add the frames to the archive).
+    """
+    dataset_format = data.get('format', DEFAULT_DATASET_FORMAT)
+    if dataset_format not in DATASET_FORMATS:
+        raise ValueError(f"Unknown format '{dataset_format}', expected one of {list(DATASET_FORMATS)}")
+    return {
+        'dataset_format': dataset_format,
+        'include_images': bool(data.get('include_images', False))
+    }
+
+def get_propagation_options(data):
+    """
+    Read the propagation range from the JSON body: 'start_frame' (defaults to the earliest prompted frame),
+    'max_frames' (per direction, defaults to the rest of the video) and 'direction' (forward, reverse or both).
+    """
+    direction = data.get('direction', 'forward')
+    if direction not in PROPAGATION_DIRECTIONS:
+        raise ValueError(f"direction must be one of {list(PROPAGATION_DIRECTIONS)}")
+
+    start_frame = data.get('start_frame')
+    max_frames = data.get('max_frames')
+    return {
+        'start_frame_idx': int(start_frame) if start_frame is not None else None,
+        'max_frames': int(max_frames) if max_frames is not None else None,
+        'direction': direction
+    }
+
+def get_sparse_options(data):
+    """
+    Read the sparse propagation options from the JSON body: 'sparse' (only run the model on keyframes and
+    interpolate the other frames), 'quality' (0-1, IoU the masks of consecutive keyframes must keep),
+    'keyframe_stride' (most frames between keyframes) and 'keyframe_mode' (stride or motion).
+    """
+    quality = float(data.get('quality', DEFAULT_SPARSE_QUALITY))
+    if not 0 <= quality <= 1:
+        raise ValueError("quality must be between 0 and 1")
+
+    keyframe_stride = int(data.get('keyframe_stride', DEFAULT_KEYFRAME_STRIDE))
+    if keyframe_stride < 1:
+        raise ValueError("keyframe_stride must be at least 1")
+
+    keyframe_mode = data.get('keyframe_mode', DEFAULT_KEYFRAME_MODE)
+    if keyframe_mode not in KEYFRAME_MODES:
+        raise ValueError(f"keyframe_mode must be one of {list(KEYFRAME_MODES)}")
+
+    return {
+        'sparse': bool(data.get('sparse', False)),
+        'quality': quality,
+        'keyframe_stride': keyframe_stride,
+        'keyframe_mode': keyframe_mode
+    }
+
+def require_inference_state(annotator):
+    """
+    Wait (up to STATE_READY_TIMEOUT) for the session's inference state to finish loading.
+
+    Returns:
+        None when the state is ready, otherwise the error response to return.
+    """
+    if annotator.wait_until_ready(timeout=STATE_READY_TIMEOUT):
+        return None
+
+    status = annotator.get_state_status()
+    if status['status'] == STATE_LOADING:
+        response = jsonify({'error': 'Inference state is still loading, retry shortly', **status})
+        response.headers['Retry-After'] = '2'
+        return response, 503
+    elif status['status'] == STATE_FAILED:
+        return jsonify({'error': f"Inference state failed to load: {status['error']}", **status}), 500
+    else:
+        return jsonify({'error': 'No video has been uploaded for this session', **status}), 409
+
+def get_upload_options(values):
+    """
+    Read the frame options of an upload from its form fields, or from the body of a chunked upload's completion:
+    'in_memory_frames', the sampling ('stride', 'target_fps', 'max_resolution', 'start_frame', 'end_frame')
+    and 'frame_window'.
+    """
+    # Either decode the frames in memory when the inference state is built (JPEGs are then only written
+    # for the frames the UI requests), or extract every frame to disk using AnnotationModule
+    in_memory = str(values.get('in_memory_frames', '1' if IN_MEMORY_FRAMES else '0')).lower() in ('1', 'true')
+
+    # Optional sampling: temporal stride or target fps, resolution cap and source frame range
+    try:
+        sampling = {
+            'stride': values.get('stride', 1, type=int),
+            'target_fps': values.get('target_fps', None, type=float),
+            'max_resolution': values.get('max_resolution', MAX_FRAME_RESOLUTION, type=int),
+            'start_frame': values.get('start_frame', 0, type=int),
+            'end_frame': values.get('end_frame', None, type=int)
+        }
+    except ValueError as e:
+        raise ValueError(f'Invalid sampling option: {str(e)}')
 
-    # Get the list of extracted frames (first frame to return)
-    # Filter out non-image files (like .mp4) and only include image files (jpg, jpeg, png)
-    frame_files = sorted([f for f in os.listdir(annotator.frame_folder) if f.lower().endswith(('.jpg', '.jpeg', '.png'))])
-    print(f"frame_files: {frame_files}")
+    # Optionally load frames lazily, keeping only a bounded window of them in memory
+    frame_window = values.get('frame_window', FRAME_WINDOW_SIZE, type=int)
+    return in_memory, sampling, frame_window
+
+def open_uploaded_video(annotator, video_path, video_hash, deduplicated, options):
+    """
+    Extract (or reuse) the frames of a stored video for the current session and start building its inference
+    state in the background.
+    """
+    in_memory, sampling, frame_window = options
+
+    # Prompts for this session wait for the new video from here on
+    generation = annotator.mark_state_loading()
+    annotator.frame_window_size = frame_window or None
+
+    with metrics.time('frame_extraction'):
+        if in_memory:
+            annotator.prepare_in_memory_video(video_path, video_hash=video_hash, **sampling)
+        else:
+            annotator.video_to_frames(video_path, video_hash=video_hash, **sampling)
+    logger.debug(f"video_path: {video_path}")
+
+    # Get the list of frames (first frame to return)
+    frame_files = list(annotator.frame_names or [])
+    logger.debug(f"frame_files: {len(frame_files)} frames")
     
     # Check if frames were extracted
     if frame_files:
+        session_id = get_session_id()
+
+        def init_session_state(frame_folder):
+            annotator.init_inference_state(frame_folder, generation=generation)
+            # The new state may push the sessions over the memory budget
+            session_manager.enforce_budget(keep=session_id)
+
         # Start the inference initialization in a separate thread
-        threading.Thread(target=annotator.init_inference_state, args=(annotator.frame_folder,)).start()
+        threading.Thread(target=init_session_state, args=(annotator.frame_folder,)).start()
         
-        # Construct full URLs for frames
-        frame_urls = [url_for('get_frame', filename=frame, _external=True) for frame in frame_files]
-        
-        # Return the response immediately to display the frames
+        # Return the response immediately to display the frames, the first page of frame URLs inline
         return jsonify({
             'message': 'Video uploaded and frames extracted. Inference state is initializing in the background.',
-            'frames': frame_urls
+            'session_id': session_id,
+            'video_hash': video_hash,
+            'deduplicated': deduplicated,
+            'status_url': url_for('get_inference_status', session_id=session_id, _external=True),
+            'sprites_url': url_for('get_sprite_layout', session_id=session_id, _external=True),
+            'fps': annotator.fps,
+            'source_frame_indices': annotator.source_frame_indices,
+            **frame_page(annotator, session_id, 0, FRAME_PAGE_SIZE)
         }), 200
     else:
+        annotator.mark_state_failed(generation, 'No frames extracted')
         return jsonify({'error': 'No frames extracted'}), 500
 
-# Route to get the first frame
+def frame_page(annotator, session_id, offset, limit):
+    """
+    Full URLs of a page of frames, and the URL of the next page. Image tags can't send headers, so the
+    session goes in the query, and so does the frames version, which lets browsers cache the frames for good.
+    """
+    frame_files = list(annotator.frame_names or [])
+    version = annotator.frames_version()
+    frame_urls = [url_for('get_frame', filename=frame, session_id=session_id, v=version, _external=True)
+                  for frame in frame_files[offset:offset + limit]]
+    next_offset = offset + limit
+    return {
+        'frames': frame_urls,
+        'frame_count': len(frame_files),
+        'offset': offset,
+        'frames_next': url_for('list_frames', session_id=session_id, offset=next_offset, limit=limit, _external=True)
+                       if next_offset < len(frame_files) else None
+    }
+
+def send_frame_image(annotator, image_path, variant):
+    """
+    Send a frame, thumbnail or sprite sheet with an ETag (answering If-None-Match with 304). Requests naming
+    the current frames version with 'v' may be cached as immutable, the others have to revalidate.
+    """
+    version = annotator.frames_version()
+    response = send_from_directory(os.path.dirname(image_path), os.path.basename(image_path),
+                                   etag=f"{version}-{variant}", max_age=0)
+    if request.args.get('v') == version:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = FRAME_CACHE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+# Route to handle video upload
+@app.route('/upload', methods=['POST'])
+def upload_video():
+    annotator = get_annotator()
+    if 'video' not in request.files:
+        return jsonify({'error': 'No video file provided'}), 400
+
+    try:
+        options = get_upload_options(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Stored by content hash: a video uploaded before reuses its stored file, frames and cached features
+    video = request.files['video']
+    video_path, video_hash, deduplicated = upload_store.store_stream(video.stream, video.filename)
+    return open_uploaded_video(annotator, video_path, video_hash, deduplicated, options)
+
+def upload_response(upload):
+    data = upload.to_dict()
+    data['upload_url'] = url_for('upload_chunk', upload_id=upload.upload_id, _external=True)
+    data['complete_url'] = url_for('complete_upload', upload_id=upload.upload_id, _external=True)
+    return data
+
+# Resumable chunked uploads: start one, PUT the chunks at their offsets, then complete it
+@app.route('/uploads', methods=['POST'])
+def begin_upload():
+    """
+    Start a chunked upload from a JSON body with 'filename' and optionally 'size' and 'sha256'. If the
+    hash is given and the video is already stored, the response has 'exists' set and no chunks need to be sent.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        size = data.get('size')
+        upload = upload_store.begin(data.get('filename', 'video.mp4'), total_size=int(size) if size is not None else None,
+                                    sha256=data.get('sha256'))
+        return jsonify(upload_response(upload)), 201
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error starting upload: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """
+    Report how many bytes of an upload were received, to resume it after an interruption.
+    """
+    try:
+        return jsonify(upload_response(upload_store.get(upload_id))), 200
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """
+    Append the request body at the byte given by the 'offset' query parameter or the Content-Range header
+    ('bytes <start>-<end>/<total>'). A chunk that does not start where the upload ends is refused with 409
+    and the current offset.
+    """
+    offset = request.args.get('offset', type=int)
+    content_range = request.headers.get('Content-Range')
+    if offset is None and content_range:
+        try:
+            offset = int(content_range.split()[1].split('-')[0])
+        except (IndexError, ValueError):
+            return jsonify({'error': f'Invalid Content-Range: {content_range}'}), 400
+    if offset is None:
+        return jsonify({'error': 'The chunk offset is required, as offset parameter or Content-Range header'}), 400
+
+    try:
+        upload = upload_store.append(upload_id, offset, request.stream)
+        return jsonify(upload_response(upload)), 200
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+    except UploadOffsetError as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error receiving a chunk of upload {upload_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    """
+    Finish a chunked upload and open the video in the session, like /upload. Takes the same options as
+    /upload, as form fields or JSON, plus an optional 'sha256' checked against the received data.
+    """
+    annotator = get_annotator()
+    values = request.form if request.form else MultiDict(request.get_json(silent=True) or {})
+    try:
+        options = get_upload_options(values)
+        video_path, video_hash, deduplicated = upload_store.complete(upload_id, sha256=values.get('sha256'))
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return open_uploaded_video(annotator, video_path, video_hash, deduplicated, options)
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    try:
+        upload_store.get(upload_id)
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+    upload_store.discard(upload_id)
+    return jsonify({'message': f'Upload {upload_id} aborted'}), 200
+
+@app.route('/frames', methods=['GET'])
+def list_frames():
+    """
+    Page through the frame URLs of the session's video with 'offset' and 'limit'.
+    """
+    annotator = get_annotator()
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', FRAME_PAGE_SIZE, type=int)
+    if offset < 0 or limit < 1:
+        return jsonify({'error': 'offset must not be negative and limit must be positive'}), 400
+    if not annotator.frame_names:
+        return jsonify({'error': 'No video has been uploaded for this session'}), 409
+    return jsonify(frame_page(annotator, get_session_id(), offset, min(limit, MAX_MASK_FRAMES_PER_REQUEST))), 200
+
+# Route to get a frame, or with 'width' a thumbnail of it
 @app.route('/frames/<filename>')
 def get_frame(filename):
-    return send_from_directory(annotator.frame_folder, filename)
+    annotator = get_annotator()
+    width = request.args.get('width', type=int)
+    try:
+        if width is not None:
+            # Thumbnails are made on first request and cached on disk
+            width = thumbnail_width(width)
+            frame_path = annotator.get_thumbnail_path(filename, width)
+        else:
+            # Frames of the in-memory pipeline are encoded on first request
+            frame_path = annotator.get_frame_path(filename)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if frame_path is None:
+        return jsonify({'error': f'Frame {filename} not found'}), 404
+    return send_frame_image(annotator, frame_path, f"{filename}-w{width or 'full'}")
+
+@app.route('/sprites', methods=['GET'])
+def get_sprite_layout():
+    """
+    Describe the sprite sheets of the timeline scrubber for thumbnails of 'width' pixels (rounded up to an
+    available thumbnail width) showing every 'stride'-th frame, with the URL of every sheet.
+    """
+    annotator = get_annotator()
+    if not annotator.frame_names:
+        return jsonify({'error': 'No video has been uploaded for this session'}), 409
+    try:
+        layout = annotator.sprite_layout(request.args.get('width', 64, type=int), request.args.get('stride', 1, type=int))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    session_id = get_session_id()
+    version = annotator.frames_version()
+    layout['sheets'] = [url_for('get_sprite_sheet', sheet_idx=sheet_idx, width=layout['width'], stride=layout['stride'],
+                                session_id=session_id, v=version, _external=True)
+                        for sheet_idx in range(layout['sheet_count'])]
+    return jsonify(layout), 200
+
+@app.route('/sprites/<int:sheet_idx>', methods=['GET'])
+def get_sprite_sheet(sheet_idx):
+    annotator = get_annotator()
+    if not annotator.frame_names:
+        return jsonify({'error': 'No video has been uploaded for this session'}), 409
+    width = request.args.get('width', 64, type=int)
+    stride = request.args.get('stride', 1, type=int)
+    try:
+        sheet_path = annotator.get_sprite_sheet_path(sheet_idx, width, stride)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if sheet_path is None:
+        return jsonify({'error': f'Sprite sheet {sheet_idx} not found'}), 404
+    return send_frame_image(annotator, sheet_path, os.path.basename(sheet_path))
     
 @app.route('/predict_mask', methods=['POST'])
 def predict_mask():
+    annotator = get_annotator()
+    not_ready = require_inference_state(annotator)
+    if not_ready:
+        return not_ready
     data = request.json
     object_id = data.get('object_id')
     frame_idx = data.get('frame_idx')
@@ -83,24 +630,20 @@ def predict_mask():
     
     if not object_id or frame_idx is None or not points:
         return jsonify({'error': 'Missing required parameters'}), 400
+
+    try:
+        mask_format = get_mask_format(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     # Log the incoming data
-    print(f"Object ID: {object_id}, Frame Index: {frame_idx}, Points: {points}")
+    logger.debug(f"Object ID: {object_id}, Frame Index: {frame_idx}, Points: {points}")
 
     try:
         # Prepare points and labels as NumPy arrays
         points_np = np.array([(p['x'], p['y']) for p in points], dtype=np.float32)
         labels_np = np.array([p['label'] for p in points], dtype=np.int32)
 
-        # Print logs for debugging
-        print(points_np)
-        print(labels_np)
-        print(frame_idx)
-        print(object_id)
-
-        print(annotator.frame_folder)
-        #print(annotator.inference_state)
-
         #if annotator.inference_state is None:
         #    threading.Thread(target=annotator.init_inference_state, args=(annotator.frame_folder,)).start()
 
@@ -112,10 +655,6 @@ def predict_mask():
             labels=labels_np
         )
 
-        print(frame_idx)
-        print(out_obj_ids)
-        print(out_mask_logits)
-
         # Ensure the outputs are not None
         if out_obj_ids is None or out_mask_logits is None:
             raise ValueError("Mask prediction failed: received None as output")
@@ -124,43 +663,56 @@ def predict_mask():
         # Modify the binary mask before returning it
         binary_mask = np.squeeze(binary_mask)  # This removes the extra dimension
 
-        # Count values greater than 1 in out_mask_logits
-        count_above_one = np.sum(out_mask_logits.cpu().numpy() > 1)
-        print(f"Number of values in mask logits greater than 1: {count_above_one}")
-
-        # Count how many pixels are predicted as part of the object (1 values in binary mask)
-        count_true_pixels = np.sum(binary_mask == 1)
-        print(f"Number of true (1) pixels in the binary mask: {count_true_pixels}")
+        if logger.isEnabledFor(logging.DEBUG):
+            # Count values greater than 1 in out_mask_logits, and the pixels predicted as part of the object
+            count_above_one = np.sum(out_mask_logits.cpu().numpy() > 1)
+            count_true_pixels = np.sum(binary_mask == 1)
+            logger.debug(f"Frame {frame_idx}, objects {out_obj_ids}: {count_above_one} mask logits greater than 1, "
+                         f"{count_true_pixels} true pixels in the binary mask")
 
         # Overlay the mask on the current frame
         #overlay_frame_path = annotator.display_frame_with_mask(frame_idx, out_obj_ids, out_mask_logits)
 
+        # Compact formats encode a single 2D mask, so pick the requested object's mask
+        if mask_format != 'list' and binary_mask.ndim == 3:
+            binary_mask = binary_mask[list(out_obj_ids).index(object_id)]
+
         # Return the overlay frame URL and mask prediction result
         return jsonify({
             'out_obj_ids': out_obj_ids,
             'frame_idx': frame_idx,
-            'binary_mask': binary_mask.tolist()
+            'mask_format': mask_format,
+            'binary_mask': encode_mask(binary_mask, mask_format)
         })
 
     except Exception as e:
-        print(f"Error during mask prediction: {str(e)}")
+        logger.error(f"Error during mask prediction: {str(e)}")
         return jsonify({'error': str(e)}), 500
     
 @app.route('/predict_mask_from_mask', methods=['POST'])
 def predict_mask_from_mask():
+    annotator = get_annotator()
+    not_ready = require_inference_state(annotator)
+    if not_ready:
+        return not_ready
     try:
         # Get the data from the request
         data = request.json
         frame_idx = data.get('frame_idx')
         obj_id = data.get('obj_id')
-        mask = data.get('mask')  # mask should be a list or array
+        mask = data.get('mask')  # mask should be a list or an encoded mask (see MaskEncoding)
 
         # Validate inputs
         if frame_idx is None or obj_id is None or mask is None:
             return jsonify({'error': 'Missing required parameters'}), 400
 
+        try:
+            mask_format = get_mask_format(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
         # Convert the mask to a NumPy array
-        mask_np = np.array(mask, dtype=np.uint8)
+        mask_np = decode_mask(mask).astype(np.uint8)
 
         # Pass the data to the predict_mask_from_mask function
         frame_idx, out_obj_ids, out_mask_logits = annotator.predict_mask_from_mask(
@@ -169,22 +721,112 @@ def predict_mask_from_mask():
             mask=mask_np
         )
 
-        # Return the result as JSON
+        # The legacy format returns the raw logits for compatibility
+        if mask_format == 'list':
+            return jsonify({
+                'frame_idx': frame_idx,
+                'out_obj_ids': out_obj_ids,
+                'out_mask_logits': out_mask_logits.tolist()  # Convert to list for JSON
+            }), 200
+
+        # Compact formats return one thresholded mask per object
+        binary_masks = (out_mask_logits > 0.0).cpu().numpy()
         return jsonify({
             'frame_idx': frame_idx,
             'out_obj_ids': out_obj_ids,
-            'out_mask_logits': out_mask_logits.tolist()  # Convert to list for JSON
+            'mask_format': mask_format,
+            'binary_masks': [encode_mask(np.squeeze(m, axis=0), mask_format) for m in binary_masks]
         }), 200
 
     except Exception as e:
-        print(f"Error in predict_mask_from_mask: {str(e)}")
+        logger.error(f"Error in predict_mask_from_mask: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/predict_masks_batch', methods=['POST'])
+def predict_masks_batch():
+    """
+    Prompt many objects, on one or more frames, in a single request. The body holds a 'prompts' list whose
+    entries look like the /predict_mask body ('object_id', 'frame_idx', 'points') or the
+    /predict_mask_from_mask body ('obj_id', 'frame_idx', 'mask'). Masks are returned per frame for every
+    object on it, RLE encoded unless another mask_format is requested.
+    """
+    annotator = get_annotator()
+    not_ready = require_inference_state(annotator)
+    if not_ready:
+        return not_ready
+
+    data = request.get_json(silent=True) or {}
+    if not data.get('prompts'):
+        return jsonify({'error': 'Missing required parameters'}), 400
+
+    try:
+        mask_format = get_mask_format({'mask_format': 'rle', **data})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    prompts = []
+    for prompt in data['prompts']:
+        obj_id = prompt.get('object_id', prompt.get('obj_id'))
+        frame_idx = prompt.get('frame_idx')
+        if not obj_id or frame_idx is None or not (prompt.get('points') or prompt.get('mask') is not None):
+            return jsonify({'error': f"Invalid prompt, expected object_id, frame_idx and points or mask: {prompt}"}), 400
+
+        if prompt.get('mask') is not None:
+            prompts.append({'frame_idx': frame_idx, 'obj_id': obj_id, 'mask': decode_mask(prompt['mask'])})
+        else:
+            prompts.append({
+                'frame_idx': frame_idx,
+                'obj_id': obj_id,
+                'points': [(p['x'], p['y']) for p in prompt['points']],
+                'labels': [p['label'] for p in prompt['points']]
+            })
+
+    try:
+        results = annotator.predict_masks_batch(prompts)
+
+        frames = []
+        for frame_idx, out_obj_ids, out_mask_logits in results:
+            binary_masks = (out_mask_logits > 0.0).cpu().numpy()
+            frames.append({
+                'frame_idx': frame_idx,
+                'obj_ids': list(out_obj_ids),
+                'masks': [encode_mask(np.squeeze(m, axis=0), mask_format) for m in binary_masks]
+            })
+
+        return jsonify({'mask_format': mask_format, 'frames': frames}), 200
+
+    except Exception as e:
+        logger.error(f"Error in predict_masks_batch: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/propagate_masks', methods=['POST'])
 def propagate_masks():
+    annotator = get_annotator()
+    not_ready = require_inference_state(annotator)
+    if not_ready:
+        return not_ready
+    data = request.get_json(silent=True) or {}
+    try:
+        mask_format = get_mask_format(data)
+        propagation_options = get_propagation_options(data)
+        annotator.propagation_passes(annotator.inference_state, **propagation_options)  # Checks the range
+        sparse_options = get_sparse_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     try:
-        # Start the mask propagation process
-        video_segments = annotator.propagate_segmentation(annotator.inference_state)
+        # Start the mask propagation process, 'incremental' only recomputes what changed since the last one,
+        # 'sparse' only runs the model on keyframes
+        video_segments = annotator.propagate_segmentation(annotator.inference_state,
+                                                          incremental=bool(data.get('incremental', False)),
+                                                          **propagation_options, **sparse_options)
+
+        # The masks are kept in the session's mask store, clients can skip them and fetch frames from /masks
+        if not data.get('return_masks', True):
+            return jsonify({
+                'message': 'Mask propagation completed',
+                'masks': annotator.mask_store.describe()
+            }), 200
 
         # Prepare the binary_mask_per_frame_list to return with frame_idx, obj_id, and binary_mask
         binary_mask_per_frame_list = []
@@ -196,35 +838,150 @@ def propagate_masks():
                 binary_mask_per_frame_list.append({
                     'obj_id': obj_id,          # Include object ID
                     'frame_idx': frame_idx,    # Include frame index
-                    'binary_mask': binary_mask.tolist()  # Convert numpy array to list for JSON
+                    'binary_mask': encode_mask(binary_mask, mask_format)  # Encode for JSON
                 })
 
         # Return the results as a JSON response
         return jsonify({
             'message': 'Mask propagation completed',
+            'mask_format': mask_format,
             'binary_mask_per_frame_list': binary_mask_per_frame_list
         }), 200
 
     except Exception as e:
-        print(f"Error during mask propagation: {str(e)}")
+        logger.error(f"Error during mask propagation: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/masks', methods=['GET'])
+def get_masks():
+    """
+    Fetch masks from the session's mask store: one frame with 'frame_idx', or the frames in
+    [start_frame, end_frame) with 'start_frame' and 'end_frame'. 'obj_id' (repeatable) limits
+    the objects. Masks are RLE encoded unless another mask_format is requested.
+    """
+    annotator = get_annotator()
+    try:
+        mask_format = get_mask_format({'mask_format': 'rle'})
+        obj_ids = request.args.getlist('obj_id', type=int) or None
+        frame_idx = request.args.get('frame_idx', type=int)
+        if frame_idx is not None:
+            start_frame, end_frame = frame_idx, frame_idx + 1
+        else:
+            start_frame = request.args.get('start_frame', 0, type=int)
+            end_frame = request.args.get('end_frame', start_frame + 1, type=int)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if end_frame - start_frame > MAX_MASK_FRAMES_PER_REQUEST:
+        return jsonify({'error': f'At most {MAX_MASK_FRAMES_PER_REQUEST} frames can be fetched per request'}), 400
+
+    stored_frames = [idx for idx in annotator.mask_store.frame_indices() if start_frame <= idx < end_frame]
+    frames = []
+    for idx in stored_frames:
+        masks = annotator.mask_store.get_frame(idx, obj_ids)
+        if masks:
+            frames.append({
+                'frame_idx': idx,
+                'obj_ids': list(masks.keys()),
+                'masks': [encode_mask(mask, mask_format) for mask in masks.values()]
+            })
+
+    return jsonify({'mask_format': mask_format, 'frames': frames}), 200
+
+@app.route('/masks/summary', methods=['GET'])
+def get_mask_summary():
+    annotator = get_annotator()
+    return jsonify(annotator.mask_store.describe()), 200
+
+@app.route('/propagate_masks_stream', methods=['POST'])
+def propagate_masks_stream():
+    """
+    Stream the propagated masks frame by frame as SAM2 produces them, instead of building one
+    response for the whole video. The response is NDJSON (one JSON object per line) by default,
+    or Server-Sent Events when requested with stream=sse or an 'Accept: text/event-stream' header.
+    Closing the connection (or calling /propagate_masks/cancel) stops the propagation loop.
+    """
+    annotator = get_annotator()
+    not_ready = require_inference_state(annotator)
+    if not_ready:
+        return not_ready
+    data = request.get_json(silent=True) or {}
+    try:
+        mask_format = get_mask_format(data)
+        propagation_options = get_propagation_options(data)
+        annotator.propagation_passes(annotator.inference_state, **propagation_options)
+        sparse_options = get_sparse_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    use_sse = (request.args.get('stream', data.get('stream')) == 'sse'
+               or request.accept_mimetypes.best == 'text/event-stream')
+
+    def format_message(event, payload):
+        if use_sse:
+            return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+        return json.dumps({'event': event, **payload}) + "\n"
+
+    def generate():
+        frame_count = 0
+        # Produced on a separate thread, a slow client does not hold the session's state lock
+        propagation = annotator.stream_propagation(annotator.inference_state, **propagation_options, **sparse_options)
+        try:
+            for frame_idx, out_obj_ids, binary_masks in propagation:
+                frame_count += 1
+                yield format_message('mask', {
+                    'frame_idx': frame_idx,
+                    'obj_ids': out_obj_ids,
+                    'binary_masks': [encode_mask(mask, mask_format) for mask in binary_masks]
+                })
+
+            status = 'cancelled' if annotator.propagation_cancel.is_set() else 'completed'
+            yield format_message('done', {'status': status, 'frames': frame_count})
+
+        except Exception as e:
+            logger.error(f"Error during streaming mask propagation: {str(e)}")
+            yield format_message('error', {'error': str(e)})
+
+        finally:
+            # Runs on client disconnect too, which stops the propagation after the current frame
+            propagation.close()
+
+    mimetype = 'text/event-stream' if use_sse else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/propagate_masks/cancel', methods=['POST'])
+def cancel_propagation():
+    annotator = get_annotator()
+    annotator.cancel_propagation()
+    return jsonify({'message': 'Propagation cancellation requested.'}), 200
+
+
 @app.route('/video-info', methods=['GET'])
 def get_video_info():
+    annotator = get_annotator()
+    not_ready = require_inference_state(annotator)
+    if not_ready:
+        return not_ready
     video_height = annotator.inference_state.get('video_height')
     video_width = annotator.inference_state.get('video_width')
     
     if video_height and video_width:
         return jsonify({
             'video_height': video_height,
-            'video_width': video_width
+            'video_width': video_width,
+            'inference_profile': inference_profile.describe()
         }), 200
     else:
         return jsonify({'error': 'Video dimensions not available'}), 404
     
 @app.route('/reset_inference', methods=['POST'])
 def reset_inference():
+    annotator = get_annotator()
+    not_ready = require_inference_state(annotator)
+    if not_ready:
+        return not_ready
     try:
         # Call the reset_inference_state function from the AnnotationModule
         annotator.reset_inference_state()
@@ -237,18 +994,95 @@ def reset_inference():
         # Return an error message if resetting fails
         return jsonify({'error': f"Error resetting inference state: {str(e)}"}), 500
     
+def step_prompt_history(step):
+    """
+    Undo or redo the last prompt of the object given as 'object_id' in the JSON body, and return the object's
+    mask on the frame of that prompt as it is now (null if the object has no mask there anymore).
+    """
+    annotator = get_annotator()
+    not_ready = require_inference_state(annotator)
+    if not_ready:
+        return not_ready
+    data = request.get_json(silent=True) or {}
+    object_id = data.get('object_id')
+    if not object_id:
+        return jsonify({'error': 'Missing required parameter object_id'}), 400
+
+    try:
+        mask_format = get_mask_format(data)
+        entry = annotator.undo_prompt(object_id) if step == 'undo' else annotator.redo_prompt(object_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        logger.error(f"Error during {step}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    mask = annotator.mask_store.get(object_id, entry['frame_idx'])
+    return jsonify({
+        'object_id': object_id,
+        step: entry,
+        'frame_idx': entry['frame_idx'],
+        'mask_format': mask_format,
+        'binary_mask': encode_mask(mask, mask_format) if mask is not None else None,
+        'can_undo': annotator.prompt_history.can_undo(object_id),
+        'can_redo': annotator.prompt_history.can_redo(object_id)
+    }), 200
+
+@app.route('/undo', methods=['POST'])
+def undo_prompt():
+    return step_prompt_history('undo')
+
+@app.route('/redo', methods=['POST'])
+def redo_prompt():
+    return step_prompt_history('redo')
+
+@app.route('/history', methods=['GET'])
+def get_prompt_history():
+    """
+    List the prompt history of every object of the session, with the position undo and redo step from.
+    """
+    annotator = get_annotator()
+    with annotator.state_lock:
+        return jsonify(annotator.prompt_history.describe()), 200
+
+@app.route('/history/replay', methods=['POST'])
+def replay_prompt_history():
+    """
+    Rebuild the prompts and the history of the session from its replay log, after a restart and once the
+    same video was uploaded again.
+    """
+    annotator = get_annotator()
+    not_ready = require_inference_state(annotator)
+    if not_ready:
+        return not_ready
+    try:
+        events = annotator.replay_history()
+        return jsonify({'message': f'Replayed {events} prompt history events', 'events': events,
+                        **annotator.prompt_history.describe()}), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        logger.error(f"Error replaying the prompt history: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/download_video', methods=['POST'])
 def download_video():
+    annotator = get_annotator()
     try:
-        # Get the mask data from the request
-        data = request.json
+        # Get the mask data from the request, or read the masks from the server-side mask store
+        data = request.get_json(silent=True) or {}
         masks_by_object_and_frame = data.get('masksByObjectAndFrame')
 
-        if not masks_by_object_and_frame:
+        if not masks_by_object_and_frame and not len(annotator.mask_store):
             return jsonify({'error': 'No mask data provided'}), 400
 
+        try:
+            export_options = get_export_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
         # Call a function in AnnotationModule to generate the video with masks
-        output_video_path = annotator.create_annotated_video(masks_by_object_and_frame)
+        output_video_path = annotator.create_annotated_video(masks_by_object_and_frame or None, **export_options)
 
         if os.path.exists(output_video_path):
             return send_from_directory(os.path.dirname(output_video_path), os.path.basename(output_video_path), as_attachment=True)
@@ -256,14 +1090,288 @@ def download_video():
             return jsonify({'error': 'Video generation failed'}), 500
 
     except Exception as e:
-        print(f"Error generating video: {str(e)}")
+        logger.error(f"Error generating video: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/export_dataset', methods=['POST'])
+def export_dataset():
+    """
+    Download the masks in the mask store as a zip archive of COCO (RLE or polygons), YOLO segmentation
+    or indexed PNG annotations. Use /jobs/export_dataset for long videos.
+    """
+    annotator = get_annotator()
+    try:
+        data = request.get_json(silent=True) or {}
+        if not len(annotator.mask_store):
+            return jsonify({'error': 'No mask data provided'}), 400
+
+        try:
+            dataset_options = get_dataset_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        output_path = annotator.create_dataset_export(**dataset_options)
+        return send_from_directory(os.path.dirname(output_path), os.path.basename(output_path), as_attachment=True)
+
+    except Exception as e:
+        logger.error(f"Error exporting dataset: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/propagate', methods=['POST'])
+def submit_propagation_job():
+    """
+    Run the mask propagation in the background. The masks are written to the job folder as JSON
+    (RLE encoded unless another mask_format is requested) and can be fetched from /jobs/<job_id>/result.
+    """
+    data = request.get_json(silent=True) or {}
+    annotator = get_annotator()
+    not_ready = require_inference_state(annotator)
+    if not_ready:
+        return not_ready
+    session_id = get_session_id()
+    try:
+        # Results are persisted, so default to the compact RLE format rather than nested lists
+        mask_format = get_mask_format({'mask_format': 'rle', **data})
+        propagation_options = get_propagation_options(data)
+        annotator.propagation_passes(annotator.inference_state, **propagation_options)
+        sparse_options = get_sparse_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def run_propagation(job, job_folder):
+        # The session is not offloaded while the job is queued or running, but may have been just before
+        session_manager.restore(session_id)
+        video_segments = annotator.propagate_segmentation(
+            annotator.inference_state,
+            progress_callback=job.report_progress,
+            cancel_event=job.cancel_event,
+            incremental=bool(data.get('incremental', False)),
+            **propagation_options,
+            **sparse_options
+        )
+        if job.cancel_event.is_set():
+            raise JobCancelled()
+
+        binary_mask_per_frame_list = [{
+            'obj_id': obj_id,
+            'frame_idx': frame_idx,
+            'binary_mask': encode_mask(np.squeeze(binary_mask), mask_format)
+        } for obj_id, frame_masks in video_segments.items() for frame_idx, binary_mask in frame_masks.items()]
+
+        result_path = os.path.join(job_folder, 'masks.json')
+        with open(result_path, 'w') as f:
+            json.dump({'mask_format': mask_format, 'binary_mask_per_frame_list': binary_mask_per_frame_list}, f)
+        return result_path
+
+    job = job_manager.submit('propagate', run_propagation, session_id=session_id)
+    status_url = url_for('get_job', job_id=job.job_id, session_id=session_id, _external=True)
+    return jsonify({**job.to_dict(), 'status_url': status_url}), 202
+
+@app.route('/jobs/download_video', methods=['POST'])
+def submit_video_job():
+    """
+    Render the annotated video in the background. The video can be downloaded from /jobs/<job_id>/result.
+    Without 'masksByObjectAndFrame', the masks are read from the session's mask store.
+    """
+    data = request.get_json(silent=True) or {}
+    annotator = get_annotator()
+    session_id = get_session_id()
+    masks_by_object_and_frame = data.get('masksByObjectAndFrame')
+
+    if not masks_by_object_and_frame and not len(annotator.mask_store):
+        return jsonify({'error': 'No mask data provided'}), 400
+
+    try:
+        export_options = get_export_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def run_export(job, job_folder):
+        return annotator.create_annotated_video(
+            masks_by_object_and_frame or None,
+            output_video_path=os.path.join(job_folder, 'annotated_video' + video_extension(export_options['codec'])),
+            progress_callback=job.report_progress,
+            cancel_event=job.cancel_event,
+            **export_options
+        )
+
+    job = job_manager.submit('download_video', run_export, session_id=session_id)
+    status_url = url_for('get_job', job_id=job.job_id, session_id=session_id, _external=True)
+    return jsonify({**job.to_dict(), 'status_url': status_url}), 202
+
+@app.route('/jobs/export_dataset', methods=['POST'])
+def submit_dataset_job():
+    """
+    Export the dataset in the background. The archive can be downloaded from /jobs/<job_id>/result.
+    """
+    data = request.get_json(silent=True) or {}
+    annotator = get_annotator()
+    session_id = get_session_id()
+
+    if not len(annotator.mask_store):
+        return jsonify({'error': 'No mask data provided'}), 400
+
+    try:
+        dataset_options = get_dataset_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def run_export(job, job_folder):
+        return annotator.create_dataset_export(
+            output_path=os.path.join(job_folder, f"dataset_{dataset_options['dataset_format']}.zip"),
+            progress_callback=job.report_progress,
+            cancel_event=job.cancel_event,
+            **dataset_options
+        )
+
+    job = job_manager.submit('export_dataset', run_export, session_id=session_id)
+    status_url = url_for('get_job', job_id=job.job_id, session_id=session_id, _external=True)
+    return jsonify({**job.to_dict(), 'status_url': status_url}), 202
+
+def get_session_job(job_id):
+    """
+    Return the job with the given ID if the session making the current request submitted it, None otherwise,
+    so sessions can neither see nor download each other's jobs.
+    """
+    job = job_manager.get(job_id)
+    if job is None or job.session_id != get_session_id():
+        return None
+    return job
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({'jobs': [job.to_dict() for job in job_manager.list(get_session_id())]}), 200
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = get_session_job(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    return jsonify(job.to_dict()), 200
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if get_session_job(job_id) is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    try:
+        job = job_manager.cancel(job_id)
+        return jsonify(job.to_dict()), 200
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = get_session_job(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    if job.status != 'completed' or not job.result_path or not os.path.exists(job.result_path):
+        return jsonify({'error': f'Job {job_id} has no result (status: {job.status})'}), 409
+    return send_from_directory(os.path.dirname(job.result_path), os.path.basename(job.result_path),
+                               as_attachment=job.kind in ('download_video', 'export_dataset'))
+
+@app.route('/inference_status', methods=['GET'])
+def get_inference_status():
+    """
+    Report whether the session's inference state is idle, loading, ready or failed,
+    and what share of the video frames is loaded.
+    """
+    annotator = get_annotator()
+    return jsonify(annotator.get_state_status()), 200
+
+@app.route('/feature_cache', methods=['GET'])
+def feature_cache_stats():
+    return jsonify(feature_cache.get_stats()), 200
+
+@app.route('/inference_worker', methods=['GET'])
+def inference_worker_stats():
+    if inference_worker is None:
+        return jsonify({'error': 'The inference worker is disabled'}), 404
+    return jsonify(inference_worker.describe()), 200
+
+@app.route('/health', methods=['GET'])
+def health():
+    """
+    Liveness of the server, the state of the model and the inference profile it runs with.
+    """
+    return jsonify({
+        'status': 'ok',
+        'startup_seconds': startup_seconds,
+        'model': session_manager.predictor.describe_model(),
+        'sessions': len(session_manager.sessions),
+        'inference_profile': inference_profile.describe(),
+        'inference_worker': inference_worker.describe() if inference_worker is not None else None
+    }), 200
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness probe: 200 once the model is loaded and warmed up, 503 while it loads, 500 if loading failed.
+    """
+    model = session_manager.predictor.describe_model()
+    if model['status'] == MODEL_READY:
+        return jsonify({'status': 'ready', 'model': model}), 200
+    elif model['status'] == MODEL_LOADING:
+        response = jsonify({'status': 'loading', 'model': model})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    else:
+        return jsonify({'status': 'failed', 'model': model}), 500
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Latency histograms of the pipeline stages and HTTP endpoints, and a few gauges, in the Prometheus text
+    format. With format=json, the count, mean, p50 and p95 of every stage instead.
+    """
+    if request.args.get('format') == 'json':
+        return jsonify(metrics.summary()), 200
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/sessions', methods=['GET'])
+def list_sessions():
+    return jsonify({
+        'memory_budget_bytes': session_manager.memory_budget_bytes,
+        'sessions': session_manager.describe()
+    }), 200
+
+@app.route('/sessions/<session_id>/offload', methods=['POST'])
+def offload_session(session_id):
+    try:
+        offloaded = session_manager.offload(session_id)
+        return jsonify({'session_id': session_id, 'offloaded': offloaded}), 200
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+
+@app.route('/sessions/<session_id>/restore', methods=['POST'])
+def restore_session(session_id):
+    try:
+        session_manager.restore(session_id)
+        return jsonify({'session_id': session_id, 'offloaded': False}), 200
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        logger.error(f"Error restoring session {session_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    try:
+        session_manager.remove(session_id)
+        return jsonify({'message': f'Session {session_id} removed.'}), 200
+    except KeyError as e:
+        return jsonify({'error': str(e)}), 404
+
 # Route to serve the overlay frame
 @app.route('/overlay/<filename>')
 def get_overlay_frame(filename):
+    annotator = get_annotator()
     return send_from_directory(annotator.overlay_folder, filename)
 
+# Everything above runs on import, the model itself may still be loading
+startup_seconds = time.time() - STARTUP_STARTED
+logger.info(f"Server started in {startup_seconds:.2f}s"
+            f"{', loading the model in the background' if BACKGROUND_MODEL_LOADING else ''}")
+
 # Run the Flask app
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
+    app.run(debug=FLASK_DEBUG, port=5000, use_reloader=False, threaded=True)
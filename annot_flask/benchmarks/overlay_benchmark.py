@@ -0,0 +1,80 @@
+#overlay_benchmark.py micro-benchmark of the mask overlay
+"""
+Compare the per-object overlay (a full-frame color image and a cv2.addWeighted per object) with
+OverlayRenderer, in frames per second against the number of objects.
+
+    python benchmarks/overlay_benchmark.py --width 1920 --height 1080 --frames 50
+"""
+import os
+import sys
+import time
+import argparse
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from modules.Overlay import OverlayRenderer
+
+COLORS = {
+    1: [0, 0, 255], 2: [255, 0, 0], 3: [0, 0, 255], 4: [255, 255, 0], 5: [128, 0, 128],
+    6: [0, 255, 0], 7: [255, 165, 0], 8: [128, 128, 0], 9: [128, 128, 128]
+}
+
+
+def make_masks(num_objects, width, height, rng):
+    """
+    One filled ellipse per object, covering a few percent of the frame each.
+    """
+    masks = []
+    for obj_id in range(1, num_objects + 1):
+        mask = np.zeros((height, width), dtype=np.uint8)
+        center = (int(rng.integers(width // 8, width * 7 // 8)), int(rng.integers(height // 8, height * 7 // 8)))
+        axes = (int(rng.integers(width // 16, width // 6)), int(rng.integers(height // 16, height // 6)))
+        cv2.ellipse(mask, center, axes, 0, 0, 360, 1, -1)
+        masks.append((obj_id, mask.astype(bool)))
+    return masks
+
+
+def legacy_overlay(frame, masks):
+    """
+    The overlay as previously done in AnnotationModule.
+    """
+    for obj_id, mask in masks:
+        mask = mask.astype(np.uint8) * 255
+        color = np.array(COLORS.get(obj_id, [128, 128, 128])).reshape(1, 1, 3)
+        mask_image = np.clip(mask[:, :, np.newaxis] * color, 0, 255).astype(np.uint8)
+        frame = cv2.addWeighted(frame, 0.7, mask_image, 0.3, 0)
+    return frame
+
+
+def measure(render, frame, masks, num_frames):
+    start = time.perf_counter()
+    for _ in range(num_frames):
+        render(frame, masks)
+    return num_frames / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--frames', type=int, default=30, help='Frames rendered per measurement')
+    parser.add_argument('--max-objects', type=int, default=9)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    renderer = OverlayRenderer(COLORS)
+
+    print(f"{args.width}x{args.height}, {args.frames} frames per measurement")
+    print(f"{'objects':>8} {'legacy fps':>12} {'renderer fps':>13} {'+contours fps':>14} {'speedup':>8}")
+    for num_objects in range(1, args.max_objects + 1):
+        masks = make_masks(num_objects, args.width, args.height, rng)
+        legacy_fps = measure(legacy_overlay, frame, masks, args.frames)
+        renderer_fps = measure(renderer.render, frame, masks, args.frames)
+        contour_fps = measure(lambda f, m: renderer.render(f, m, contours=True), frame, masks, args.frames)
+        print(f"{num_objects:>8} {legacy_fps:>12.1f} {renderer_fps:>13.1f} {contour_fps:>14.1f} {renderer_fps / legacy_fps:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
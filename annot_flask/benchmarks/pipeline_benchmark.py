@@ -0,0 +1,354 @@
+#pipeline_benchmark.py offline benchmark of the AnnotationModule hot paths
+"""
+Time the annotation pipeline on a synthetic video: frame extraction (video_to_frames), init_inference_state,
+predict_mask, propagate_segmentation, the JSON mask serialization of /propagate_masks and
+create_annotated_video. Reports p50/p95 latency, throughput and the peak RSS reached after each stage.
+
+By default SAM2 is replaced by a stub predictor that returns synthetic masks, so the decoding, I/O and
+serialization paths can be measured on a CPU box without the checkpoint. --model sam2 loads the real model.
+
+    python benchmarks/pipeline_benchmark.py --frames 60 --width 1280 --height 720 --objects 3
+    python benchmarks/pipeline_benchmark.py --model sam2 --device cuda --json results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+from collections import OrderedDict
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from modules.Annotation import AnnotationModule
+from modules.MaskEncoding import MASK_FORMATS, encode_mask
+from modules.Metrics import metrics
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODEL_CFG = os.path.join(current_dir, '..', '..', 'sam2_hiera_l.yaml')
+DEFAULT_CHECKPOINT = os.path.join(current_dir, '..', '..', 'sam2_hiera_large.pt')
+
+
+# Stub predictor
+class StubPredictor:
+    def __init__(self, image_size=1024, device='cpu', latency_ms=0.0):
+        """
+        Stand-in for SAM2VideoPredictor with the calls AnnotationModule makes. Frames are loaded through
+        SAM2's frame loader (so the in-memory and JPEG pipelines run for real), and every object gets a
+        disc-shaped mask around its last prompt, drifting slowly over the frames.
+
+        Args:
+            image_size (int): Model input size, sets the size of the decoded frame tensor.
+            device (str): Device of the inference state.
+            latency_ms (float): Optional. Sleep per object and frame, to mimic the model's cost.
+        """
+        self.image_size = image_size
+        self.device = torch.device(device)
+        self.latency_ms = latency_ms
+        self.clear_non_cond_mem_around_input = False
+
+    def init_state(self, video_path, offload_video_to_cpu=False, async_loading_frames=False, **kwargs):
+        import sam2.sam2_video_predictor as sam2_video_predictor
+
+        images, video_height, video_width = sam2_video_predictor.load_video_frames(
+            video_path=video_path, image_size=self.image_size, offload_video_to_cpu=offload_video_to_cpu,
+            compute_device=self.device)
+        return {
+            "images": images,
+            "num_frames": len(images),
+            "video_height": video_height,
+            "video_width": video_width,
+            "device": self.device,
+            "point_inputs_per_obj": {},
+            "mask_inputs_per_obj": {},
+            "obj_id_to_idx": OrderedDict(),
+            "obj_idx_to_id": OrderedDict(),
+            "obj_ids": [],
+            "output_dict_per_obj": {},
+            "temp_output_dict_per_obj": {},
+            "frames_tracked_per_obj": {},
+            "cached_features": {},
+            "stub_centers": {}  # obj_id -> (x, y, radius) of the last prompt
+        }
+
+    def reset_state(self, inference_state):
+        for key in ("point_inputs_per_obj", "mask_inputs_per_obj", "obj_id_to_idx", "obj_idx_to_id",
+                    "output_dict_per_obj", "temp_output_dict_per_obj", "frames_tracked_per_obj", "stub_centers"):
+            inference_state[key].clear()
+        inference_state["obj_ids"] = []
+
+    def _obj_id_to_idx(self, inference_state, obj_id):
+        obj_idx = inference_state["obj_id_to_idx"].get(obj_id)
+        if obj_idx is None:
+            obj_idx = len(inference_state["obj_id_to_idx"])
+            inference_state["obj_id_to_idx"][obj_id] = obj_idx
+            inference_state["obj_idx_to_id"][obj_idx] = obj_id
+            inference_state["obj_ids"] = list(inference_state["obj_id_to_idx"])
+            for key in ("point_inputs_per_obj", "mask_inputs_per_obj", "frames_tracked_per_obj"):
+                inference_state[key][obj_idx] = {}
+            for key in ("output_dict_per_obj", "temp_output_dict_per_obj"):
+                inference_state[key][obj_idx] = {"cond_frame_outputs": {}, "non_cond_frame_outputs": {}}
+        return obj_idx
+
+    def remove_object(self, inference_state, obj_id, strict=False, need_output=True):
+        # Like SAM2, the remaining objects are renumbered so their indices stay contiguous
+        obj_idx = inference_state["obj_id_to_idx"].get(obj_id)
+        if obj_idx is None:
+            if strict:
+                raise RuntimeError(f"Cannot remove object id {obj_id} as it doesn't exist.")
+            return inference_state["obj_ids"], None
+
+        per_obj = {key: {obj_id_: inference_state[key][idx] for obj_id_, idx in inference_state["obj_id_to_idx"].items()}
+                   for key in ("point_inputs_per_obj", "mask_inputs_per_obj", "output_dict_per_obj",
+                               "temp_output_dict_per_obj", "frames_tracked_per_obj")}
+        remaining = [obj_id_ for obj_id_ in inference_state["obj_ids"] if obj_id_ != obj_id]
+        inference_state["obj_id_to_idx"] = OrderedDict((obj_id_, idx) for idx, obj_id_ in enumerate(remaining))
+        inference_state["obj_idx_to_id"] = OrderedDict(enumerate(remaining))
+        inference_state["obj_ids"] = remaining
+        for key, values in per_obj.items():
+            inference_state[key].clear()
+            inference_state[key].update((idx, values[obj_id_]) for idx, obj_id_ in enumerate(remaining))
+        inference_state["stub_centers"].pop(obj_id, None)
+        return remaining, None
+
+    def _masks(self, inference_state, frame_idx):
+        height, width = inference_state["video_height"], inference_state["video_width"]
+        if self.latency_ms:
+            time.sleep(self.latency_ms * len(inference_state["obj_ids"]) / 1000)
+
+        ys = torch.arange(height, dtype=torch.float32).view(height, 1)
+        xs = torch.arange(width, dtype=torch.float32).view(1, width)
+        logits = torch.empty((len(inference_state["obj_ids"]), 1, height, width), dtype=torch.float32)
+        for i, obj_id in enumerate(inference_state["obj_ids"]):
+            x, y, radius = inference_state["stub_centers"][obj_id]
+            x = (x + frame_idx) % width
+            inside = (xs - x) ** 2 + (ys - y) ** 2 < radius ** 2
+            logits[i, 0] = inside.float() * 20.0 - 10.0
+        return list(inference_state["obj_ids"]), logits
+
+    def add_new_points_or_box(self, inference_state, frame_idx, obj_id, points=None, labels=None, **kwargs):
+        obj_idx = self._obj_id_to_idx(inference_state, obj_id)
+        inference_state["point_inputs_per_obj"][obj_idx][frame_idx] = (points, labels)
+        inference_state["output_dict_per_obj"][obj_idx]["cond_frame_outputs"][frame_idx] = {}
+
+        positive = np.asarray(points)[np.asarray(labels) == 1]
+        x, y = positive.mean(axis=0) if len(positive) else np.asarray(points).mean(axis=0)
+        inference_state["stub_centers"][obj_id] = (float(x), float(y), min(inference_state["video_height"],
+                                                                           inference_state["video_width"]) / 8)
+        return (frame_idx, *self._masks(inference_state, frame_idx))
+
+    def add_new_mask(self, inference_state, frame_idx, obj_id, mask):
+        obj_idx = self._obj_id_to_idx(inference_state, obj_id)
+        inference_state["mask_inputs_per_obj"][obj_idx][frame_idx] = mask
+        inference_state["output_dict_per_obj"][obj_idx]["cond_frame_outputs"][frame_idx] = {}
+
+        ys, xs = np.nonzero(mask)
+        radius = np.sqrt(len(xs) / np.pi) if len(xs) else 1.0
+        inference_state["stub_centers"][obj_id] = (float(xs.mean()) if len(xs) else 0.0,
+                                                   float(ys.mean()) if len(ys) else 0.0, radius)
+        return (frame_idx, *self._masks(inference_state, frame_idx))
+
+    def propagate_in_video_preflight(self, inference_state):
+        if not inference_state["obj_ids"]:
+            raise RuntimeError("No input points or masks are provided for any object; please add inputs first.")
+
+    def propagate_in_video(self, inference_state, start_frame_idx=None, max_frame_num_to_track=None, reverse=False):
+        # Same frame range semantics as SAM2VideoPredictor.propagate_in_video
+        self.propagate_in_video_preflight(inference_state)
+        num_frames = inference_state["num_frames"]
+        if start_frame_idx is None:
+            start_frame_idx = min(t for output_dict in inference_state["output_dict_per_obj"].values()
+                                  for t in output_dict["cond_frame_outputs"])
+        if max_frame_num_to_track is None:
+            max_frame_num_to_track = num_frames
+        if reverse:
+            end_frame_idx = max(start_frame_idx - max_frame_num_to_track, 0)
+            processing_order = range(start_frame_idx, end_frame_idx - 1, -1) if start_frame_idx > 0 else []
+        else:
+            end_frame_idx = min(start_frame_idx + max_frame_num_to_track, num_frames - 1)
+            processing_order = range(start_frame_idx, end_frame_idx + 1)
+
+        for frame_idx in processing_order:
+            yield (frame_idx, *self._masks(inference_state, frame_idx))
+
+
+def make_synthetic_video(path, num_frames, width, height, fps, num_objects, seed=0):
+    """
+    Write a video of colored ellipses moving over a textured background.
+    """
+    rng = np.random.default_rng(seed)
+    background = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (0, 0), 8)
+    objects = [(rng.uniform(0, width), rng.uniform(0, height), rng.uniform(-4, 4), rng.uniform(-4, 4),
+                tuple(int(c) for c in rng.integers(0, 256, 3))) for _ in range(num_objects)]
+
+    video_writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    for frame_idx in range(num_frames):
+        frame = background.copy()
+        for x, y, dx, dy, color in objects:
+            center = (int(x + dx * frame_idx) % width, int(y + dy * frame_idx) % height)
+            cv2.ellipse(frame, center, (width // 12, height // 10), frame_idx % 180, 0, 360, color, -1)
+        video_writer.write(frame)
+    video_writer.release()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def summarize(name, samples, items_per_sample=1, unit='frames'):
+    """
+    p50/p95 of the samples (seconds) and throughput in items per second.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    total = samples.sum()
+    return {
+        'name': name,
+        'samples': len(samples),
+        'p50_ms': float(np.percentile(samples, 50) * 1000),
+        'p95_ms': float(np.percentile(samples, 95) * 1000),
+        'throughput': float(items_per_sample * len(samples) / total) if total else None,
+        'unit': unit,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='annot-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    video_path = os.path.join(workdir, 'synthetic.mp4')
+    make_synthetic_video(video_path, args.frames, args.width, args.height, args.fps, args.objects)
+
+    if args.model == 'sam2':
+        from sam2.build_sam import build_sam2_video_predictor
+        predictor = build_sam2_video_predictor(args.model_cfg, args.checkpoint, device=args.device)
+    else:
+        predictor = StubPredictor(image_size=args.image_size, device=args.device, latency_ms=args.stub_latency_ms)
+    annotator = AnnotationModule(args.model_cfg, args.checkpoint, args.device, predictor=predictor)
+
+    results = []
+    try:
+        # Frame extraction to JPEGs
+        samples = []
+        for _ in range(args.repeats):
+            elapsed, _ = timed(annotator.video_to_frames, video_path, reuse_frames=False)
+            samples.append(elapsed)
+        results.append(summarize('video_to_frames', samples, len(annotator.frame_names)))
+
+        # Inference state from the in-memory decoding pipeline
+        samples = []
+        for _ in range(args.repeats):
+            annotator.mask_store.clear()
+            start = time.perf_counter()
+            annotator.prepare_in_memory_video(video_path)
+            annotator.init_inference_state(annotator.frame_folder, async_loading_frames=False)
+            samples.append(time.perf_counter() - start)
+        num_frames = annotator.inference_state["num_frames"]
+        results.append(summarize('init_inference_state', samples, num_frames))
+
+        # Clicks on random frames, one object after the other
+        rng = np.random.default_rng(1)
+        samples = []
+        for click in range(args.clicks):
+            obj_id = click % args.objects + 1
+            frame_idx = 0 if click < args.objects else int(rng.integers(0, num_frames))
+            point = [[float(rng.uniform(0, args.width)), float(rng.uniform(0, args.height))]]
+            elapsed, _ = timed(annotator.predict_mask, frame_idx, obj_id, point, [1])
+            samples.append(elapsed)
+        results.append(summarize('predict_mask', samples, unit='calls'))
+
+        # Full propagation, per-frame latency from the progress callback
+        frame_samples = []
+        for _ in range(args.repeats):
+            last = [time.perf_counter()]
+
+            def record(frames_done, frames_total):
+                now = time.perf_counter()
+                frame_samples.append(now - last[0])
+                last[0] = now
+
+            annotator.propagate_segmentation(annotator.inference_state, progress_callback=record)
+        results.append(summarize('propagate_segmentation', frame_samples))
+
+        # JSON serialization of the propagated masks, as /propagate_masks builds its response
+        masks_by_frame = {frame_idx: annotator.mask_store.get_frame(frame_idx)
+                          for frame_idx in annotator.mask_store.frame_indices()}
+        for mask_format in args.mask_formats:
+            samples = []
+            payload_bytes = 0
+            for frame_idx, frame_masks in masks_by_frame.items():
+                start = time.perf_counter()
+                payload = json.dumps([{
+                    'obj_id': obj_id,
+                    'frame_idx': frame_idx,
+                    'binary_mask': encode_mask(mask, mask_format)
+                } for obj_id, mask in frame_masks.items()])
+                samples.append(time.perf_counter() - start)
+                payload_bytes += len(payload)
+            result = summarize(f'serialize_{mask_format}', samples)
+            result['payload_mb'] = payload_bytes / (1024 * 1024)
+            results.append(result)
+
+        # Annotated video from the mask store
+        samples = []
+        for _ in range(args.repeats):
+            elapsed, _ = timed(annotator.create_annotated_video,
+                               output_video_path=os.path.join(workdir, 'annotated.mp4'))
+            samples.append(elapsed)
+        results.append(summarize('create_annotated_video', samples, num_frames))
+
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=60, help='Length of the synthetic video')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--fps', type=float, default=30.0)
+    parser.add_argument('--objects', type=int, default=3)
+    parser.add_argument('--clicks', type=int, default=20, help='predict_mask calls to time')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs of each whole-video stage')
+    parser.add_argument('--mask-formats', nargs='+', default=list(MASK_FORMATS), choices=MASK_FORMATS)
+    parser.add_argument('--model', choices=['stub', 'sam2'], default='stub')
+    parser.add_argument('--model-cfg', default=DEFAULT_MODEL_CFG)
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--image-size', type=int, default=1024, help='Input size of the stub model')
+    parser.add_argument('--stub-latency-ms', type=float, default=0.0, help='Stub model cost per object and frame')
+    parser.add_argument('--workdir', help='Where to write the video and frames, a temporary folder by default')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary folder')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    print(f"{args.model} model, {args.frames} frames of {args.width}x{args.height}, {args.objects} objects")
+    print(f"{'stage':<24} {'samples':>8} {'p50 ms':>10} {'p95 ms':>10} {'throughput':>16} {'peak RSS MB':>12}")
+    for result in results:
+        throughput = f"{result['throughput']:.1f} {result['unit']}/s" if result['throughput'] else '-'
+        print(f"{result['name']:<24} {result['samples']:>8} {result['p50_ms']:>10.2f} {result['p95_ms']:>10.2f} "
+              f"{throughput:>16} {result['peak_rss_mb']:>12.0f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'results': results, 'stages': metrics.summary()}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,51 +1,231 @@
 import os
+import time
+import hashlib
+import json
+import shutil
+import queue
+import inspect
+import logging
+import threading
+import weakref
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import torch
-import torchvision
 import numpy as np
-from PIL import Image
-import base64
-from sam2.build_sam import build_sam2_video_predictor
-from IPython.display import display, Image
-
-# select the device for computation
-if torch.cuda.is_available():
-    device = torch.device("cuda")
-elif torch.backends.mps.is_available():
-    device = torch.device("mps")
-else:
-    device = torch.device("cpu")
-print(f"using device: {device}")
-
-if device.type == "cuda":
-    # use bfloat16 for the entire notebook
-    torch.autocast("cuda", dtype=torch.bfloat16).__enter__()
-    # turn on tfloat32 for Ampere GPUs (https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices)
-    if torch.cuda.get_device_properties(0).major >= 8:
-        torch.backends.cuda.matmul.allow_tf32 = True
-        torch.backends.cudnn.allow_tf32 = True
-elif device.type == "mps":
-    print(
-        "\nSupport for MPS devices is preliminary. SAM 2 is trained with CUDA and might "
-        "give numerically different outputs and sometimes degraded performance on MPS. "
-        "See e.g. https://github.com/pytorch/pytorch/issues/84936 for a discussion."
-    )
+from .MaskEncoding import decode_mask, rle_encode, rle_decode
+from .MaskStore import MaskStore
+from .PromptHistory import PromptHistory, ObjectSnapshot, OBJECT_STATE_KEYS, DEFAULT_HISTORY_BYTES, copy_structure
+from .FrameExtraction import (DEFAULT_NUM_WORKERS, probe_video, sample_frame_indices, fit_resolution,
+                              split_segments, iter_video_frames, extract_frames_parallel)
+from .FrameWindow import LazyVideoFrames, preprocess_frame
+from .FeatureCache import hash_file
+from .Overlay import OverlayRenderer
+from .SparsePropagation import (DEFAULT_KEYFRAME_MODE, DEFAULT_KEYFRAME_STRIDE, DEFAULT_SPARSE_QUALITY, MOTION_BUDGET,
+                                KeyframeMemory, motion_thumbnail, frame_difference, signed_distance,
+                                interpolate_mask, tracking_order)
+from .Thumbnails import (SPRITE_FRAMES, SPRITE_COLUMNS, THUMBNAIL_QUALITY, thumbnail_width, thumbnail_size,
+                         resize_frame, write_jpeg, sprite_sheet)
+from .DatasetExport import DEFAULT_DATASET_FORMAT, export_dataset
+from .VideoExport import DEFAULT_VIDEO_CODEC, DEFAULT_VIDEO_QUALITY, video_extension, export_video
+from .Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Lifecycle of an inference state
+STATE_IDLE = "idle"        # no video uploaded yet
+STATE_LOADING = "loading"  # frames are being extracted or loaded into the inference state
+STATE_READY = "ready"      # prompts can be handled
+STATE_FAILED = "failed"    # loading failed, see state_error
+
+# Incremental propagation stops for an object once this many consecutive frames past its edits
+# have an IoU of at least CONVERGENCE_IOU with the masks already stored
+CONVERGENCE_IOU = 0.98
+CONVERGENCE_FRAMES = 3
+
+# Directions a propagation can run in from its start frame
+PROPAGATION_DIRECTIONS = ("forward", "reverse", "both")
+
+# SAM2VideoPredictor internals incremental and sparse propagation rely on, as of SAM2 1.1.0: private methods with the
+# keyword arguments passed to them, attributes, and inference state entries. SAM2 does not keep them stable,
+# so check_tracking_api() verifies them and propagations fall back to propagate_in_video when they differ.
+SAM2_TRACKING_METHODS = {
+    "_run_single_frame_inference": ("inference_state", "output_dict", "frame_idx", "batch_size", "is_init_cond_frame",
+                                    "point_inputs", "mask_inputs", "reverse", "run_mem_encoder"),
+    "_get_orig_video_res_output": ("inference_state", "any_res_masks"),
+    "_obj_id_to_idx": ("inference_state", "obj_id"),
+    "propagate_in_video_preflight": ("inference_state",),
+}
+SAM2_TRACKING_ATTRIBUTES = ("clear_non_cond_mem_around_input", "memory_temporal_stride_for_eval", "num_maskmem")
+SAM2_TRACKING_STATE_KEYS = ("output_dict_per_obj", "frames_tracked_per_obj", "obj_id_to_idx", "obj_ids")
+
+# Frames a streamed propagation queues with their masks for a slow consumer; the masks of further frames
+# are read back from the mask store once the consumer gets to them
+STREAM_BUFFER_FRAMES = 8
+
+# init_state calls are serialized, since preloaded frames are handed to SAM2 by temporarily
+# replacing its frame loader (see preloaded_video_frames)
+_INIT_STATE_LOCK = threading.Lock()
+
+# Written next to extracted frames once the extraction completed, so later uploads of the same video reuse them
+FRAME_MANIFEST = "frames.json"
+
+# Frame folders being extracted or decoded, so sessions opening the same video wait for each other and reuse
+# the result instead of working on the same folder concurrently
+_FRAME_FOLDER_LOCKS = {}
+_FRAME_FOLDER_LOCKS_GUARD = threading.Lock()
+
+# Frames decoded in memory, shared by the sessions annotating the same video with the same sampling. An entry
+# disappears once no session holds its frames anymore.
+_DECODED_VIDEOS = weakref.WeakValueDictionary()
+
+
+def mask_iou(mask_a, mask_b):
+    """
+    Intersection over union of two binary masks; two empty masks count as identical.
+    """
+    union = np.logical_or(mask_a, mask_b).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(mask_a, mask_b).sum()) / float(union)
+
+
+def check_tracking_api(predictor):
+    """
+    Check that a SAM2 video predictor has the internals incremental and sparse propagation call, see
+    SAM2_TRACKING_METHODS.
+
+    Returns:
+        list: One description per missing or changed method or attribute, empty if the predictor is compatible.
+    """
+    problems = []
+    for name, params in SAM2_TRACKING_METHODS.items():
+        method = getattr(predictor, name, None)
+        if not callable(method):
+            problems.append(f"{name}() is missing")
+            continue
+        try:
+            inspect.signature(method).bind(**{param: None for param in params})
+        except TypeError as e:
+            problems.append(f"{name}() changed: {e}")
+    problems.extend(f"attribute {name} is missing" for name in SAM2_TRACKING_ATTRIBUTES if not hasattr(predictor, name))
+    return problems
+
+
+def sampling_key(source_frame_indices, frame_size):
+    """
+    Short hash of the sampled source frames and their size.
+    """
+    return hashlib.sha256(repr((source_frame_indices, frame_size)).encode("utf-8")).hexdigest()[:16]
+
+
+def frame_folder_lock(frame_folder):
+    with _FRAME_FOLDER_LOCKS_GUARD:
+        return _FRAME_FOLDER_LOCKS.setdefault(os.path.abspath(frame_folder), threading.Lock())
+
+
+def video_signature(file):
+    """
+    Size and modification time of a video, to notice a file replaced under the same name.
+    """
+    stat = os.stat(file)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+# Decoded video
+class DecodedVideo:
+    def __init__(self, images, video_height, video_width, source_frame_indices):
+        """
+        Frames of a video decoded into the SAM2 frame tensor, with the source frames they come from.
+        """
+        self.images = images
+        self.video_height = video_height
+        self.video_width = video_width
+        self.source_frame_indices = source_frame_indices
+
+
+@contextmanager
+def preloaded_video_frames(images, video_height, video_width):
+    """
+    Make SAM2's init_state use an already decoded frame tensor instead of reading the JPEGs of a
+    frame folder. Must be used while holding _INIT_STATE_LOCK.
+
+    Args:
+        images (torch.Tensor or LazyVideoFrames): Normalized frames of shape (N, 3, image_size, image_size).
+        video_height (int): Height of the original video.
+        video_width (int): Width of the original video.
+    """
+    import sam2.sam2_video_predictor as sam2_video_predictor
+
+    original_loader = sam2_video_predictor.load_video_frames
+
+    def load_preloaded_frames(video_path, image_size, offload_video_to_cpu, *args, **kwargs):
+        # Lazily loaded frames (see FrameWindow) move themselves to the device
+        if offload_video_to_cpu or not torch.is_tensor(images):
+            return images, video_height, video_width
+        compute_device = kwargs.get("compute_device", images.device)
+        return images.to(compute_device), video_height, video_width
+
+    sam2_video_predictor.load_video_frames = load_preloaded_frames
+    try:
+        yield
+    finally:
+        sam2_video_predictor.load_video_frames = original_loader
 
 # Annotation module
 class AnnotationModule:
-    def __init__(self, model_cfg, checkpoint, device):
+    def __init__(self, model_cfg, checkpoint, device, predictor=None, feature_cache=None, inference_profile=None,
+                 history_max_bytes=DEFAULT_HISTORY_BYTES, history_log_path=None):
         """ 
         Initialize the annotation module with video processing and segmentation functionalities.
+        An already loaded predictor can be passed in so several modules share the same model weights,
+        and a FeatureCache installed on it so they also share the computed image features. The model
+        calls run in the autocast context of the optional InferenceProfile. Prompts can be undone and
+        redone per object (see PromptHistory), within history_max_bytes, and are written to the replay
+        log at history_log_path, if given, to rebuild them after a restart.
         """
         self.model_cfg = model_cfg
         self.checkpoint = checkpoint
         self.device = device
-        self.predictor = build_sam2_video_predictor(model_cfg, checkpoint, device=device)
+        if predictor is None:
+            from sam2.build_sam import build_sam2_video_predictor
+            predictor = build_sam2_video_predictor(model_cfg, checkpoint, device=device)
+        self.predictor = predictor
         self.frame_folder = None  # Folder where frames will be saved
         self.frame_names = None
         self.current_video_path = None
+        self.current_video_file = None  # Source video, used when frames are decoded in memory
+        self.video_hash = None  # Content hash of the source video, computed on first use
+        self.decoded_video = None  # DecodedVideo of the in-memory pipeline, possibly shared with other sessions
+        self.feature_cache = feature_cache
+        self.inference_context = inference_profile.autocast if inference_profile is not None else nullcontext
+        self.in_memory_frames = False  # Frames are decoded straight into the SAM2 tensor, JPEGs are made lazily
+        self.frames_decoded = 0
+        self.source_frame_count = None
+        self.source_frame_indices = []  # Source video frame index of every extracted frame
+        self.frame_size = None  # (width, height) of the extracted frames
+        self.sampling_key = None  # Identifies the sampled frames and their size, names the frame folder
+        self.source_fps = None
+        self.fps = None  # Frame rate of the extracted frames (source fps divided by the stride)
+        self.frame_window_size = None  # If set, frames are loaded lazily and at most this many stay resident
         self.inference_state = None
         self.prompts = {}
+        self.mask_store = MaskStore()  # Latest mask of every object on every frame, from prompts and propagation
+        self.dirty_frames = {}  # obj_id -> frames prompted since the object was last propagated
+        self.prompt_history = PromptHistory(history_max_bytes)
+        self.history_log_path = history_log_path
+        self.history_log_synced = False  # The replay log matches the prompts of the current state
+        self.replaying_history = False
+        self.propagation_cancel = threading.Event()  # Set to stop a running propagation loop
+        self.tracking_api_problems = None  # check_tracking_api() of the predictor, once a propagation needed it
+        self.state_lock = threading.RLock()  # Held while the inference state is in use
+        self.offloaded_state_path = None  # Set while the inference state is offloaded to disk
+        self.state_status = STATE_IDLE
+        self.state_error = None
+        self.state_generation = 0  # Incremented for every new video, so stale loads can be discarded
+        self.state_load_seconds = None
+        self.state_loading_started = None
+        self.state_condition = threading.Condition()  # Notified whenever state_status changes
         # Define custom color list (RGB format, 0-255 range) as a class property
         self.custom_colors = {
             1: [0, 0, 255],     # blue (solid organ)
@@ -58,6 +238,19 @@ class AnnotationModule:
             8: [128, 128, 0],   # olive green (LN)
             9: [128, 128, 128]  # grey (other)
         }
+        # Class names of the object IDs, used by the dataset export
+        self.class_names = {
+            1: "solid organ",
+            2: "artery",
+            3: "vein",
+            4: "nerve",
+            5: "bone",
+            6: "muscle",
+            7: "instrument",
+            8: "LN",
+            9: "other"
+        }
+        self.overlay_renderer = OverlayRenderer(self.custom_colors)
 
     def build_sam2_video_predictor(self, model_cfg, checkpoint, device):
         """ 
@@ -66,86 +259,716 @@ class AnnotationModule:
         # Assuming this is a placeholder for the actual SAM2 video segmentation model
         return self.predictor(model_cfg, checkpoint, device)
 
-    def video_to_frames(self, file):
+    def video_to_frames(self, file, stride=1, target_fps=None, max_resolution=None, start_frame=0, end_frame=None, num_workers=None,
+                        video_hash=None, reuse_frames=True):
         """
         Processes the video, saves frames as images, stores the directory for future segmentation tasks,
-        and loads the frame names internally.
+        and loads the frame names internally. The video is split in segments that are decoded and
+        encoded in parallel, and only the sampled frames are written. Frames extracted earlier from the
+        same file with the same sampling are reused.
         
         Args:
             file (str): The path to the video file (e.g., .mp4).
+            stride (int): Keep every stride-th frame.
+            target_fps (float): Optional. Derive the stride from the wanted frame rate instead.
+            max_resolution (int): Optional. Downscale frames so their longest side is at most this.
+            start_frame (int): First source frame to extract.
+            end_frame (int): Optional. Source frame to stop at (exclusive).
+            num_workers (int): Optional. Number of parallel extraction workers.
+            video_hash (str): Optional. Content hash of the video, if already known.
+            reuse_frames (bool): Reuse frames extracted earlier instead of extracting them again.
         
         Returns:
             frame_folder (str): The folder where the frames are saved.
         """
+        if not self.set_frame_sampling(file, stride, target_fps, max_resolution, start_frame, end_frame, video_hash):
+            return None
+
+        with frame_folder_lock(self.frame_folder):
+            manifest_path = os.path.join(self.frame_folder, FRAME_MANIFEST)
+            manifest = self.read_frame_manifest(manifest_path) if reuse_frames else None
+            if manifest is not None:
+                frame_count = len(manifest['source_frame_indices'])
+                logger.info(f"Reusing {frame_count} frames extracted earlier to {self.frame_folder}")
+            else:
+                for p in os.listdir(self.frame_folder):
+                    if os.path.splitext(p)[-1].lower() in [".jpg", ".jpeg"] or p == FRAME_MANIFEST:
+                        os.remove(os.path.join(self.frame_folder, p))
+                    elif p in ("thumbnails", "sprites"):
+                        shutil.rmtree(os.path.join(self.frame_folder, p), ignore_errors=True)
+
+                frame_count = extract_frames_parallel(
+                    file, self.frame_folder, self.source_frame_indices,
+                    frame_size=self.frame_size, num_workers=num_workers
+                )
+                logger.info(f"Processed {frame_count} frames from the video")
+
+                with open(manifest_path, "w") as f:
+                    json.dump({'video': video_signature(file),
+                               'source_frame_indices': self.source_frame_indices[:frame_count]}, f)
+
+        self.in_memory_frames = False
+        self.source_frame_indices = self.source_frame_indices[:frame_count]
+        self.frame_names = [f"{i:05d}.jpg" for i in range(frame_count)]
+
+        # Only return the frame folder
+        return self.frame_folder
+
+    def read_frame_manifest(self, manifest_path):
+        """
+        Return the manifest of a complete extraction of the current video, or None if the frames have to be
+        extracted (again).
+        """
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if manifest.get('video') != video_signature(self.current_video_file):
+            return None
+        indices = manifest.get('source_frame_indices') or []
+        if indices != self.source_frame_indices[:len(indices)]:
+            return None
+        if not all(os.path.exists(os.path.join(self.frame_folder, f"{i:05d}.jpg")) for i in range(len(indices))):
+            return None
+        return manifest
+
+    def set_frame_sampling(self, file, stride=1, target_fps=None, max_resolution=None, start_frame=0, end_frame=None,
+                           video_hash=None):
+        """
+        Probe the video, decide which source frames are used and at which size, and prepare the frame
+        folder for them. Every sampling of a video gets its own frame folder next to the video.
+
+        Returns:
+            bool: False if the video could not be opened.
+        """
+        info = probe_video(file)
+        if info is None:
+            logger.error(f"Error: Could not open video file {file}")
+            return False
+
+        self.source_frame_indices, stride = sample_frame_indices(
+            info['frame_count'], info['fps'], stride=stride, target_fps=target_fps,
+            start_frame=start_frame, end_frame=end_frame
+        )
+        self.frame_size = fit_resolution(info['width'], info['height'], max_resolution)
+
         video_dir = os.path.dirname(file)
         video_name = os.path.splitext(os.path.basename(file))[0]
+        self.sampling_key = sampling_key(self.source_frame_indices, self.frame_size)
+        self.frame_folder = os.path.join(video_dir, f"{video_name}-{self.sampling_key}")
+        os.makedirs(self.frame_folder, exist_ok=True)
+
+        self.source_fps = info['fps']
+        self.fps = info['fps'] / stride
+        self.current_video_file = file
+        self.video_hash = video_hash
+        self.decoded_video = None
+        self.source_frame_count = info['frame_count']
+        return True
 
-        self.frame_folder = os.path.join(video_dir, video_name)
+    def mark_state_loading(self):
+        """
+        Mark the inference state as loading, e.g. as soon as a new video is uploaded, so prompt calls
+        wait for the new state instead of using the previous one.
 
-        if not os.path.exists(self.frame_folder):
-            os.makedirs(self.frame_folder)
+        Returns:
+            int: The generation of the state being loaded, to be passed to init_inference_state.
+        """
+        with self.state_condition:
+            self.state_generation += 1
+            self.state_status = STATE_LOADING
+            self.state_error = None
+            self.state_load_seconds = None
+            self.state_loading_started = time.time()
+            self.state_condition.notify_all()
+            return self.state_generation
 
-        cap = cv2.VideoCapture(file)
+    def mark_state_failed(self, generation, error):
+        """
+        Mark the load of the given generation as failed, unless a newer video replaced it meanwhile.
+        """
+        with self.state_condition:
+            if generation == self.state_generation:
+                self.state_status = STATE_FAILED
+                self.state_error = str(error)
+                self.state_condition.notify_all()
+
+    def wait_until_ready(self, timeout=None):
+        """
+        Block until the inference state has finished loading, or the timeout expires.
 
-        if not cap.isOpened():
-            print(f"Error: Could not open video file {file}")
+        Args:
+            timeout (float): Maximum number of seconds to wait, None to wait indefinitely.
+
+        Returns:
+            bool: True if the inference state is ready.
+        """
+        with self.state_condition:
+            self.state_condition.wait_for(lambda: self.state_status != STATE_LOADING, timeout=timeout)
+            return self.state_status == STATE_READY
+
+    def get_state_status(self):
+        """
+        Report the lifecycle status of the inference state and how many frames are loaded.
+        """
+        with self.state_condition:
+            status = {
+                'status': self.state_status,
+                'error': self.state_error,
+                'load_seconds': self.state_load_seconds,
+                'frames_total': len(self.frame_names) if self.frame_names else 0,
+                'frames_loaded': 0
+            }
+            inference_state = self.inference_state
+
+        if status['status'] == STATE_LOADING and self.in_memory_frames:
+            status['frames_loaded'] = min(self.frames_decoded, status['frames_total'])
+        elif status['status'] == STATE_READY and inference_state is not None:
+            images = inference_state["images"]
+            status['frames_total'] = len(images)
+            # Frames loaded in the background are None until the loader reaches them
+            loaded_images = getattr(images, "images", None)
+            if isinstance(images, LazyVideoFrames):
+                # Every frame can be decoded on demand, only a window of them is resident
+                status['frames_loaded'] = len(images)
+                status['frames_resident'] = len(images.resident_frames())
+            elif loaded_images is not None:
+                status['frames_loaded'] = sum(image is not None for image in loaded_images)
+            else:
+                status['frames_loaded'] = len(images)
+
+        if status['frames_total']:
+            status['percent_loaded'] = round(100.0 * status['frames_loaded'] / status['frames_total'], 1)
+        else:
+            status['percent_loaded'] = 0.0
+        return status
+
+    def prepare_in_memory_video(self, file, stride=1, target_fps=None, max_resolution=None, start_frame=0, end_frame=None,
+                                video_hash=None):
+        """
+        Prepare the zero-disk frame pipeline for a video: no frames are written up front, the frames are
+        decoded once into the tensor SAM2 needs when the inference state is initialized, and JPEGs are only
+        written for the frames the UI requests (see get_frame_path). The sampling options are the same as
+        for video_to_frames.
+
+        Args:
+            file (str): The path to the video file (e.g., .mp4).
+            video_hash (str): Optional. Content hash of the video, if already known. Sessions that open a video
+                with a known hash share its decoded frames.
+
+        Returns:
+            frame_folder (str): The folder where requested frames are cached as JPEGs.
+        """
+        if not self.set_frame_sampling(file, stride, target_fps, max_resolution, start_frame, end_frame, video_hash):
             return None
 
+        self.in_memory_frames = True
+        self.frames_decoded = 0
+        # Frame names are virtual until a frame is requested, they keep the usual naming scheme
+        self.frame_names = [f"{i:05d}.jpg" for i in range(len(self.source_frame_indices))]
+        logger.info(f"Prepared {len(self.frame_names)} frames for in-memory decoding")
+        return self.frame_folder
+
+    def decode_video_frames(self, file, num_workers=None):
+        """
+        Decode the sampled frames of the video once, straight into the normalized and resized frame tensor
+        SAM2 uses. Segments of the video are decoded in parallel, each worker seeking to its own segment.
+
+        Args:
+            file (str): The path to the video file.
+            num_workers (int): Optional. Number of parallel decoding workers.
+
+        Returns:
+            tuple: (images, video_height, video_width) where images has shape (N, 3, image_size, image_size).
+        """
+        image_size = self.predictor.image_size
+
+        source_indices = self.source_frame_indices
+        images = torch.empty((len(source_indices), 3, image_size, image_size), dtype=torch.float32)
+        self.frames_decoded = 0
+        progress_lock = threading.Lock()
+
+        def decode_segment(offset, chunk):
+            decoded = 0
+            for i, frame in iter_video_frames(file, chunk):
+                images[offset + i] = preprocess_frame(frame, image_size)
+                decoded += 1
+                with progress_lock:
+                    self.frames_decoded += 1
+            return decoded
+
+        segments = split_segments(source_indices, num_workers or DEFAULT_NUM_WORKERS)
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            decoded = list(executor.map(lambda segment: decode_segment(*segment), segments))
+
+        # The reported frame count is only an estimate, stop at the first segment that ran short
         frame_count = 0
-        success, frame = cap.read()
+        for (offset, chunk), count in zip(segments, decoded):
+            frame_count += count
+            if count < len(chunk):
+                break
 
-        while success:
-            frame_filename = os.path.join(self.frame_folder, f"{frame_count:05d}.jpg")
-            cv2.imwrite(frame_filename, frame)
-            success, frame = cap.read()
-            frame_count += 1
+        if frame_count == 0:
+            raise ValueError(f"No frames could be decoded from {file}")
 
-        cap.release()
-        print(f"Processed {frame_count} frames from the video")
+        self.source_frame_indices = source_indices[:frame_count]
+        self.frames_decoded = frame_count
+        logger.info(f"Decoded {frame_count} frames in memory")
 
-        # Load and sort the frame names internally for future use
-        self.frame_names = [
-            p for p in os.listdir(self.frame_folder)
-            if os.path.splitext(p)[-1].lower() in [".jpg", ".jpeg"]
-        ]
-        self.frame_names.sort(key=lambda p: int(os.path.splitext(p)[0]))
+        # Masks are produced at the (possibly capped) frame size
+        video_width, video_height = self.frame_size
+        return images[:frame_count], video_height, video_width
 
-        # Only return the frame folder
-        return self.frame_folder
+    def feature_cache_key(self):
+        """
+        Identify the frames of the current video for the feature cache: the content hash of the video plus
+        the way frames are turned into model inputs, since each frame loader resizes slightly differently.
+        """
+        if self.video_hash is None:
+            self.video_hash = hash_file(self.current_video_file)
+
+        if self.in_memory_frames:
+            # Decoded from the video at its native resolution
+            pipeline = "video"
+        else:
+            width, height = self.frame_size
+            # Read back from the extracted JPEGs, by SAM2's own loader or by the lazy frame window
+            pipeline = f"{'jpegcv' if self.frame_window_size else 'jpeg'}{width}x{height}"
+        return f"{self.video_hash}-{pipeline}"
+
+    def build_inference_state(self, frame_folder, async_loading_frames=False):
+        """
+        Create a fresh SAM2 inference state for the current video, from the in-memory decoded frames,
+        a lazily loaded frame window (when frame_window_size is set) or the frame folder.
+        With a feature cache, the state is tagged so the image features of its frames are looked up
+        in the cache (including the first frame, which init_state already runs through the backbone).
+        """
+        if self.feature_cache is None or self.current_video_file is None:
+            return self._build_inference_state(frame_folder, async_loading_frames)
+
+        video_key = self.feature_cache_key()
+        self.feature_cache.bind_pending((video_key, list(self.source_frame_indices)))
+        try:
+            inference_state = self._build_inference_state(frame_folder, async_loading_frames)
+        finally:
+            self.feature_cache.bind_pending(None)
+
+        # Decoding may have dropped frames past the real end of the video
+        inference_state["feature_cache_keys"] = (video_key, list(self.source_frame_indices))
+        return inference_state
+
+    def _build_inference_state(self, frame_folder, async_loading_frames=False):
+        if self.frame_window_size:
+            return self.build_windowed_inference_state(frame_folder)
+
+        if self.in_memory_frames:
+            decoded = self.get_decoded_video()
+            # The actual number of frames can differ from the container's estimate
+            self.frame_names = [f"{i:05d}.jpg" for i in range(len(decoded.images))]
+            with _INIT_STATE_LOCK, preloaded_video_frames(decoded.images, decoded.video_height, decoded.video_width):
+                inference_state = self.predictor.init_state(video_path=self.current_video_file)
+            # Share the frames as the state holds them, i.e. already on the compute device
+            decoded.images = inference_state["images"]
+            self.decoded_video = decoded
+            return inference_state
+
+        with _INIT_STATE_LOCK:
+            return self.predictor.init_state(video_path=frame_folder, async_loading_frames=async_loading_frames)
+
+    def get_decoded_video(self):
+        """
+        Return the decoded frames of the current video, reusing those of another session that opened the
+        same video (same content hash) with the same sampling, if it still holds them.
+        """
+        if self.video_hash is None:
+            return DecodedVideo(*self.decode_video_frames(self.current_video_file), self.source_frame_indices)
+
+        key = (self.video_hash, self.frame_folder)
+        with frame_folder_lock(self.frame_folder):
+            decoded = _DECODED_VIDEOS.get(key)
+            if decoded is not None:
+                logger.info(f"Reusing {len(decoded.images)} frames decoded by another session")
+                self.source_frame_indices = list(decoded.source_frame_indices)
+                self.frames_decoded = len(decoded.images)
+                return decoded
+
+            decoded = DecodedVideo(*self.decode_video_frames(self.current_video_file), self.source_frame_indices)
+            _DECODED_VIDEOS[key] = decoded
+            return decoded
+
+    def build_windowed_inference_state(self, frame_folder):
+        """
+        Create an inference state whose frames are decoded on demand. Only the frame_window_size most
+        recently used frames and the prompted frames stay in memory, and the cached image features of a
+        frame are dropped together with it, so memory stays roughly constant in the video length.
+        """
+        if self.in_memory_frames:
+            frames = LazyVideoFrames(self.predictor.image_size, self.predictor.device, self.frame_window_size,
+                                     video_file=self.current_video_file, source_frame_indices=self.source_frame_indices)
+        else:
+            frames = LazyVideoFrames(self.predictor.image_size, self.predictor.device, self.frame_window_size,
+                                     frame_folder=frame_folder, frame_names=self.frame_names)
+
+        video_width, video_height = self.frame_size
+        with _INIT_STATE_LOCK, preloaded_video_frames(frames, video_height, video_width):
+            inference_state = self.predictor.init_state(video_path=frame_folder)
+
+        # SAM2 replaces the cached_features dict, so look it up at eviction time
+        frames.on_evict = lambda frame_idx: inference_state["cached_features"].pop(frame_idx, None)
+        return inference_state
+
+    def pin_frame(self, inference_state, frame_idx):
+        """
+        Keep a prompted frame resident in a lazily loaded frame window.
+        """
+        images = inference_state["images"]
+        if isinstance(images, LazyVideoFrames):
+            images.pin(frame_idx)
+
+    def get_frame_path(self, filename):
+        """
+        Return the path of a frame JPEG. In the in-memory pipeline, the JPEG is written the first time
+        the frame is requested, by seeking to it in the source video.
+
+        Args:
+            filename (str): Frame file name, e.g. '00042.jpg'.
+
+        Returns:
+            str: Path to the JPEG, or None if the frame does not exist.
+        """
+        frame_path = os.path.join(self.frame_folder, filename)
+        if os.path.exists(frame_path) or not self.in_memory_frames:
+            return frame_path if os.path.exists(frame_path) else None
+
+        try:
+            frame_idx = int(os.path.splitext(filename)[0])
+        except ValueError:
+            return None
+        if frame_idx < 0 or frame_idx >= len(self.frame_names):
+            return None
+
+        frame = next((frame for _, frame in iter_video_frames(
+            self.current_video_file, [self.source_frame_indices[frame_idx]], self.frame_size)), None)
+        if frame is None or not write_jpeg(frame_path, frame):
+            return None
+        return frame_path
+
+    def frames_version(self):
+        """
+        Identify the frame images of the current video for HTTP caching: the content hash of the video and
+        the requested sampling, which determine every frame, thumbnail and sprite sheet served for it.
+        """
+        if self.video_hash is None:
+            self.video_hash = hash_file(self.current_video_file)
+        return f"{self.video_hash[:16]}-{self.sampling_key}"
+
+    def iter_frames_at(self, frame_indices, frame_size=None):
+        """
+        Read the given frames (in increasing order) as BGR images, optionally resized. The in-memory pipeline
+        decodes them from the source video in one sequential pass, at the wanted size.
+
+        Yields:
+            tuple: (frame_idx, frame) where frame is None if it could not be read.
+        """
+        if self.in_memory_frames:
+            source_indices = [self.source_frame_indices[frame_idx] for frame_idx in frame_indices]
+            decoded = dict(iter_video_frames(self.current_video_file, source_indices, frame_size or self.frame_size))
+            for i, frame_idx in enumerate(frame_indices):
+                yield frame_idx, decoded.get(i)
+        else:
+            for frame_idx in frame_indices:
+                frame = cv2.imread(os.path.join(self.frame_folder, self.frame_names[frame_idx]))
+                yield frame_idx, resize_frame(frame, frame_size) if frame is not None and frame_size else frame
+
+    def get_thumbnail_path(self, filename, width):
+        """
+        Return the path of a frame thumbnail, made the first time it is requested and cached on disk next to
+        the frames.
+
+        Args:
+            filename (str): Frame file name, e.g. '00042.jpg'.
+            width (int): Wanted width, rounded up to one of THUMBNAIL_WIDTHS.
+
+        Returns:
+            str: Path to the JPEG, or None if the frame does not exist.
+        """
+        width = thumbnail_width(width)
+        thumbnail_path = os.path.join(self.frame_folder, "thumbnails", str(width), filename)
+        if os.path.exists(thumbnail_path):
+            return thumbnail_path
+
+        try:
+            frame_idx = int(os.path.splitext(filename)[0])
+        except ValueError:
+            return None
+        if frame_idx < 0 or frame_idx >= len(self.frame_names or []):
+            return None
 
-    def init_inference_state(self, frame_folder):
+        _, frame = next(self.iter_frames_at([frame_idx], thumbnail_size(self.frame_size, width)))
+        if frame is None or not write_jpeg(thumbnail_path, frame, THUMBNAIL_QUALITY):
+            return None
+        return thumbnail_path
+
+    def sprite_layout(self, width, stride=1):
+        """
+        Describe the sprite sheets of the timeline: every stride-th frame as a thumbnail of the given width,
+        SPRITE_FRAMES per sheet in rows of SPRITE_COLUMNS.
+        """
+        if stride < 1:
+            raise ValueError("stride must be at least 1")
+        width = thumbnail_width(width)
+        tile_width, tile_height = thumbnail_size(self.frame_size, width)
+        frame_count = -(-len(self.frame_names or []) // stride)
+        return {
+            'width': width,
+            'stride': stride,
+            'tile_width': tile_width,
+            'tile_height': tile_height,
+            'columns': SPRITE_COLUMNS,
+            'frames_per_sheet': SPRITE_FRAMES,
+            'frame_count': frame_count,
+            'sheet_count': -(-frame_count // SPRITE_FRAMES)
+        }
+
+    def get_sprite_sheet_path(self, sheet_idx, width, stride=1):
+        """
+        Return the path of a sprite sheet of the timeline (see sprite_layout), made the first time it is
+        requested and cached on disk next to the frames. Tile i of sheet s shows frame
+        (s * SPRITE_FRAMES + i) * stride.
+
+        Returns:
+            str: Path to the JPEG, or None if there is no such sheet.
+        """
+        layout = self.sprite_layout(width, stride)
+        if sheet_idx < 0 or sheet_idx >= layout['sheet_count']:
+            return None
+
+        sheet_path = os.path.join(self.frame_folder, "sprites", f"w{layout['width']}-s{stride}-{sheet_idx:04d}.jpg")
+        if os.path.exists(sheet_path):
+            return sheet_path
+
+        first = sheet_idx * SPRITE_FRAMES * stride
+        frame_indices = list(range(first, min(first + SPRITE_FRAMES * stride, len(self.frame_names)), stride))
+        tile_size = (layout['tile_width'], layout['tile_height'])
+        tiles = [frame for _, frame in self.iter_frames_at(frame_indices, tile_size)]
+        if not write_jpeg(sheet_path, sprite_sheet(tiles, tile_size, SPRITE_COLUMNS), THUMBNAIL_QUALITY):
+            return None
+        return sheet_path
+
+    def read_frame(self, frame_idx):
+        """
+        Read a frame as a BGR image, from the frame folder or (in-memory pipeline) the source video.
+        """
+        frame_path = self.get_frame_path(self.frame_names[frame_idx])
+        frame = cv2.imread(frame_path) if frame_path else None
+        if frame is None:
+            raise ValueError(f"Frame {frame_idx} not found")
+        return frame
+
+    def iter_frames(self):
+        """
+        Iterate over all frames of the video in order, as BGR images. The in-memory pipeline decodes the
+        source video sequentially rather than writing or seeking individual frames.
+
+        Yields:
+            tuple: (frame_idx, frame) where frame is None if it could not be read.
+        """
+        if self.in_memory_frames:
+            frame_idx = -1
+            for frame_idx, frame in iter_video_frames(self.current_video_file, self.source_frame_indices, self.frame_size):
+                yield frame_idx, frame
+            # Frames the decoder could not reach
+            for frame_idx in range(frame_idx + 1, len(self.frame_names)):
+                yield frame_idx, None
+        else:
+            for frame_idx, frame_name in enumerate(self.frame_names):
+                yield frame_idx, cv2.imread(os.path.join(self.frame_folder, frame_name))
+
+    def init_inference_state(self, frame_folder, generation=None, async_loading_frames=True):
         """
         Initialize the inference state for segmentation with a new video frame folder.
+        The new state is built first and only swapped in once complete, and a load that was
+        overtaken by a newer upload is discarded instead of replacing the newer state.
         Parameters:
             - frame_folder (str): Path to the video frames folder.
+            - generation (int): Generation returned by mark_state_loading, if it was already called.
+            - async_loading_frames (bool): Let SAM2 load the remaining frames in the background once
+              the first one is ready.
         """
+        if generation is None:
+            generation = self.mark_state_loading()
+
         try:
-            print("Initializing the inference state...")
-            self.inference_state = self.predictor.init_state(video_path=frame_folder)
-            self.current_video_path = frame_folder
-            print("Inference state initialized successfully.")
-            return self.inference_state
+            logger.info("Initializing the inference state...")
+            with metrics.time('init_state'), self.inference_context():
+                inference_state = self.build_inference_state(frame_folder, async_loading_frames=async_loading_frames)
         except Exception as e:
-            print(f"Error initializing inference state: {e}")
+            logger.error(f"Error initializing inference state: {e}")
+            self.mark_state_failed(generation, e)
             raise  # Re-raise the exception after logging for debugging purposes
 
+        # Wait for any call still using the previous state before swapping it
+        with self.state_lock, self.state_condition:
+            if generation != self.state_generation:
+                logger.info("Discarding an inference state that was replaced by a newer upload.")
+                return None
+
+            self.inference_state = inference_state
+            self.current_video_path = frame_folder
+            self.load_mask_store()
+            self.dirty_frames = {}
+            self.prompt_history.clear()
+            # The log of an earlier run on this video is kept until it is replayed or a new prompt is made
+            self.history_log_synced = False
+            self.discard_offloaded_state()
+
+            self.state_status = STATE_READY
+            self.state_load_seconds = time.time() - self.state_loading_started
+            self.state_condition.notify_all()
+
+        logger.info(f"Inference state initialized successfully in {self.state_load_seconds:.2f}s.")
+        return inference_state
+
     def reset_inference_state(self):
         """
         Reset the current inference state.
         This function assumes that the state was initialized already and just resets it.
         """
         try:
-            if self.inference_state is not None:
-                print("Resetting the inference state...")
-                self.predictor.reset_state(self.inference_state)
-                print("Inference state reset successfully.")
-                #return self.inference_state
-            else:
-                raise ValueError("Inference state has not been initialized.")
+            with self.state_lock:
+                if self.inference_state is not None:
+                    logger.info("Resetting the inference state...")
+                    self.predictor.reset_state(self.inference_state)
+                    self.mask_store.clear(self.mask_store.video_key)
+                    self.save_mask_store()
+                    self.dirty_frames = {}
+                    self.prompt_history.clear()
+                    self.start_history_log()
+                    logger.info("Inference state reset successfully.")
+                    #return self.inference_state
+                else:
+                    raise ValueError("Inference state has not been initialized.")
         except Exception as e:
-            print(f"Error resetting inference state: {e}")
+            logger.error(f"Error resetting inference state: {e}")
             raise  # Re-raise the exception after logging for debugging purposes
 
+    def is_offloaded(self):
+        """
+        Whether the inference state currently lives on disk rather than in memory.
+        """
+        return self.offloaded_state_path is not None
+
+    def offload_inference_state(self, offload_path, blocking=True):
+        """
+        Write the inference state to disk and free it from memory. The video frames and the cached
+        image features are not written, they are rebuilt from the frame folder on restore.
+
+        Args:
+            offload_path (str): File the state is written to.
+            blocking (bool): If False, give up instead of waiting when the state is in use.
+
+        Returns:
+            bool: True if the state was offloaded.
+        """
+        if not self.state_lock.acquire(blocking=blocking):
+            return False
+        try:
+            if self.inference_state is None:
+                return False
+
+            logger.info(f"Offloading the inference state to {offload_path}...")
+            saved_state = {key: value for key, value in self.inference_state.items()
+                           if key not in ("images", "cached_features")}
+            # Saved together, so the snapshots keep sharing their tensors with the state
+            saved_state["prompt_history"] = self.prompt_history
+            torch.save(saved_state, offload_path)
+            self.offloaded_state_path = offload_path
+            self.inference_state = None
+            self.decoded_video = None
+            return True
+        finally:
+            self.state_lock.release()
+
+    def restore_inference_state(self):
+        """
+        Load an offloaded inference state back into memory.
+        """
+        with self.state_lock:
+            if self.offloaded_state_path is None:
+                return self.inference_state
+
+            logger.info(f"Restoring the inference state from {self.offloaded_state_path}...")
+            with self.inference_context():
+                inference_state = self.build_inference_state(self.current_video_path)
+            saved_state = torch.load(self.offloaded_state_path, map_location=inference_state["storage_device"], weights_only=False)
+            self.prompt_history = saved_state.pop("prompt_history", self.prompt_history)
+            inference_state.update(saved_state)
+            for inputs_per_obj in (inference_state["point_inputs_per_obj"], inference_state["mask_inputs_per_obj"]):
+                for frame_inputs in inputs_per_obj.values():
+                    for frame_idx in frame_inputs:
+                        self.pin_frame(inference_state, frame_idx)
+
+            self.inference_state = inference_state
+            self.discard_offloaded_state()
+            return self.inference_state
+
+    def discard_offloaded_state(self):
+        """
+        Delete the offloaded inference state file, if any.
+        """
+        if self.offloaded_state_path is not None:
+            if os.path.exists(self.offloaded_state_path):
+                os.remove(self.offloaded_state_path)
+            self.offloaded_state_path = None
+
+    def store_masks(self, frame_idx, out_obj_ids, out_mask_logits):
+        """
+        Record the thresholded masks of a SAM2 output in the mask store.
+        """
+        with metrics.time('mask_threshold'):
+            binary_masks = (out_mask_logits > 0.0).cpu().numpy()[:, 0]
+        with metrics.time('mask_store'):
+            self.mask_store.put_frame(frame_idx, out_obj_ids, binary_masks)
+
+    def mask_store_key(self):
+        """
+        Identify the frames the masks were made for: the video content, the sampled frames and their size.
+        """
+        if self.video_hash is None:
+            self.video_hash = hash_file(self.current_video_file)
+        return f"{self.video_hash}-{sampling_key(self.source_frame_indices, self.frame_size)}"
+
+    def mask_store_path(self):
+        return os.path.join(self.frame_folder, "masks.npz")
+
+    def load_mask_store(self):
+        """
+        Start the mask store of a newly loaded video, picking up the masks saved for the same video
+        and sampling by an earlier session, if any.
+        """
+        try:
+            video_key = self.mask_store_key()
+        except OSError as e:
+            logger.warning(f"Could not identify the video for the mask store: {e}")
+            video_key = None
+
+        self.mask_store.clear(video_key)
+        if video_key is not None and self.mask_store.load(self.mask_store_path(), video_key=video_key):
+            logger.info(f"Loaded {len(self.mask_store)} saved masks from {self.mask_store_path()}")
+
+    def save_mask_store(self):
+        """
+        Persist the mask store next to the frames, so the masks survive restarts.
+        """
+        if self.frame_folder is None or self.mask_store.video_key is None:
+            return
+        try:
+            self.mask_store.save(self.mask_store_path())
+        except OSError as e:
+            logger.warning(f"Could not save the mask store: {e}")
+
     def predict_mask(self, frame_idx, obj_id, points, labels):
         """
         Add click prompts for segmentation at a specific frame and object ID.
@@ -153,21 +976,30 @@ class AnnotationModule:
         points = np.array(points, dtype=np.float32)
         labels = np.array(labels, np.int32)
 
-        self.prompts[obj_id] = (points, labels)
+        with self.state_lock:
+            before = self.snapshot_object(obj_id)
+            self.prompts[obj_id] = (points, labels)
 
-        frame_idx, out_obj_ids, out_mask_logits = self.predictor.add_new_points_or_box(
-            inference_state=self.inference_state,
-            frame_idx=frame_idx,
-            obj_id=obj_id,
-            points=points,
-            labels=labels,
-        )
+            with metrics.time('prompt_points'), self.inference_context():
+                self.pin_frame(self.inference_state, frame_idx)
+                self.mark_dirty(obj_id, frame_idx)
+                frame_idx, out_obj_ids, out_mask_logits = self.predictor.add_new_points_or_box(
+                    inference_state=self.inference_state,
+                    frame_idx=frame_idx,
+                    obj_id=obj_id,
+                    points=points,
+                    labels=labels,
+                )
 
-        if out_obj_ids is None or out_mask_logits is None:
-            raise ValueError(f"add_new_points_or_box returned None for frame_idx={frame_idx}, obj_id={obj_id}")
+            if out_obj_ids is None or out_mask_logits is None:
+                raise ValueError(f"add_new_points_or_box returned None for frame_idx={frame_idx}, obj_id={obj_id}")
+            self.store_masks(frame_idx, out_obj_ids, out_mask_logits)
+            self.record_prompt(obj_id, 'points', frame_idx, before)
+            self.append_history_log({'op': 'points', 'obj_id': obj_id, 'frame_idx': frame_idx,
+                                     'points': points.tolist(), 'labels': labels.tolist()})
         return frame_idx, out_obj_ids, out_mask_logits
 
-    def display_frame_with_mask(self, frame_idx, out_obj_ids, out_mask_logits, save_path=None):
+    def display_frame_with_mask(self, frame_idx, out_obj_ids, out_mask_logits, save_path=None, contours=False):
         """
         Display a specified frame with the segmentation results, overlay the mask using OpenCV, 
         and return the result as a JPEG for display in the React app.
@@ -177,37 +1009,18 @@ class AnnotationModule:
             out_obj_ids (list): List of object IDs predicted by SAM.
             out_mask_logits (list): List of mask logits from SAM.
             save_path (str): Optional. If provided, the frame will be saved at this path instead of returned.
+            contours (bool): Optional. Also outline every object.
             
         Returns:
             str: Path to the saved image or None if no save_path is provided.
         """
     
         # Load the current frame
-        frame_path = os.path.join(self.frame_folder, self.frame_names[frame_idx])
-        frame = cv2.imread(frame_path)
-    
-        if frame is None:
-            raise ValueError(f"Frame not found at path: {frame_path}")
+        frame = self.read_frame(frame_idx)
     
-        # Iterate over each object ID and display the masks
-        for i, out_obj_id in enumerate(out_obj_ids):
-            # Get mask, threshold it, and convert it to a 3-channel image
-            mask = (out_mask_logits[i] > 0.0).cpu().numpy().astype(np.uint8) * 255
-            h, w = mask.shape[-2:]
-            mask = mask.reshape(h, w, 1)
-    
-            # Get the color for the current object ID
-            color = np.array(self.custom_colors.get(out_obj_id, [128, 128, 128]))  # Default to grey if obj_id not in list
-            color = color.reshape(1, 1, 3)  # Reshape for broadcasting
-    
-            # Create the mask image with the color applied (3-channel RGB mask)
-            mask_image = mask * color
-
-            # Ensure that mask_image stays within the range and type of uint8
-            mask_image = np.clip(mask_image, 0, 255).astype(np.uint8)
-    
-            # Overlay the mask on the frame with some transparency
-            frame = cv2.addWeighted(frame, 0.7, mask_image, 0.3, 0)
+        # Threshold the logits and overlay the masks of all objects in one pass
+        masks = [(out_obj_id, (out_mask_logits[i] > 0.0).cpu().numpy()) for i, out_obj_id in enumerate(out_obj_ids)]
+        frame = self.overlay_renderer.render(frame, masks, contours=contours)
     
         # Save or return the frame with overlaid mask
         if save_path:
@@ -240,38 +1053,770 @@ class AnnotationModule:
         mask = np.array(mask, dtype=np.uint8)
 
         # Add the mask to the SAM2 model for the given object and frame
-        frame_idx, out_obj_ids, out_mask_logits = self.predictor.add_new_mask(
-            inference_state=self.inference_state,
-            frame_idx=frame_idx,
-            obj_id=obj_id,
-            mask=mask
-        )
+        with self.state_lock:
+            before = self.snapshot_object(obj_id)
+            with metrics.time('prompt_mask'), self.inference_context():
+                self.pin_frame(self.inference_state, frame_idx)
+                self.mark_dirty(obj_id, frame_idx)
+                frame_idx, out_obj_ids, out_mask_logits = self.predictor.add_new_mask(
+                    inference_state=self.inference_state,
+                    frame_idx=frame_idx,
+                    obj_id=obj_id,
+                    mask=mask
+                )
 
-        if out_obj_ids is None or out_mask_logits is None:
-            raise ValueError(f"add_new_mask returned None for frame_idx={frame_idx}, obj_id={obj_id}")
+            if out_obj_ids is None or out_mask_logits is None:
+                raise ValueError(f"add_new_mask returned None for frame_idx={frame_idx}, obj_id={obj_id}")
+            self.store_masks(frame_idx, out_obj_ids, out_mask_logits)
+            self.record_prompt(obj_id, 'mask', frame_idx, before)
+            self.append_history_log({'op': 'mask', 'obj_id': obj_id, 'frame_idx': frame_idx, 'mask': rle_encode(mask)})
 
         # Return the frame index, object IDs, and the logits for the generated mask
         return frame_idx, out_obj_ids, out_mask_logits
 
+    def predict_masks_batch(self, prompts):
+        """
+        Add the prompts of several objects, possibly on several frames, in one call. Prompts are grouped
+        by frame, so the image features of each frame are computed once and shared by all its objects,
+        and the state lock is taken once for the whole batch. Each prompt gives the same masks as the
+        corresponding predict_mask or predict_mask_from_mask call.
+
+        Args:
+            prompts (list): Dicts with 'frame_idx', 'obj_id' and either 'points' and 'labels', or 'mask'.
+
+        Returns:
+            list: (frame_idx, out_obj_ids, out_mask_logits) per prompted frame, in order of first appearance,
+                holding the masks of every object on that frame after all its prompts were added.
+
+        The prompts of an object on one frame make a single entry of its prompt history.
+        """
+        prompts_by_frame = {}
+        for prompt in prompts:
+            prompts_by_frame.setdefault(prompt['frame_idx'], []).append(prompt)
+
+        results = []
+        with self.state_lock, metrics.time('prompt_batch'), self.inference_context():
+            for frame_idx, frame_prompts in prompts_by_frame.items():
+                self.pin_frame(self.inference_state, frame_idx)
+                out_obj_ids, out_mask_logits = None, None
+                before = {}  # obj_id -> snapshot before its first prompt on this frame
+
+                for prompt in frame_prompts:
+                    obj_id = prompt['obj_id']
+                    if obj_id not in before:
+                        before[obj_id] = self.snapshot_object(obj_id)
+                    self.mark_dirty(obj_id, frame_idx)
+                    if prompt.get('mask') is not None:
+                        _, out_obj_ids, out_mask_logits = self.predictor.add_new_mask(
+                            inference_state=self.inference_state,
+                            frame_idx=frame_idx,
+                            obj_id=obj_id,
+                            mask=np.array(prompt['mask'], dtype=np.uint8)
+                        )
+                    else:
+                        points = np.array(prompt['points'], dtype=np.float32)
+                        labels = np.array(prompt['labels'], np.int32)
+                        self.prompts[obj_id] = (points, labels)
+                        _, out_obj_ids, out_mask_logits = self.predictor.add_new_points_or_box(
+                            inference_state=self.inference_state,
+                            frame_idx=frame_idx,
+                            obj_id=obj_id,
+                            points=points,
+                            labels=labels,
+                        )
+
+                if out_obj_ids is None or out_mask_logits is None:
+                    raise ValueError(f"Prediction returned None for frame_idx={frame_idx}")
+                self.store_masks(frame_idx, out_obj_ids, out_mask_logits)
+                for obj_id, snapshot in before.items():
+                    self.record_prompt(obj_id, 'batch', frame_idx, snapshot)
+                results.append((frame_idx, out_obj_ids, out_mask_logits))
+
+            self.append_history_log({'op': 'batch', 'prompts': [
+                {**prompt, 'mask': rle_encode(np.array(prompt['mask'], dtype=np.uint8))} if prompt.get('mask') is not None
+                else {**prompt, 'points': np.asarray(prompt['points']).tolist(), 'labels': np.asarray(prompt['labels']).tolist()}
+                for prompt in prompts]})
+
+        return results
+
+    def snapshot_object(self, obj_id):
+        """
+        Capture an object of the inference state for its prompt history.
+
+        Returns:
+            ObjectSnapshot: The snapshot, or None if the object has no prompts yet.
+        """
+        obj_idx = self.inference_state["obj_id_to_idx"].get(obj_id)
+        if obj_idx is None:
+            return None
+        # Keys missing from the state, e.g. with other SAM2 versions, are left out of the snapshot
+        object_state = {key: copy_structure(self.inference_state[key][obj_idx])
+                        for key in OBJECT_STATE_KEYS if obj_idx in self.inference_state.get(key, {})}
+        return ObjectSnapshot(object_state, self.mask_store.object_entries(obj_id),
+                              prompt=self.prompts.get(obj_id), dirty_frames=self.dirty_frames.get(obj_id))
+
+    def restore_object(self, obj_id, snapshot):
+        """
+        Put an object of the inference state back to a snapshot, or remove it if the snapshot is None.
+        Only the object's own entries are touched, the other objects keep their prompts and masks.
+        """
+        if snapshot is None:
+            self.predictor.remove_object(self.inference_state, obj_id, strict=False, need_output=False)
+            self.mask_store.remove(obj_id=obj_id)
+            self.prompts.pop(obj_id, None)
+            self.dirty_frames.pop(obj_id, None)
+            return
+
+        obj_idx = self.predictor._obj_id_to_idx(self.inference_state, obj_id)
+        for key, value in snapshot.object_state.items():
+            # Copied again, the state changes its dicts in place
+            self.inference_state[key][obj_idx] = copy_structure(value)
+        self.mask_store.replace_object(obj_id, snapshot.masks)
+        if snapshot.prompt is not None:
+            self.prompts[obj_id] = snapshot.prompt
+        else:
+            self.prompts.pop(obj_id, None)
+        if snapshot.dirty_frames:
+            self.dirty_frames[obj_id] = set(snapshot.dirty_frames)
+        else:
+            self.dirty_frames.pop(obj_id, None)
+
+    def record_prompt(self, obj_id, op, frame_idx, before):
+        """
+        Add a prompt just made to the object's history, given the snapshot taken before it. Must be called
+        with the state lock held.
+        """
+        self.prompt_history.record(obj_id, {'op': op, 'frame_idx': frame_idx}, before, self.snapshot_object(obj_id))
+        self.prompt_history.enforce_budget(self.inference_state)
+
+    def undo_prompt(self, obj_id):
+        """
+        Undo the last prompt of an object by restoring its snapshot from before that prompt, without running
+        the model. Undoing the first prompt of an object removes the object.
+
+        Returns:
+            dict: The undone history entry ('op', 'frame_idx', ...).
+        """
+        with self.state_lock:
+            description, snapshot = self.prompt_history.undo(obj_id)
+            self.restore_object(obj_id, snapshot)
+            self.append_history_log({'op': 'undo', 'obj_id': obj_id})
+        return description
+
+    def redo_prompt(self, obj_id):
+        """
+        Redo the last undone prompt of an object by restoring its snapshot from after that prompt.
+
+        Returns:
+            dict: The redone history entry.
+        """
+        with self.state_lock:
+            description, snapshot = self.prompt_history.redo(obj_id)
+            self.restore_object(obj_id, snapshot)
+            self.append_history_log({'op': 'redo', 'obj_id': obj_id})
+        return description
+
+    def start_history_log(self):
+        """
+        Start a new replay log for the current video, replacing the previous one.
+        """
+        if self.history_log_path is None:
+            return
+        try:
+            with open(self.history_log_path, "w") as f:
+                f.write(json.dumps({'op': 'video', 'video_key': self.mask_store.video_key}) + "\n")
+            self.history_log_synced = True
+        except OSError as e:
+            logger.warning(f"Could not write the prompt history log: {e}")
+
+    def append_history_log(self, event):
+        """
+        Append a prompt, undo or redo to the replay log. Must be called with the state lock held, so the
+        log keeps the order in which the state changed.
+        """
+        if self.history_log_path is None or self.replaying_history:
+            return
+        if not self.history_log_synced:
+            self.start_history_log()
+        try:
+            with open(self.history_log_path, "a") as f:
+                f.write(json.dumps(event) + "\n")
+        except OSError as e:
+            logger.warning(f"Could not write the prompt history log: {e}")
+
+    def read_history_log(self):
+        """
+        Return the events of the replay log of the current video.
+        """
+        if self.history_log_path is None or not os.path.exists(self.history_log_path):
+            raise ValueError("There is no prompt history to replay")
+        with open(self.history_log_path) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        if not events or events[0].get('op') != 'video' or events[0].get('video_key') != self.mask_store.video_key:
+            raise ValueError("The prompt history was recorded for another video")
+        return events[1:]
+
+    def replay_history(self):
+        """
+        Rebuild the prompts and the undo/redo history of the current video from the replay log, e.g. after
+        a restart. The prompts are run again on a reset state; propagations are not replayed, the masks
+        they stored are kept.
+
+        Returns:
+            int: Number of replayed events.
+        """
+        events = self.read_history_log()
+        with self.state_lock:
+            self.predictor.reset_state(self.inference_state)
+            self.prompts = {}
+            self.dirty_frames = {}
+            self.prompt_history.clear()
+
+            self.replaying_history = True
+            try:
+                for event in events:
+                    self.apply_history_event(event)
+            finally:
+                self.replaying_history = False
+            self.history_log_synced = True
+
+        logger.info(f"Replayed {len(events)} prompt history events")
+        return len(events)
+
+    def apply_history_event(self, event):
+        op = event.get('op')
+        if op == 'points':
+            self.predict_mask(event['frame_idx'], event['obj_id'], event['points'], event['labels'])
+        elif op == 'mask':
+            self.predict_mask_from_mask(event['frame_idx'], event['obj_id'], rle_decode(event['mask']))
+        elif op == 'batch':
+            self.predict_masks_batch([{**prompt, 'mask': rle_decode(prompt['mask'])} if prompt.get('mask') is not None
+                                      else prompt for prompt in event['prompts']])
+        elif op == 'undo':
+            self.undo_prompt(event['obj_id'])
+        elif op == 'redo':
+            self.redo_prompt(event['obj_id'])
+        else:
+            logger.warning(f"Skipping unknown prompt history event {op}")
+
+
+    def iter_propagation(self, inference_state, cancel_event=None, start_frame_idx=None, max_frames=None,
+                         direction="forward", sparse=False, quality=DEFAULT_SPARSE_QUALITY,
+                         keyframe_stride=DEFAULT_KEYFRAME_STRIDE, keyframe_mode=DEFAULT_KEYFRAME_MODE):
+        """
+        Propagate the segmentation through the video, yielding the thresholded masks of each frame
+        as soon as SAM2 produces them. Only the compressed copy in the mask store is kept, so memory
+        stays low regardless of the video length.
+
+        The loop stops early when cancel_propagation() is called, when the optional cancel_event is set,
+        or when the consumer closes the generator (e.g. a streaming client disconnects), which also
+        closes SAM2's propagation loop.
+
+        Args:
+            start_frame_idx (int): Optional. Frame to start from, defaults to the earliest prompted frame.
+            max_frames (int): Optional. Most frames to propagate in each direction, start frame included.
+            direction (str): One of PROPAGATION_DIRECTIONS. With "both" the forward pass runs first, then
+                the reverse pass covers the frames before the start frame.
+            sparse (bool): Optional. Only run the model on keyframes and interpolate the masks in between
+                (see iter_sparse_tracking), with the given quality, keyframe_stride and keyframe_mode.
+
+        Yields:
+            tuple: (out_frame_idx, out_obj_ids, binary_masks) where binary_masks is a boolean
+                array of shape (num_objects, H, W).
+        """
+        passes = self.propagation_passes(inference_state, start_frame_idx, max_frames, direction)
+        self.propagation_cancel.clear()
+        if sparse and not self.supports_tracking_api(inference_state):
+            logger.warning("Sparse propagation is not supported by this SAM2 version, propagating every frame")
+            sparse = False
+
+        self.state_lock.acquire()
+        propagation = None
+        try:
+            for pass_start_frame_idx, max_frame_num_to_track, reverse, frames in passes:
+                if sparse:
+                    tracking = self.iter_sparse_tracking(inference_state, pass_start_frame_idx, max_frame_num_to_track,
+                                                         reverse, quality=quality, keyframe_stride=keyframe_stride,
+                                                         keyframe_mode=keyframe_mode)
+                else:
+                    tracking = self.predictor.propagate_in_video(inference_state, start_frame_idx=pass_start_frame_idx,
+                                                                 max_frame_num_to_track=max_frame_num_to_track,
+                                                                 reverse=reverse)
+                propagation = self.run_in_inference_context(tracking)
+                frame_started = time.perf_counter()
+                for out_frame_idx, out_obj_ids, out_mask_logits in propagation:
+                    if self.propagation_cancel.is_set() or (cancel_event is not None and cancel_event.is_set()):
+                        logger.info(f"Propagation cancelled at frame {out_frame_idx}")
+                        return
+
+                    # Both passes produce the start frame, only yield it once
+                    if out_frame_idx not in frames:
+                        frame_started = time.perf_counter()
+                        continue
+                    metrics.observe('propagate_frame', time.perf_counter() - frame_started)
+
+                    if sparse:
+                        binary_masks = out_mask_logits  # Already thresholded, or interpolated
+                    else:
+                        with metrics.time('mask_threshold'):
+                            binary_masks = (out_mask_logits > 0.0).cpu().numpy()[:, 0]
+                    with metrics.time('mask_store'):
+                        self.mask_store.put_frame(out_frame_idx, out_obj_ids, binary_masks)
+                    yield out_frame_idx, list(out_obj_ids), binary_masks
+                    # The time the consumer spends on the frame is not part of the propagation
+                    frame_started = time.perf_counter()
+                propagation.close()
+
+            # A complete propagation brings every object up to date, a limited one only part of the video
+            if start_frame_idx is None and max_frames is None:
+                self.dirty_frames = {}
+        finally:
+            # Stop SAM2's generator as well, so no further frames are computed
+            if propagation is not None:
+                propagation.close()
+            self.state_lock.release()
+            self.save_mask_store()
+
+    def stream_propagation(self, inference_state, **options):
+        """
+        Run iter_propagation() on its own thread for a consumer that may be slow, such as a streaming HTTP
+        response. The propagation holds the state lock but never waits for the consumer, so a stalled client
+        does not keep the prompts, undo and exports of the session waiting until its socket times out.
+        Closing the generator stops the propagation after the current frame.
+
+        Args:
+            options: Keyword arguments of iter_propagation().
+
+        Yields:
+            tuple: (out_frame_idx, out_obj_ids, binary_masks), as iter_propagation().
+        """
+        frames = queue.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def produce():
+            propagation = self.iter_propagation(inference_state, **options)
+            try:
+                for out_frame_idx, out_obj_ids, binary_masks in propagation:
+                    if stop.is_set():
+                        break
+                    if frames.qsize() >= STREAM_BUFFER_FRAMES:
+                        binary_masks = None  # Read back from the mask store, memory stays bounded
+                    frames.put((out_frame_idx, out_obj_ids, binary_masks))
+                frames.put(done)
+            except Exception as e:
+                frames.put(e)
+            finally:
+                propagation.close()
+
+        threading.Thread(target=produce, name="annot-propagation", daemon=True).start()
+        try:
+            while True:
+                item = frames.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+
+                out_frame_idx, out_obj_ids, binary_masks = item
+                if binary_masks is None:
+                    masks = self.mask_store.get_frame(out_frame_idx, out_obj_ids)
+                    # Objects removed in the meantime are left out
+                    out_obj_ids = [obj_id for obj_id in out_obj_ids if obj_id in masks]
+                    if out_obj_ids:
+                        binary_masks = np.stack([masks[obj_id] for obj_id in out_obj_ids])
+                    else:
+                        binary_masks = np.zeros((0, inference_state["video_height"], inference_state["video_width"]),
+                                                dtype=bool)
+                yield out_frame_idx, out_obj_ids, binary_masks
+        finally:
+            stop.set()
+
+    def run_in_inference_context(self, generator):
+        """
+        Step a model generator inside the inference context, leaving it between steps so the consumer
+        of the frames does not run under autocast.
+        """
+        try:
+            while True:
+                with self.inference_context():
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                yield item
+        finally:
+            generator.close()
+
+    def cancel_propagation(self):
+        """
+        Ask a running propagation loop to stop after the current frame.
+        """
+        self.propagation_cancel.set()
+
+    def propagation_passes(self, inference_state, start_frame_idx=None, max_frames=None, direction="forward"):
+        """
+        Plan the SAM2 propagate_in_video calls of a propagation.
+
+        Args:
+            start_frame_idx (int): Optional. Frame to start from, defaults to the earliest frame that
+                has a click or mask input, like SAM2 does.
+            max_frames (int): Optional. Most frames to propagate in each direction, start frame included.
+            direction (str): One of PROPAGATION_DIRECTIONS.
+
+        Returns:
+            list: (start_frame_idx, max_frame_num_to_track, reverse, frames) per pass, where frames is the
+                range of frames the pass yields.
+        """
+        if direction not in PROPAGATION_DIRECTIONS:
+            raise ValueError(f"Unknown direction '{direction}', expected one of {list(PROPAGATION_DIRECTIONS)}")
+
+        num_frames = inference_state["num_frames"]
+        if start_frame_idx is None:
+            prompted_frames = [
+                frame_idx
+                for inputs_per_obj in (inference_state["point_inputs_per_obj"], inference_state["mask_inputs_per_obj"])
+                for frame_inputs in inputs_per_obj.values()
+                for frame_idx in frame_inputs
+            ]
+            start_frame_idx = min(prompted_frames) if prompted_frames else 0
+        elif not 0 <= start_frame_idx < num_frames:
+            raise ValueError(f"start_frame_idx must be between 0 and {num_frames - 1}")
+
+        if max_frames is None:
+            max_frames = num_frames
+        elif max_frames < 1:
+            raise ValueError("max_frames must be at least 1")
+
+        # SAM2 tracks max_frame_num_to_track frames past the start frame, i.e. one more than that in total
+        passes = []
+        if direction in ("forward", "both"):
+            passes.append((start_frame_idx, max_frames - 1, False,
+                           range(start_frame_idx, min(start_frame_idx + max_frames, num_frames))))
+        if direction == "reverse":
+            if start_frame_idx > 0:
+                passes.append((start_frame_idx, max_frames - 1, True,
+                               range(max(start_frame_idx - max_frames + 1, 0), start_frame_idx + 1)))
+            else:
+                # SAM2 skips reverse tracking from frame 0 altogether, so start one frame later and keep frame 0
+                passes.append((min(1, num_frames - 1), 1, True, range(0, 1)))
+        if direction == "both" and start_frame_idx > 0:
+            # The start frame comes from the forward pass, this one adds up to max_frames frames before it
+            passes.append((start_frame_idx, max_frames, True, range(max(start_frame_idx - max_frames, 0), start_frame_idx)))
+        return passes
+
+    def count_frames_to_propagate(self, inference_state, start_frame_idx=None, max_frames=None, direction="forward"):
+        """
+        Number of frames a propagation will produce. By default SAM2 starts from the earliest frame
+        that has a click or mask input and runs forward to the end of the video.
+        """
+        return sum(len(frames) for *_, frames in self.propagation_passes(inference_state, start_frame_idx, max_frames, direction))
+
+    def mark_dirty(self, obj_id, frame_idx):
+        """
+        Remember that the prompts of an object changed on a frame, so its masks around that frame
+        are out of date until the next propagation.
+        """
+        self.dirty_frames.setdefault(obj_id, set()).add(frame_idx)
+
+    @torch.inference_mode()
+    def iter_incremental_propagation(self, inference_state, cancel_event=None, convergence_iou=CONVERGENCE_IOU,
+                                     convergence_frames=CONVERGENCE_FRAMES):
+        """
+        Re-propagate only the objects prompted since their last propagation, forward and backward from the
+        edited frames, and stop each object once its new masks agree with the stored ones (IoU of at least
+        convergence_iou on convergence_frames consecutive frames past the edits). Objects that were never
+        propagated have no stored masks to agree with, so they run to both ends of the video. The new masks
+        are merged into the mask store.
+
+        This follows SAM2's propagate_in_video, restricted to the dirty objects and with an early stop.
+        SAM2 tracks every object separately, so the other objects' outputs are left as they are.
+
+        Yields:
+            tuple: (out_frame_idx, out_obj_ids, binary_masks) for the re-propagated objects only.
+        """
+        self.propagation_cancel.clear()
+
+        with self.state_lock:
+            dirty_frames = {obj_id: frames for obj_id, frames in self.dirty_frames.items()
+                            if obj_id in inference_state["obj_id_to_idx"]}
+            if not dirty_frames:
+                return
+
+            # Move the outputs of new prompts into the tracking memory, as propagate_in_video does
+            self.predictor.propagate_in_video_preflight(inference_state)
+            num_frames = inference_state["num_frames"]
+
+            for reverse in (False, True):
+                # Forward passes start at the first edit of each object and may only stop after its last one,
+                # backward passes the other way round. The forward pass already produced the frame a backward
+                # pass starts from, so it starts on the frame before, as in iter_propagation
+                tracks = {}
+                for obj_id, frames in dirty_frames.items():
+                    start, last_edit = (max(frames), min(frames)) if reverse else (min(frames), max(frames))
+                    tracks[obj_id] = {'start': start, 'last_edit': last_edit, 'stable': 0, 'done': False}
+
+                if reverse:
+                    processing_order = range(max(t['start'] for t in tracks.values()) - 1, -1, -1)
+                else:
+                    processing_order = range(min(t['start'] for t in tracks.values()), num_frames)
+
+                for frame_idx in processing_order:
+                    if self.propagation_cancel.is_set() or (cancel_event is not None and cancel_event.is_set()):
+                        logger.info(f"Incremental propagation cancelled at frame {frame_idx}")
+                        return
+
+                    active = [obj_id for obj_id, track in tracks.items() if not track['done']
+                              and (frame_idx < track['start'] if reverse else frame_idx >= track['start'])]
+                    if not active:
+                        if all(track['done'] for track in tracks.values()):
+                            break
+                        continue
+
+                    with metrics.time('propagate_frame'), self.inference_context():
+                        pred_masks = [self._track_object_on_frame(inference_state, obj_id, frame_idx, reverse)
+                                      for obj_id in active]
+                        _, video_res_masks = self.predictor._get_orig_video_res_output(inference_state, torch.cat(pred_masks, dim=0))
+                    with metrics.time('mask_threshold'):
+                        binary_masks = (video_res_masks > 0.0).cpu().numpy()[:, 0]
+
+                    for obj_id, mask in zip(active, binary_masks):
+                        track = tracks[obj_id]
+                        past_edits = frame_idx < track['last_edit'] if reverse else frame_idx > track['last_edit']
+                        previous = self.mask_store.get(obj_id, frame_idx)
+                        if past_edits and previous is not None and mask_iou(previous, mask) >= convergence_iou:
+                            track['stable'] += 1
+                            track['done'] = track['stable'] >= convergence_frames
+                        else:
+                            track['stable'] = 0
+                        self.mask_store.put(obj_id, frame_idx, mask)
+
+                    yield frame_idx, active, binary_masks
+
+            for obj_id in dirty_frames:
+                self.dirty_frames.pop(obj_id, None)
+            self.save_mask_store()
+
+    @torch.inference_mode()
+    def _track_object_on_frame(self, inference_state, obj_id, frame_idx, reverse, memory=None):
+        """
+        Run SAM2's tracking step for one object on one frame, reusing the output of prompted frames.
+        Mirrors the body of SAM2VideoPredictor.propagate_in_video. The memory attention reads the object's
+        outputs through memory if given (see KeyframeMemory).
+        """
+        obj_idx = self.predictor._obj_id_to_idx(inference_state, obj_id)
+        obj_output_dict = inference_state["output_dict_per_obj"][obj_idx]
+
+        if frame_idx in obj_output_dict["cond_frame_outputs"]:
+            current_out = obj_output_dict["cond_frame_outputs"][frame_idx]
+            pred_masks = current_out["pred_masks"].to(inference_state["device"], non_blocking=True)
+            if self.predictor.clear_non_cond_mem_around_input:
+                self._clear_non_cond_memory_around(obj_output_dict, frame_idx)
+        else:
+            current_out, pred_masks = self.predictor._run_single_frame_inference(
+                inference_state=inference_state,
+                output_dict=obj_output_dict if memory is None else memory,
+                frame_idx=frame_idx,
+                batch_size=1,
+                is_init_cond_frame=False,
+                point_inputs=None,
+                mask_inputs=None,
+                reverse=reverse,
+                run_mem_encoder=True,
+            )
+            obj_output_dict["non_cond_frame_outputs"][frame_idx] = current_out
+
+        inference_state["frames_tracked_per_obj"][obj_idx][frame_idx] = {"reverse": reverse}
+        return pred_masks
+
+    def _clear_non_cond_memory_around(self, obj_output_dict, frame_idx):
+        """
+        Drop an object's non-conditioning outputs within memory reach of a prompted frame, as SAM2's
+        _clear_non_cond_mem_around_input does for all objects at once.
+        """
+        reach = self.predictor.memory_temporal_stride_for_eval * self.predictor.num_maskmem
+        non_cond_frame_outputs = obj_output_dict["non_cond_frame_outputs"]
+        for t in range(frame_idx - reach, frame_idx + reach + 1):
+            non_cond_frame_outputs.pop(t, None)
 
-    def propagate_segmentation(self, inference_state):
+    def supports_tracking_api(self, inference_state):
+        """
+        Whether the predictor and the inference state have the SAM2 internals incremental and sparse propagation call
+        (see check_tracking_api). The predictor is only checked once.
         """
-        Propagate the segmentation through the entire video and collect results.
+        if self.tracking_api_problems is None:
+            self.tracking_api_problems = check_tracking_api(self.predictor)
+        return not self.tracking_api_problems and all(key in inference_state for key in SAM2_TRACKING_STATE_KEYS)
+
+    @torch.inference_mode()
+    def iter_sparse_tracking(self, inference_state, start_frame_idx, max_frame_num_to_track, reverse,
+                             quality=DEFAULT_SPARSE_QUALITY, keyframe_stride=DEFAULT_KEYFRAME_STRIDE,
+                             keyframe_mode=DEFAULT_KEYFRAME_MODE):
+        """
+        Sparse counterpart of SAM2's propagate_in_video: the model only tracks the objects on keyframes, and
+        the masks of the frames in between are interpolated from the two keyframes around them. Keyframes
+        are at most keyframe_stride frames apart, every prompted frame is one, and in motion mode a keyframe
+        also comes as soon as the frames changed by more than the motion budget. When the masks of two
+        consecutive keyframes overlap by less than quality (IoU, worst object), the later one is discarded
+        and the gap halved, until they agree or are adjacent; the gap grows back while masks change slowly.
+        The memory attention sees the previous keyframes as the previous frames (see KeyframeMemory).
+
+        Outputs the model no longer matches, on the interpolated frames, are dropped from the inference state.
+
+        Yields:
+            tuple: (frame_idx, obj_ids, binary_masks) in processing order, binary_masks being a boolean array
+                of shape (num_objects, H, W), as thresholded from propagate_in_video's outputs.
+        """
+        order = tracking_order(start_frame_idx, max_frame_num_to_track, inference_state["num_frames"], reverse)
+        if not order:
+            return
+
+        self.predictor.propagate_in_video_preflight(inference_state)
+        obj_ids = list(inference_state["obj_ids"])
+        obj_idxs = [self.predictor._obj_id_to_idx(inference_state, obj_id) for obj_id in obj_ids]
+        output_dicts = [inference_state["output_dict_per_obj"][obj_idx] for obj_idx in obj_idxs]
+        frames_tracked = [inference_state["frames_tracked_per_obj"][obj_idx] for obj_idx in obj_idxs]
+        prompted_frames = {frame_idx for output_dict in output_dicts for frame_idx in output_dict["cond_frame_outputs"]}
+        motion_budget = MOTION_BUDGET * (1.0 - quality) if keyframe_mode == "motion" else None
+        thumbnails = {}
+        keyframes = []
+
+        def thumbnail(frame_idx):
+            if frame_idx not in thumbnails:
+                thumbnails[frame_idx] = motion_thumbnail(inference_state["images"][frame_idx])
+            return thumbnails[frame_idx]
+
+        def track(frame_idx):
+            # Keep what the inference state held on this frame, in case the keyframe is discarded
+            previous = [(output_dict["non_cond_frame_outputs"].get(frame_idx), tracked.get(frame_idx))
+                        for output_dict, tracked in zip(output_dicts, frames_tracked)]
+            with metrics.time('sparse_keyframe'):
+                pred_masks = [self._track_object_on_frame(inference_state, obj_id, frame_idx, reverse,
+                                                          memory=KeyframeMemory(output_dict, frame_idx, keyframes, reverse))
+                              for obj_id, output_dict in zip(obj_ids, output_dicts)]
+                _, video_res_masks = self.predictor._get_orig_video_res_output(inference_state, torch.cat(pred_masks, dim=0))
+                binary_masks = (video_res_masks > 0.0).cpu().numpy()[:, 0]
+            return binary_masks, previous
+
+        def restore(frame_idx, previous):
+            for output_dict, tracked, (output, tracked_entry) in zip(output_dicts, frames_tracked, previous):
+                for entries, value in ((output_dict["non_cond_frame_outputs"], output), (tracked, tracked_entry)):
+                    if value is None:
+                        entries.pop(frame_idx, None)
+                    else:
+                        entries[frame_idx] = value
+
+        masks, _ = track(order[0])
+        keyframes.append(order[0])
+        yield order[0], obj_ids, masks
+
+        position, gap, refinements = 0, keyframe_stride, 0
+        distances = None
+        while position < len(order) - 1:
+            # Next keyframe: gap frames ahead, or earlier at a prompted frame or past the motion budget
+            candidate = min(position + gap, len(order) - 1)
+            motion = 0.0
+            for i in range(position + 1, candidate + 1):
+                if order[i] in prompted_frames:
+                    candidate = i
+                    break
+                if motion_budget is not None:
+                    motion += frame_difference(thumbnail(order[i - 1]), thumbnail(order[i]))
+                    if motion > motion_budget:
+                        candidate = max(i - 1, position + 1)
+                        break
+
+            candidate_masks, previous = track(order[candidate])
+            agreement = min((mask_iou(a, b) for a, b in zip(masks, candidate_masks)), default=1.0)
+            if agreement < quality and candidate - position > 1:
+                restore(order[candidate], previous)
+                gap = max(1, (candidate - position) // 2)
+                refinements += 1
+                continue
+
+            if candidate - position > 1:
+                with metrics.time('mask_interpolate'):
+                    if distances is None:
+                        distances = [signed_distance(mask) if mask.any() else None for mask in masks]
+                    candidate_distances = [signed_distance(mask) if mask.any() else None for mask in candidate_masks]
+                for i in range(position + 1, candidate):
+                    weight = (i - position) / (candidate - position)
+                    with metrics.time('mask_interpolate'):
+                        interpolated = np.stack([
+                            interpolate_mask(mask_a, mask_b, weight, distance_a, distance_b)
+                            for mask_a, mask_b, distance_a, distance_b
+                            in zip(masks, candidate_masks, distances, candidate_distances)])
+                    # The model did not run on this frame, drop outputs of earlier propagations
+                    restore(order[i], [(None, None)] * len(obj_ids))
+                    yield order[i], obj_ids, interpolated
+                distances = candidate_distances
+            else:
+                distances = None
+
+            yield order[candidate], obj_ids, candidate_masks
+            keyframes.append(order[candidate])
+            masks, position = candidate_masks, candidate
+            # Grow the gap back when it could take twice the change
+            if 1.0 - agreement <= (1.0 - quality) / 2:
+                gap = min(keyframe_stride, gap * 2)
+
+        logger.info(f"Sparse propagation ran the model on {len(keyframes)} of {len(order)} frames "
+                    f"({refinements} keyframes refined)")
+
+    def propagate_segmentation(self, inference_state, progress_callback=None, cancel_event=None, incremental=False,
+                               start_frame_idx=None, max_frames=None, direction="forward", sparse=False,
+                               quality=DEFAULT_SPARSE_QUALITY, keyframe_stride=DEFAULT_KEYFRAME_STRIDE,
+                               keyframe_mode=DEFAULT_KEYFRAME_MODE):
+        """
+        Propagate the segmentation through the video and collect results.
+
+        Args:
+            inference_state (dict): The SAM2 inference state to propagate.
+            progress_callback (callable): Optional. Called as progress_callback(frames_done, frames_total)
+                after each frame.
+            cancel_event (threading.Event): Optional. Stops the propagation early when set.
+            incremental (bool): Optional. Only re-propagate the objects prompted since the last propagation,
+                around the edited frames (see iter_incremental_propagation). The result then only holds
+                the frames that were recomputed.
+            start_frame_idx (int): Optional. Frame to start from, defaults to the earliest prompted frame.
+            max_frames (int): Optional. Most frames to propagate in each direction, start frame included.
+            direction (str): Optional. "forward", "reverse" or "both"; both directions are merged into
+                one result.
+            sparse (bool): Optional. Only run the model on keyframes and interpolate the other frames,
+                see iter_sparse_tracking for quality, keyframe_stride and keyframe_mode. Ignored when
+                incremental.
         """
         video_segments = {}
+        frames_done = set()  # Incremental passes can both yield the frames between the edits of an object
+        if incremental and not self.supports_tracking_api(inference_state):
+            logger.warning("Incremental propagation is not supported by this SAM2 version, propagating fully")
+            incremental = False
+        if incremental:
+            frames_total = inference_state["num_frames"]  # Upper bound, the passes usually stop much earlier
+            propagation = self.iter_incremental_propagation(inference_state, cancel_event=cancel_event)
+        else:
+            frames_total = self.count_frames_to_propagate(inference_state, start_frame_idx, max_frames, direction)
+            propagation = self.iter_propagation(inference_state, cancel_event=cancel_event,
+                                                start_frame_idx=start_frame_idx, max_frames=max_frames,
+                                                direction=direction, sparse=sparse, quality=quality,
+                                                keyframe_stride=keyframe_stride, keyframe_mode=keyframe_mode)
     
-        for out_frame_idx, out_obj_ids, out_mask_logits in self.predictor.propagate_in_video(inference_state):
+        for out_frame_idx, out_obj_ids, binary_masks in propagation:
             for i, out_obj_id in enumerate(out_obj_ids):
                 # Initialize a dictionary for the object ID if not already present
                 if out_obj_id not in video_segments:
                     video_segments[out_obj_id] = {}
                     
                 # Store the mask for the current frame under the corresponding object ID
-                video_segments[out_obj_id][out_frame_idx] = (out_mask_logits[i] > 0.0).cpu().numpy()
+                video_segments[out_obj_id][out_frame_idx] = binary_masks[i:i + 1]
+
+            frames_done.add(out_frame_idx)
+            if progress_callback is not None:
+                progress_callback(len(frames_done), frames_total)
         
         return video_segments
 
-    def display_propagated_masks(self, vis_frame_stride=30, extract_as_video="no", output_video_path="masked_output.mp4"):
+    def display_propagated_masks(self, vis_frame_stride=30, extract_as_video="no", output_video_path="masked_output.mp4", contours=False):
         """
         Display the propagated segmentation masks on frames at regular intervals and optionally save them as a video.
         
@@ -279,12 +1824,13 @@ class AnnotationModule:
             vis_frame_stride (int): How frequently to visualize frames. For example, every 30 frames.
             extract_as_video (str): If set to 'yes', save the masked frames as a video.
             output_video_path (str): Path where the output video will be saved (only used if extract_as_video is 'yes').
+            contours (bool): Optional. Also outline every object.
             
         Returns:
             List of byte buffers for each frame, if extract_as_video is not enabled.
         """
         if self.inference_state is None:
-            print("Inference state is not initialized. Cannot display or extract propagated masks.")
+            logger.info("Inference state is not initialized. Cannot display or extract propagated masks.")
             return
     
         # Run propagation through the video and collect the segmentation results
@@ -295,9 +1841,7 @@ class AnnotationModule:
         # Initialize video writer if extracting as video
         if extract_as_video == "yes":
             # Get the size of the original frames (expected frame size)
-            frame_sample = cv2.imread(os.path.join(self.frame_folder, self.frame_names[0]))
-            if frame_sample is None:
-                raise ValueError("Cannot load sample frame for size reference.")
+            frame_sample = self.read_frame(0)
             frame_height, frame_width, _ = frame_sample.shape
     
             # Initialize video writer
@@ -307,31 +1851,12 @@ class AnnotationModule:
         # Loop through the frames with the specified stride and process
         for out_frame_idx in range(0, len(self.frame_names), vis_frame_stride):
             # Load the frame
-            frame_path = os.path.join(self.frame_folder, self.frame_names[out_frame_idx])
-            frame = cv2.imread(frame_path)
+            frame = self.read_frame(out_frame_idx)
     
-            if frame is None:
-                raise ValueError(f"Frame not found at path: {frame_path}")
-    
-            # For each object ID in the frame, overlay the corresponding mask
-            if out_frame_idx in video_segments:
-                for out_obj_id, out_mask in video_segments[out_frame_idx].items():
-
-                    # Get the color for the current object ID
-                    color = np.array(self.custom_colors.get(out_obj_id, [128, 128, 128]))  # Default to grey if obj_id not in list
-                    color = color.reshape(1, 1, 3)  # Reshape for broadcasting
-    
-                    # Create the mask image with the color applied (3-channel RGB mask)
-                    mask = out_mask.astype(np.uint8) * 255
-                    h, w = mask.shape[-2:]
-                    mask = mask.reshape(h, w, 1)
-                    mask_image = mask * color
-    
-                    # Ensure that mask_image stays within the range and type of uint8
-                    mask_image = np.clip(mask_image, 0, 255).astype(np.uint8)
-    
-                    # Overlay the mask on the frame with some transparency
-                    frame = cv2.addWeighted(frame, 0.7, mask_image, 0.3, 0)
+            # Overlay the masks of every object present on this frame
+            masks = [(out_obj_id, frames[out_frame_idx]) for out_obj_id, frames in video_segments.items()
+                     if out_frame_idx in frames]
+            frame = self.overlay_renderer.render(frame, masks, contours=contours)
     
             # Save or display the masked frame
             if extract_as_video == "yes":
@@ -345,86 +1870,112 @@ class AnnotationModule:
         # Release the video writer if extracting as video
         if extract_as_video == "yes":
             video_writer.release()
-            print(f"Video saved at {output_video_path}")
+            logger.info(f"Video saved at {output_video_path}")
     
         # Return list of byte buffers if not saving video
         if extract_as_video != "yes":
             return frame_buffers
         
-    def create_annotated_video(self, masks_by_object_and_frame):
+    def create_annotated_video(self, masks_by_object_and_frame=None, output_video_path=None, progress_callback=None,
+                               cancel_event=None, contours=False, codec=DEFAULT_VIDEO_CODEC,
+                               quality=DEFAULT_VIDEO_QUALITY, fps=None, num_workers=None):
         """
-        Generate a video by overlaying masks on all frames and combining them.
-        
+        Generate a video by overlaying masks on all frames and combining them. Frames are read, overlaid
+        and written by a pipeline of threads (see VideoExport.export_video).
+
         Args:
-            masks_by_object_and_frame (dict): Contains mask data for each object and frame.
-        
+            masks_by_object_and_frame (dict): Contains mask data for each object and frame. Each mask is either
+                a nested list or an encoded mask (see MaskEncoding.decode_mask). Defaults to the masks in the
+                mask store.
+            output_video_path (str): Optional. Where to write the video, defaults to the frame folder.
+            progress_callback (callable): Optional. Called as progress_callback(frames_done, frames_total)
+                after each frame.
+            cancel_event (threading.Event): Optional. Stops the export and removes the partial video when set.
+            contours (bool): Optional. Also outline every object.
+            codec (str): Optional. One of VideoExport.VIDEO_CODECS.
+            quality (int): Optional. 0-100, for codecs that support it.
+            fps (float): Optional. Frame rate of the video, defaults to the rate of the extracted frames.
+            num_workers (int): Optional. Number of overlay workers.
+
         Returns:
             output_video_path (str): Path to the generated video file.
         """
         try:
-            frame_paths = [os.path.join(self.frame_folder, frame) for frame in sorted(os.listdir(self.frame_folder))]
-            print(f"Length of frames: {len(frame_paths)}")
-
-            if not frame_paths:
+            frame_count = len(self.frame_names) if self.frame_names else 0
+            if not frame_count:
                 raise ValueError("No frames found for creating video")
 
-            # Set up video writer
-            frame_sample = cv2.imread(frame_paths[0])
-            height, width, _ = frame_sample.shape
-            print(f"Height: {height}, Width: {width}")
-            output_video_path = os.path.join(self.frame_folder, "annotated_video.mp4")
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            video_writer = cv2.VideoWriter(output_video_path, fourcc, 30.0, (width, height))
+            if masks_by_object_and_frame is None:
+                # Read straight from the mask store, decompressing each frame's masks when it is rendered
+                masks_by_frame = self.mask_store.masks_by_frame()
+                decode = self.mask_store.decode
+            else:
+                # Index the masks by frame once; clients send frame indices as strings
+                masks_by_frame = {}
+                for obj_id, frames in masks_by_object_and_frame.items():
+                    for frame_idx, mask in frames.items():
+                        masks_by_frame.setdefault(int(frame_idx), []).append((int(obj_id), mask))
+                decode = decode_mask
 
-            # Loop through all frames and overlay masks
-            for frame_idx, frame_path in enumerate(frame_paths):
-                print(f"Processing frame {frame_idx + 1} / {len(frame_paths)}: {frame_path}")                
-                frame = cv2.imread(frame_path)
+            if not masks_by_frame:
+                raise ValueError("No masks to export, add prompts or propagate the segmentation first")
 
-                if frame is None:
-                    print(f"Error: Could not read frame at path: {frame_path}")
-                    continue
+            def render(frame_idx, frame):
+                masks = [(obj_id, decode(mask)) for obj_id, mask in masks_by_frame.get(frame_idx, [])]
+                return self.overlay_renderer.render(frame, masks, contours=contours)
 
-                # Debugging info: Check the frame dimensions
-                print(f"Frame dimensions: {frame.shape}")
+            if output_video_path is None:
+                output_video_path = os.path.join(self.frame_folder, "annotated_video" + video_extension(codec))
 
-                # Initialize a flag to check if any mask was applied to the frame
-                mask_applied = False
+            fps = fps or self.fps or 30.0
+            frames_written = export_video(self.iter_frames(), render, output_video_path, fps, codec=codec,
+                                          quality=quality, num_workers=num_workers, progress_callback=progress_callback,
+                                          cancel_event=cancel_event, frames_total=frame_count)
 
-                # Overlay the mask for each object if it exists
-                for obj_id, frames in masks_by_object_and_frame.items():
-                    # Convert obj_id to integer
-                    obj_id = int(obj_id)  # Ensure obj_id is an integer
-                    print(f"Checking for mask for object {obj_id} on frame {frame_idx}")
-                    print(f"Object ID: {obj_id}, Type: {type(obj_id)}")
-                    if str(frame_idx) in frames:
-                        print(f"Mask found for object {obj_id} on frame {frame_idx}")
-                        mask = np.array(frames[str(frame_idx)], dtype=np.uint8) * 255
-
-                        # Retrieve the color for the current object from customColors
-                        color = np.array(self.custom_colors.get(obj_id, [128, 128, 128]), dtype=np.uint8)
-                        print(f"Applying color {color} for object {obj_id}")
-                        color = color.reshape(1, 1, 3)  # Reshape for broadcasting
-
-                        # Create a 3-channel mask using the object-specific color
-                        mask_rgb = mask[:, :, np.newaxis] * color
-
-                        # Overlay the mask on the frame with some transparency
-                        frame = cv2.addWeighted(frame, 0.7, mask_rgb, 0.3, 0)
-                        mask_applied = True
+            if not frames_written:
+                raise ValueError("No frames could be read for creating video")
+            logger.info(f"Annotated video saved at {output_video_path}")
+            return output_video_path
 
-                    else:
-                        print(f"No mask found for object {obj_id} on frame {frame_idx}")
+        except Exception as e:
+            logger.error(f"Error creating annotated video: {str(e)}")
+            raise
 
-                if not mask_applied:
-                    print(f"No mask applied on frame {frame_idx}")
+    def create_dataset_export(self, output_path=None, dataset_format=DEFAULT_DATASET_FORMAT, include_images=False,
+                              progress_callback=None, cancel_event=None, num_workers=None):
+        """
+        Export the masks in the mask store, for all objects and frames, as a training dataset in a zip
+        archive (see DatasetExport.export_dataset). Object IDs are the classes, named after class_names.
 
-                video_writer.write(frame)
+        Args:
+            output_path (str): Optional. Where to write the archive, defaults to the frame folder.
+            dataset_format (str): Optional. One of DatasetExport.DATASET_FORMATS.
+            include_images (bool): Optional. Also add the frames as images/<frame name>.
+            progress_callback (callable): Optional. Called as progress_callback(frames_done, frames_total).
+            cancel_event (threading.Event): Optional. Stops the export and removes the partial archive when set.
+            num_workers (int): Optional. Number of encoding threads.
 
-            video_writer.release()
-            print(f"Annotated video saved at {output_video_path}")
-            return output_video_path
+        Returns:
+            output_path (str): Path to the archive.
+        """
+        try:
+            if not self.frame_names:
+                raise ValueError("No frames found for the dataset export")
+
+            masks_by_frame = self.mask_store.masks_by_frame()
+            if not masks_by_frame:
+                raise ValueError("No masks to export, add prompts or propagate the segmentation first")
+
+            if output_path is None:
+                output_path = os.path.join(self.frame_folder, f"dataset_{dataset_format}.zip")
+
+            export_dataset(output_path, dataset_format, masks_by_frame, self.frame_names, self.frame_size,
+                           self.class_names, self.custom_colors, frames=self.iter_frames() if include_images else None,
+                           num_workers=num_workers, progress_callback=progress_callback, cancel_event=cancel_event,
+                           fps=self.fps)
+            logger.info(f"Dataset saved at {output_path}")
+            return output_path
 
         except Exception as e:
-            print(f"Error creating annotated video: {str(e)}")
-            raise
\ No newline at end of file
+            logger.error(f"Error exporting dataset: {str(e)}")
+            raise
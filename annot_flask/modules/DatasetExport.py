@@ -0,0 +1,261 @@
+import os
+import io
+import json
+import time
+import logging
+import tempfile
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from .MaskEncoding import rle_encode
+from .MaskStore import MaskStore
+from .Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Dataset formats the masks can be exported in:
+#   coco_rle     - COCO annotations.json, segmentations as uncompressed RLE
+#   coco_polygon - COCO annotations.json, segmentations as polygons
+#   yolo_seg     - YOLO segmentation labels, one text file per frame, plus data.yaml
+#   png          - Indexed PNG label maps, pixel value = object ID, palette = the object colors
+DATASET_FORMATS = ("coco_rle", "coco_polygon", "yolo_seg", "png")
+DEFAULT_DATASET_FORMAT = "coco_rle"
+
+# Contours and encodings run on threads, a few frames per task: OpenCV, zlib and PIL release the GIL while
+# they work, and threads avoid forking a server process that holds the SAM2 model and its locks
+DEFAULT_DATASET_WORKERS = max(1, min(4, os.cpu_count() or 1))
+FRAMES_PER_TASK = 16
+
+# Largest distance, in pixels, of a simplified polygon from the mask outline
+POLYGON_TOLERANCE = 1.0
+
+
+def mask_polygons(mask, tolerance=POLYGON_TOLERANCE):
+    """
+    Outer contours of a binary mask as flat [x1, y1, x2, y2, ...] polygons, simplified to the given tolerance.
+    Polygons with fewer than three points are dropped.
+    """
+    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    polygons = []
+    for contour in contours:
+        if tolerance:
+            contour = cv2.approxPolyDP(contour, tolerance, True)
+        if len(contour) >= 3:
+            polygons.append(contour.reshape(-1).astype(float).tolist())
+    return polygons
+
+
+def encode_frame_masks(task):
+    """
+    Encode the masks of a few frames in one dataset format. Runs on the worker threads.
+
+    Args:
+        task (tuple): (dataset_format, frames, options) where frames is [(frame_idx, [(obj_id, mask store
+            entry), ...]), ...] and options holds the 'frame_size', the 'class_index' of every object for YOLO
+            and the 'palette' for PNG.
+
+    Returns:
+        list: (frame_idx, payload) per frame: annotation dicts for COCO, label text for YOLO, PNG bytes.
+    """
+    dataset_format, frames, options = task
+    width, height = options['frame_size']
+    results = []
+
+    for frame_idx, entries in frames:
+        masks = [(obj_id, MaskStore._decompress(entry)) for obj_id, entry in entries]
+
+        if dataset_format in ("coco_rle", "coco_polygon"):
+            annotations = []
+            for obj_id, mask in masks:
+                area = int(mask.sum())
+                if not area:
+                    continue
+                x, y, w, h = cv2.boundingRect(mask.astype(np.uint8))
+                if dataset_format == "coco_rle":
+                    segmentation = rle_encode(mask)
+                else:
+                    segmentation = mask_polygons(mask, options.get('tolerance', POLYGON_TOLERANCE))
+                    if not segmentation:
+                        continue
+                annotations.append({'obj_id': obj_id, 'segmentation': segmentation, 'area': area,
+                                    'bbox': [x, y, w, h]})
+            results.append((frame_idx, annotations))
+
+        elif dataset_format == "yolo_seg":
+            lines = []
+            for obj_id, mask in masks:
+                for polygon in mask_polygons(mask, options.get('tolerance', POLYGON_TOLERANCE)):
+                    coords = np.asarray(polygon).reshape(-1, 2) / (width, height)
+                    lines.append(f"{options['class_index'][obj_id]} " +
+                                 " ".join(f"{value:.6f}" for value in coords.reshape(-1)))
+            results.append((frame_idx, "\n".join(lines) + ("\n" if lines else "")))
+
+        elif dataset_format == "png":
+            from PIL import Image
+
+            label_map = np.zeros((height, width), dtype=np.uint8)
+            for obj_id, mask in sorted(masks):
+                label_map[mask[:height, :width]] = obj_id
+            image = Image.fromarray(label_map, mode="P")
+            image.putpalette(options['palette'])
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG", optimize=False)
+            results.append((frame_idx, buffer.getvalue()))
+
+        else:
+            raise ValueError(f"Unknown dataset format '{dataset_format}', expected one of {list(DATASET_FORMATS)}")
+
+    return results
+
+
+def class_indices(class_names, obj_ids):
+    """
+    YOLO class index of every class name and object ID: the named classes keep their order, so datasets
+    exported from different videos share the same indices, and unnamed objects come after them.
+    """
+    ids = sorted(class_names) + sorted(set(obj_ids) - set(class_names))
+    return {obj_id: i for i, obj_id in enumerate(ids)}
+
+
+def export_dataset(output_path, dataset_format, masks_by_frame, frame_names, frame_size, class_names, colors,
+                   frames=None, num_workers=None, progress_callback=None, cancel_event=None, fps=None):
+    """
+    Write the masks of every frame as a training dataset in a zip archive. The frames are split in small
+    tasks encoded by a thread pool (contours, RLE, PNG), at most a few tasks ahead of the writer, and
+    every result is written to the archive as soon as it is in order, so memory stays bounded whatever the
+    length of the video.
+
+    Args:
+        output_path (str): Where to write the zip archive.
+        dataset_format (str): One of DATASET_FORMATS.
+        masks_by_frame (dict): {frame_idx: [(obj_id, mask store entry), ...]}, see MaskStore.masks_by_frame().
+        frame_names (list): File names of the frames, e.g. '00042.jpg'.
+        frame_size (tuple): (width, height) of the frames and masks.
+        class_names (dict): {obj_id: class name}.
+        colors (dict): {obj_id: [R, G, B]}, the palette of the PNG label maps.
+        frames (iterable): Optional. (frame_idx, BGR frame) pairs in order, written as images/<frame name>.
+        num_workers (int): Optional. Number of worker threads, 0 encodes on the calling thread.
+        progress_callback (callable): Optional. Called as progress_callback(frames_done, frames_total).
+        cancel_event (threading.Event): Optional. Stops the export and removes the partial archive when set.
+        fps (float): Optional. Frame rate, recorded in the dataset info.
+
+    Returns:
+        int: Number of frames exported.
+    """
+    if dataset_format not in DATASET_FORMATS:
+        raise ValueError(f"Unknown dataset format '{dataset_format}', expected one of {list(DATASET_FORMATS)}")
+
+    obj_ids = sorted({obj_id for entries in masks_by_frame.values() for obj_id, _ in entries})
+    if dataset_format == "png" and any(not 0 < obj_id < 256 for obj_id in obj_ids):
+        raise ValueError("PNG label maps hold object IDs from 1 to 255")
+
+    names = {obj_id: class_names.get(obj_id, f"object {obj_id}") for obj_id in sorted(set(class_names) | set(obj_ids))}
+    palette = [0, 0, 0] * 256
+    for obj_id, color in colors.items():
+        if 0 < obj_id < 256:
+            palette[3 * obj_id:3 * obj_id + 3] = list(color)
+    options = {'frame_size': tuple(frame_size), 'class_index': class_indices(class_names, obj_ids), 'palette': palette}
+
+    frames_total = len(frame_names)
+    tasks = ((dataset_format, [(frame_idx, masks_by_frame.get(frame_idx, []))
+                               for frame_idx in range(first, min(first + FRAMES_PER_TASK, frames_total))], options)
+             for first in range(0, frames_total, FRAMES_PER_TASK))
+
+    num_workers = DEFAULT_DATASET_WORKERS if num_workers is None else num_workers
+    if frames_total <= FRAMES_PER_TASK:
+        num_workers = 0  # Not worth starting threads for
+    executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="dataset-export") if num_workers else None
+
+    def results():
+        if executor is None:
+            for task in tasks:
+                yield from encode_frame_masks(task)
+            return
+        # Keep a bounded number of tasks in flight, collected in submission order
+        in_flight = deque()
+        for task in tasks:
+            in_flight.append(executor.submit(encode_frame_masks, task))
+            if len(in_flight) >= 2 * num_workers:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+    image_iterator = iter(frames) if frames is not None else None
+    coco_file = None
+    frames_done = 0
+    start_time = time.time()
+    try:
+        with zipfile.ZipFile(output_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            if dataset_format.startswith("coco"):
+                # The annotations are spooled to disk and added last, the archive takes one entry at a time
+                coco_file = tempfile.NamedTemporaryFile("w", suffix=".json", dir=os.path.dirname(output_path) or ".",
+                                                        delete=False)
+                coco_file.write('{"info": ' + json.dumps({'description': 'Exported video annotations', 'fps': fps,
+                                                           'date_created': time.strftime('%Y-%m-%dT%H:%M:%S')}))
+                coco_file.write(', "categories": ' + json.dumps([{'id': obj_id, 'name': name}
+                                                                  for obj_id, name in names.items()]))
+                coco_file.write(', "images": ' + json.dumps([{'id': frame_idx + 1, 'file_name': f"images/{name}",
+                                                               'width': frame_size[0], 'height': frame_size[1],
+                                                               'frame_index': frame_idx}
+                                                              for frame_idx, name in enumerate(frame_names)]))
+                coco_file.write(', "annotations": [')
+
+            annotation_id = 0
+            for frame_idx, payload in results():
+                if cancel_event is not None and cancel_event.is_set():
+                    raise InterruptedError("Dataset export was cancelled")
+
+                stem = os.path.splitext(frame_names[frame_idx])[0]
+                with metrics.time('export_write'):
+                    if coco_file is not None:
+                        for annotation in payload:
+                            annotation_id += 1
+                            obj_id = annotation.pop('obj_id')
+                            coco_file.write(("," if annotation_id > 1 else "") + json.dumps({
+                                'id': annotation_id, 'image_id': frame_idx + 1, 'category_id': obj_id,
+                                'object_id': obj_id, 'iscrowd': 0, **annotation}))
+                    elif dataset_format == "yolo_seg":
+                        archive.writestr(f"labels/{stem}.txt", payload)
+                    else:
+                        archive.writestr(f"masks/{stem}.png", payload, compress_type=zipfile.ZIP_STORED)
+
+                    if image_iterator is not None:
+                        image_idx, frame = next(image_iterator, (frame_idx, None))
+                        if frame is not None:
+                            success, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+                            if success:
+                                archive.writestr(f"images/{frame_names[image_idx]}", buffer.tobytes(),
+                                                 compress_type=zipfile.ZIP_STORED)
+
+                frames_done += 1
+                if progress_callback is not None:
+                    progress_callback(frames_done, frames_total)
+
+            if coco_file is not None:
+                coco_file.write("]}")
+                coco_file.close()
+                archive.write(coco_file.name, "annotations.json")
+            elif dataset_format == "yolo_seg":
+                archive.writestr("data.yaml", "path: .\ntrain: images\nval: images\n" +
+                                 f"nc: {len(options['class_index'])}\nnames:\n" +
+                                 "".join(f"  {index}: {json.dumps(names[obj_id])}\n"
+                                         for obj_id, index in options['class_index'].items()))
+            archive.writestr("classes.json", json.dumps({str(obj_id): name for obj_id, name in names.items()}))
+    except BaseException:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if coco_file is not None:
+            coco_file.close()
+            if os.path.exists(coco_file.name):
+                os.remove(coco_file.name)
+
+    elapsed = time.time() - start_time
+    logger.info(f"Exported {frames_done} frames as {dataset_format} in {elapsed:.2f}s "
+                f"({frames_done / elapsed if elapsed else 0:.1f} frames/s)")
+    return frames_done
@@ -0,0 +1,434 @@
+import os
+import queue
+import logging
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Parts of a SAM2 backbone output. Only the feature pyramid depends on the frame: the positional encodings only
+# depend on the resolution, so they are kept once per shape, and the vision features are the pyramid's last level
+PYRAMID_KEY = "backbone_fpn"
+POSITION_ENCODING_KEY = "vision_pos_enc"
+VISION_FEATURES_KEY = "vision_features"
+
+# Folder of the on-disk store holding the positional encodings, one entry per shape
+POSITION_ENCODING_FOLDER = "position_encodings"
+
+# Entries waiting for the disk writer. When it falls further behind, new entries are only kept in memory
+DEFAULT_WRITE_QUEUE_SIZE = 16
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Return the SHA-256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_cache_key(model_cfg, checkpoint, variant=None):
+    """
+    Identify the model that produced a set of features, so features of different configs or weights never mix.
+    The checkpoint is identified by its name, size and modification time rather than hashed, since it is large.
+    The optional variant tells apart features of the same weights run differently, e.g. at reduced precision.
+    """
+    description = f"{os.path.basename(model_cfg)}|{os.path.basename(checkpoint or '')}"
+    if checkpoint and os.path.exists(checkpoint):
+        description += f"|{os.path.getsize(checkpoint)}|{int(os.path.getmtime(checkpoint))}"
+    if variant:
+        description += f"|{variant}"
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()[:16]
+
+
+def backbone_nbytes(backbone_out):
+    return sum(t.element_size() * t.nelement() for t in _flatten(backbone_out).values())
+
+
+def frame_features(backbone_out):
+    """
+    The part of a SAM2 backbone output worth storing per frame: the feature pyramid, without the positional
+    encodings and without the vision features, which are rebuilt from the pyramid (see assemble_backbone_out).
+    """
+    return {key: value for key, value in backbone_out.items()
+            if key != POSITION_ENCODING_KEY and not (key == VISION_FEATURES_KEY and PYRAMID_KEY in backbone_out)}
+
+
+def position_encoding_key(position_encoding):
+    """
+    Name of a set of positional encodings, from their shapes and dtype, e.g. '1x256x64x64-...-float32'.
+    """
+    shapes = ["x".join(str(size) for size in tensor.shape) for tensor in position_encoding]
+    return "-".join(shapes + [str(position_encoding[0].dtype).replace("torch.", "")])
+
+
+def assemble_backbone_out(features, position_encoding):
+    """
+    Rebuild a SAM2 backbone output from frame_features() and the positional encodings of its shape.
+    """
+    backbone_out = dict(features)
+    if PYRAMID_KEY in features:
+        backbone_out[VISION_FEATURES_KEY] = features[PYRAMID_KEY][-1]
+    if position_encoding is not None:
+        backbone_out[POSITION_ENCODING_KEY] = list(position_encoding)
+    return backbone_out
+
+
+def _flatten(backbone_out):
+    """
+    Flatten a SAM2 backbone output ({'vision_features': tensor, 'backbone_fpn': [tensors], ...})
+    into {'vision_features': tensor, 'backbone_fpn.0': tensor, ...}.
+    """
+    flat = {}
+    for key, value in backbone_out.items():
+        if torch.is_tensor(value):
+            flat[key] = value
+        elif isinstance(value, (list, tuple)):
+            for i, tensor in enumerate(value):
+                flat[f"{key}.{i}"] = tensor
+    return flat
+
+
+# Image-encoder feature cache
+class FeatureCache:
+    def __init__(self, cache_folder, model_key, max_memory_bytes, max_disk_bytes, write_queue_size=DEFAULT_WRITE_QUEUE_SIZE):
+        """
+        Cache of SAM2 image-encoder outputs per video frame, so the backbone (by far the most expensive
+        part of a click on CPU) runs at most once per frame, across resets, restarts and re-uploads of
+        the same file. Entries are keyed by the model, the video content and the source frame index.
+        Recent entries are kept in memory (LRU, bounded by max_memory_bytes), and every entry is also
+        written to disk as .npy files that are memory-mapped when read back.
+
+        Only the feature pyramid is stored per frame (see frame_features): the positional encodings, which
+        make up most of a backbone output, are kept once per shape, and the vision features are rebuilt from
+        the pyramid. Disk writes run on a writer thread, so a miss costs the calling thread no disk I/O.
+
+        Args:
+            cache_folder (str): Folder of the on-disk store.
+            model_key (str): Identifies the model config (see model_cache_key).
+            max_memory_bytes (int): Size of the in-memory LRU.
+            max_disk_bytes (int): Size of the on-disk store, the oldest entries are deleted beyond it. The
+                positional encodings, written once per shape, are not counted.
+            write_queue_size (int): Most entries waiting to be written, further entries are not written.
+        """
+        self.cache_folder = os.path.join(cache_folder, model_key)
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()  # (video_key, source_frame_idx) -> (features, position encoding key, nbytes)
+        self.memory_bytes = 0
+        self.position_encodings = {}  # position encoding key -> [tensors], shared by all entries of that shape
+        self.lock = threading.RLock()
+        self.pending = threading.local()  # Keys of an inference state that init_state is still building
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_writes': 0,
+                      'dropped_writes': 0}
+
+        if not os.path.exists(self.cache_folder):
+            os.makedirs(self.cache_folder)
+
+        # On-disk entries, oldest first: entry folder -> size in bytes
+        self.disk_entries = OrderedDict()
+        self.disk_bytes = 0
+        self._scan_disk()
+
+        self.write_queue = queue.Queue(maxsize=write_queue_size)
+        self.queued_writes = set()  # Entry folders in the write queue
+        self.writer = threading.Thread(target=self._run_writer, name="feature-cache-writer", daemon=True)
+        self.writer.start()
+
+    def _scan_disk(self):
+        entries = []
+        for video_key in os.listdir(self.cache_folder):
+            video_folder = os.path.join(self.cache_folder, video_key)
+            if video_key == POSITION_ENCODING_FOLDER or not os.path.isdir(video_folder):
+                continue
+            for name in os.listdir(video_folder):
+                entry_folder = os.path.join(video_folder, name)
+                if name.endswith(".tmp"):
+                    # Left over from an interrupted write
+                    shutil.rmtree(entry_folder, ignore_errors=True)
+                    continue
+                nbytes = sum(os.path.getsize(os.path.join(entry_folder, f)) for f in os.listdir(entry_folder))
+                entries.append((os.path.getmtime(entry_folder), entry_folder, nbytes))
+
+        for _, entry_folder, nbytes in sorted(entries):
+            self.disk_entries[entry_folder] = nbytes
+            self.disk_bytes += nbytes
+        self._enforce_disk_budget()
+
+    def _enforce_disk_budget(self):
+        """
+        Delete the oldest entries until the on-disk store fits in max_disk_bytes.
+        """
+        while self.disk_bytes > self.max_disk_bytes and self.disk_entries:
+            evicted_folder, evicted_bytes = self.disk_entries.popitem(last=False)
+            shutil.rmtree(evicted_folder, ignore_errors=True)
+            self.disk_bytes -= evicted_bytes
+
+    def entry_folder(self, video_key, source_frame_idx):
+        return os.path.join(self.cache_folder, video_key, f"{source_frame_idx:06d}")
+
+    def position_encoding_folder(self, position_key):
+        return os.path.join(self.cache_folder, POSITION_ENCODING_FOLDER, position_key)
+
+    def get(self, video_key, source_frame_idx, device):
+        """
+        Look up the backbone output of a frame, in memory first, then on disk.
+
+        Returns:
+            dict: The backbone output on the given device, or None on a miss.
+        """
+        key = (video_key, source_frame_idx)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                features, position_key, _ = entry
+                return assemble_backbone_out(features, self.position_encodings.get(position_key))
+
+        backbone_out = self._read(video_key, source_frame_idx, device)
+        with self.lock:
+            if backbone_out is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+            self._remember(key, backbone_out)
+        return backbone_out
+
+    def put(self, video_key, source_frame_idx, backbone_out):
+        """
+        Store the backbone output of a frame in memory, and queue it for the disk.
+        """
+        key = (video_key, source_frame_idx)
+        entry_folder = self.entry_folder(video_key, source_frame_idx)
+        with self.lock:
+            position_key = self._remember(key, backbone_out)
+            if entry_folder in self.queued_writes or os.path.exists(entry_folder):
+                return
+            features = self.memory[key][0]
+
+            position_write = None
+            position_folder = self.position_encoding_folder(position_key) if position_key is not None else None
+            if position_folder is not None and position_folder not in self.queued_writes \
+                    and not os.path.exists(position_folder):
+                self.queued_writes.add(position_folder)
+                position_write = (position_folder, {POSITION_ENCODING_KEY: self.position_encodings[position_key]}, None)
+
+        if position_write is not None:
+            # Entries are unreadable without it, so it is always queued, ahead of them. Outside the lock,
+            # which the writer takes when it is done with an entry
+            self.write_queue.put(position_write)
+
+        with self.lock:
+            if entry_folder in self.queued_writes:
+                return
+            try:
+                self.write_queue.put_nowait((entry_folder, features, position_key))
+            except queue.Full:
+                self.stats['dropped_writes'] += 1
+                return
+            self.queued_writes.add(entry_folder)
+
+    def flush(self):
+        """
+        Wait until the queued entries are written.
+        """
+        self.write_queue.join()
+
+    def _remember(self, key, backbone_out):
+        """
+        Keep a backbone output in the memory LRU, its positional encodings with those of the same shape.
+
+        Returns:
+            str: The key of its positional encodings, None if it has none.
+        """
+        position_encoding = backbone_out.get(POSITION_ENCODING_KEY)
+        position_key = position_encoding_key(position_encoding) if position_encoding else None
+        if position_key is not None and position_key not in self.position_encodings:
+            self.position_encodings[position_key] = list(position_encoding)
+
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key)[2]
+        features = frame_features(backbone_out)
+        nbytes = backbone_nbytes(features)
+        self.memory[key] = (features, position_key, nbytes)
+        self.memory_bytes += nbytes
+
+        while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+            _, (_, _, evicted_bytes) = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted_bytes
+            self.stats['evictions'] += 1
+        return position_key
+
+    def _run_writer(self):
+        while True:
+            folder, structure, position_key = self.write_queue.get()
+            try:
+                nbytes = self._write(folder, structure, position_key)
+                if nbytes is not None and position_key is not None:
+                    with self.lock:
+                        self.stats['disk_writes'] += 1
+                        self.disk_entries[folder] = nbytes
+                        self.disk_bytes += nbytes
+                        self._enforce_disk_budget()
+            except Exception as e:
+                logger.warning(f"Could not write feature cache entry {folder}: {e}")
+            finally:
+                with self.lock:
+                    self.queued_writes.discard(folder)
+                self.write_queue.task_done()
+
+    def _write(self, folder, structure, position_key=None):
+        """
+        Write one entry as a folder of .npy files plus a manifest describing the structure and naming the
+        positional encodings it goes with. The folder is written under a temporary name and renamed, so
+        readers never see partial entries.
+
+        Returns:
+            int: Bytes written, or None if the entry was already stored.
+        """
+        temp_folder = f"{folder}.{threading.get_ident()}.tmp"
+        os.makedirs(temp_folder, exist_ok=True)
+
+        manifest = {'lists': {}, 'tensors': {}, 'position_encoding': position_key}
+        for key, value in structure.items():
+            if isinstance(value, (list, tuple)):
+                manifest['lists'][key] = len(value)
+
+        for name, tensor in _flatten(structure).items():
+            tensor = tensor.detach().cpu()
+            dtype = str(tensor.dtype).replace("torch.", "")
+            if tensor.dtype == torch.bfloat16:
+                # NumPy has no bfloat16, store the raw bits
+                tensor = tensor.view(torch.int16)
+            np.save(os.path.join(temp_folder, f"{name}.npy"), tensor.numpy())
+            manifest['tensors'][name] = dtype
+
+        with open(os.path.join(temp_folder, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+        nbytes = sum(os.path.getsize(os.path.join(temp_folder, f)) for f in os.listdir(temp_folder))
+        try:
+            os.rename(temp_folder, folder)
+        except OSError:
+            # Already stored, e.g. by another server process sharing the folder
+            shutil.rmtree(temp_folder, ignore_errors=True)
+            return None
+        return nbytes
+
+    def _read_folder(self, folder, device):
+        """
+        Read an entry written by _write.
+
+        Returns:
+            tuple: (structure, manifest), or None if the entry is missing or unreadable.
+        """
+        manifest_path = os.path.join(folder, "manifest.json")
+        if not os.path.exists(manifest_path):
+            return None
+
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+            tensors = {}
+            for name, dtype in manifest['tensors'].items():
+                # Copy-on-write memory map: pages are read from disk only when the tensor is used
+                array = np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="c")
+                tensor = torch.from_numpy(array)
+                if dtype == "bfloat16":
+                    tensor = tensor.view(torch.bfloat16)
+                tensors[name] = tensor.to(device)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable feature cache entry {folder}: {e}")
+            return None
+
+        structure = {name: tensor for name, tensor in tensors.items() if "." not in name}
+        for key, length in manifest['lists'].items():
+            structure[key] = [tensors[f"{key}.{i}"] for i in range(length)]
+        return structure, manifest
+
+    def _read(self, video_key, source_frame_idx, device):
+        entry = self._read_folder(self.entry_folder(video_key, source_frame_idx), device)
+        if entry is None:
+            return None
+        features, manifest = entry
+
+        # Entries of earlier versions hold the whole backbone output, and name no positional encodings
+        position_key = manifest.get('position_encoding')
+        if position_key is None:
+            return features
+
+        with self.lock:
+            position_encoding = self.position_encodings.get(position_key)
+        if position_encoding is None:
+            stored = self._read_folder(self.position_encoding_folder(position_key), device)
+            if stored is None:
+                return None
+            position_encoding = stored[0][POSITION_ENCODING_KEY]
+            with self.lock:
+                position_encoding = self.position_encodings.setdefault(position_key, position_encoding)
+        return assemble_backbone_out(features, [tensor.to(device) for tensor in position_encoding])
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.stats['memory_hits'] + self.stats['disk_hits'] + self.stats['misses']
+            hits = self.stats['memory_hits'] + self.stats['disk_hits']
+            return {
+                **self.stats,
+                'hit_rate': round(hits / lookups, 3) if lookups else None,
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_bytes,
+                'max_memory_bytes': self.max_memory_bytes,
+                'position_encodings': len(self.position_encodings),
+                'disk_entries': len(self.disk_entries),
+                'disk_bytes': self.disk_bytes,
+                'max_disk_bytes': self.max_disk_bytes,
+                'queued_writes': self.write_queue.qsize()
+            }
+
+    def bind_pending(self, cache_keys):
+        """
+        Set the cache keys of an inference state that is being created on this thread, so the frame
+        features computed inside init_state are cached too. Pass None to clear.
+        """
+        self.pending.cache_keys = cache_keys
+
+    def install(self, predictor):
+        """
+        Route the predictor's per-frame feature lookup through this cache. Inference states opt in by
+        holding 'feature_cache_keys' = (video_key, source frame index of every frame).
+        """
+        original_get_image_feature = predictor._get_image_feature
+
+        def cached_get_image_feature(inference_state, frame_idx, batch_size):
+            cache_keys = inference_state.get("feature_cache_keys") or getattr(self.pending, "cache_keys", None)
+            if cache_keys is None or frame_idx in inference_state["cached_features"]:
+                return original_get_image_feature(inference_state, frame_idx, batch_size)
+
+            video_key, source_frame_indices = cache_keys
+            source_frame_idx = source_frame_indices[frame_idx]
+            device = inference_state["device"]
+
+            backbone_out = self.get(video_key, source_frame_idx, device)
+            if backbone_out is not None:
+                image = inference_state["images"][frame_idx].to(device).float().unsqueeze(0)
+                # Same single-entry semantics as SAM2's own cache
+                inference_state["cached_features"] = {frame_idx: (image, backbone_out)}
+                return original_get_image_feature(inference_state, frame_idx, batch_size)
+
+            features = original_get_image_feature(inference_state, frame_idx, batch_size)
+            cached = inference_state["cached_features"].get(frame_idx)
+            if cached is not None:
+                self.put(video_key, source_frame_idx, cached[1])
+            return features
+
+        predictor._get_image_feature = cached_get_image_feature
@@ -0,0 +1,177 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+# Segments are decoded on threads: OpenCV releases the GIL while decoding, resizing and encoding,
+# and threads avoid forking (or re-importing) a server process that holds the SAM2 model.
+DEFAULT_NUM_WORKERS = max(1, min(8, os.cpu_count() or 1))
+
+
+def probe_video(file):
+    """
+    Read the basic properties of a video without decoding it.
+
+    Returns:
+        dict: {'frame_count', 'fps', 'width', 'height'}, or None if the video cannot be opened.
+    """
+    cap = cv2.VideoCapture(file)
+    if not cap.isOpened():
+        return None
+
+    info = {
+        'frame_count': int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+        'fps': cap.get(cv2.CAP_PROP_FPS) or 30.0,
+        'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    }
+    cap.release()
+    return info
+
+
+def sample_frame_indices(frame_count, fps, stride=1, target_fps=None, start_frame=0, end_frame=None):
+    """
+    Select which source frames to extract.
+
+    Args:
+        frame_count (int): Number of frames in the video.
+        fps (float): Frame rate of the video.
+        stride (int): Keep every stride-th frame.
+        target_fps (float): Optional. Derive the stride from the wanted frame rate instead.
+        start_frame (int): First source frame to keep.
+        end_frame (int): Optional. Source frame to stop at (exclusive).
+
+    Returns:
+        tuple: (source frame indices, effective stride)
+    """
+    if target_fps:
+        stride = max(1, int(round(fps / float(target_fps))))
+    stride = max(1, int(stride or 1))
+
+    start_frame = max(0, int(start_frame or 0))
+    end_frame = frame_count if end_frame is None else min(int(end_frame), frame_count)
+    return list(range(start_frame, end_frame, stride)), stride
+
+
+def fit_resolution(width, height, max_resolution=None):
+    """
+    Scale a frame size down so that its longest side is at most max_resolution, keeping the aspect ratio.
+    """
+    if not max_resolution or max(width, height) <= max_resolution:
+        return width, height
+
+    scale = float(max_resolution) / max(width, height)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def split_segments(items, num_segments):
+    """
+    Split a list into at most num_segments contiguous, nearly equal chunks, keeping the offset of each.
+
+    Returns:
+        list: [(offset, chunk), ...]
+    """
+    num_segments = max(1, min(num_segments, len(items)))
+    size, remainder = divmod(len(items), num_segments)
+
+    segments = []
+    offset = 0
+    for i in range(num_segments):
+        end = offset + size + (1 if i < remainder else 0)
+        segments.append((offset, items[offset:end]))
+        offset = end
+    return segments
+
+
+def iter_video_frames(file, source_indices, frame_size=None):
+    """
+    Decode the given source frames (in increasing order) from a video. The capture seeks once to the
+    first frame, then reads sequentially, skipping unwanted frames with grab() so they are not converted.
+
+    Args:
+        file (str): The path to the video file.
+        source_indices (list): Increasing source frame indices to decode.
+        frame_size (tuple): Optional. (width, height) to resize the frames to.
+
+    Yields:
+        tuple: (position in source_indices, BGR frame). Stops at the first frame that cannot be read.
+    """
+    if not source_indices:
+        return
+
+    cap = cv2.VideoCapture(file)
+    try:
+        if source_indices[0] > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, source_indices[0])
+        position = source_indices[0]
+
+        for i, source_idx in enumerate(source_indices):
+            while position < source_idx:
+                if not cap.grab():
+                    return
+                position += 1
+
+            success, frame = cap.read()
+            if not success:
+                return
+            position += 1
+
+            if frame_size is not None and (frame.shape[1], frame.shape[0]) != tuple(frame_size):
+                frame = cv2.resize(frame, tuple(frame_size), interpolation=cv2.INTER_AREA)
+            yield i, frame
+    finally:
+        cap.release()
+
+
+def _extract_segment(file, frame_folder, source_indices, first_output_idx, frame_size, jpeg_quality):
+    """
+    Decode one segment of the video and write its frames as JPEGs named by output index.
+
+    Returns:
+        int: Number of frames written.
+    """
+    written = 0
+    for i, frame in iter_video_frames(file, source_indices, frame_size):
+        frame_path = os.path.join(frame_folder, f"{first_output_idx + i:05d}.jpg")
+        cv2.imwrite(frame_path, frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+        written += 1
+    return written
+
+
+def extract_frames_parallel(file, frame_folder, source_indices, frame_size=None, num_workers=None, jpeg_quality=95):
+    """
+    Extract the given source frames to JPEGs, splitting the work in contiguous segments that are decoded
+    and encoded in parallel, each worker seeking to the start of its own segment.
+
+    Args:
+        file (str): The path to the video file.
+        frame_folder (str): Folder the frames are written to, as 00000.jpg, 00001.jpg, ...
+        source_indices (list): Increasing source frame indices to extract.
+        frame_size (tuple): Optional. (width, height) to resize the frames to.
+        num_workers (int): Number of parallel workers.
+        jpeg_quality (int): JPEG quality of the written frames.
+
+    Returns:
+        int: Number of consecutive frames written from the start (a segment that ends early, e.g. because
+            the container over-reported its frame count, truncates the output there).
+    """
+    segments = split_segments(source_indices, num_workers or DEFAULT_NUM_WORKERS)
+
+    with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [executor.submit(_extract_segment, file, frame_folder, chunk, offset, frame_size, jpeg_quality)
+                   for offset, chunk in segments]
+        written = [future.result() for future in futures]
+
+    # Keep only the frames before the first gap
+    frame_count = 0
+    for (offset, chunk), count in zip(segments, written):
+        frame_count += count
+        if count < len(chunk):
+            break
+
+    # Remove frames written after a gap, so the folder only holds consecutive frames
+    for i in range(frame_count, len(source_indices)):
+        frame_path = os.path.join(frame_folder, f"{i:05d}.jpg")
+        if os.path.exists(frame_path):
+            os.remove(frame_path)
+
+    return frame_count
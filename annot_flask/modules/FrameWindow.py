@@ -0,0 +1,137 @@
+import os
+import threading
+from collections import OrderedDict
+import cv2
+import torch
+from .FrameExtraction import iter_video_frames
+
+# Normalization SAM2 applies to the video frames (ImageNet statistics)
+SAM2_IMG_MEAN = (0.485, 0.456, 0.406)
+SAM2_IMG_STD = (0.229, 0.224, 0.225)
+
+
+def preprocess_frame(frame, image_size):
+    """
+    Turn a BGR frame into the normalized (3, image_size, image_size) float tensor SAM2 expects.
+    """
+    frame = cv2.cvtColor(cv2.resize(frame, (image_size, image_size), interpolation=cv2.INTER_CUBIC), cv2.COLOR_BGR2RGB)
+    image = torch.from_numpy(frame).permute(2, 0, 1).float().div_(255.0)
+    mean = torch.tensor(SAM2_IMG_MEAN, dtype=torch.float32)[:, None, None]
+    std = torch.tensor(SAM2_IMG_STD, dtype=torch.float32)[:, None, None]
+    return image.sub_(mean).div_(std)
+
+
+# Lazily loaded frames
+class LazyVideoFrames:
+    def __init__(self, image_size, device, window_size, video_file=None, source_frame_indices=None,
+                 frame_folder=None, frame_names=None, read_ahead=8):
+        """
+        Stand-in for the frame tensor of a SAM2 inference state that decodes frames on demand and keeps
+        only a bounded window of them in memory: the window_size most recently used frames, plus the
+        pinned (prompted) frames, which are never evicted. Frames come either from the source video or
+        from a folder of extracted JPEGs.
+
+        Args:
+            image_size (int): Input size of the SAM2 model.
+            device (torch.device): Device the frames are moved to.
+            window_size (int): Number of unpinned frames kept in memory.
+            video_file (str): Source video, used together with source_frame_indices.
+            source_frame_indices (list): Source video frame index of every frame.
+            frame_folder (str): Folder of extracted JPEGs, used together with frame_names.
+            frame_names (list): JPEG file names of every frame.
+            read_ahead (int): Number of frames decoded per video seek, since propagation reads frames in order.
+        """
+        self.image_size = image_size
+        self.device = device
+        self.window_size = max(1, int(window_size))
+        self.video_file = video_file
+        self.source_frame_indices = source_frame_indices
+        self.frame_folder = frame_folder
+        self.frame_names = frame_names
+        self.read_ahead = max(1, min(int(read_ahead), self.window_size))
+        self.frames = OrderedDict()  # frame_idx -> tensor, least recently used first
+        self.pinned = set()
+        self.on_evict = None  # Optional callback(frame_idx), e.g. to drop cached image features
+        self.last_frame_idx = None
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        if self.source_frame_indices is not None:
+            return len(self.source_frame_indices)
+        return len(self.frame_names)
+
+    def __getitem__(self, frame_idx):
+        if frame_idx < 0:
+            frame_idx += len(self)
+        if frame_idx < 0 or frame_idx >= len(self):
+            raise IndexError(f"Frame index {frame_idx} out of range")
+
+        with self.lock:
+            image = self.frames.get(frame_idx)
+            if image is None:
+                self._load(frame_idx)
+                image = self.frames[frame_idx]
+            self.frames.move_to_end(frame_idx)
+            self.last_frame_idx = frame_idx
+            return image
+
+    def pin(self, frame_idx):
+        """
+        Keep a frame resident regardless of the window, e.g. because it has prompts.
+        """
+        with self.lock:
+            self.pinned.add(frame_idx)
+
+    def unpin(self, frame_idx):
+        with self.lock:
+            self.pinned.discard(frame_idx)
+            self._evict()
+
+    def resident_frames(self):
+        with self.lock:
+            return list(self.frames.keys())
+
+    def nbytes(self):
+        with self.lock:
+            return sum(image.element_size() * image.nelement() for image in self.frames.values())
+
+    def _load(self, frame_idx):
+        """
+        Decode a frame, plus a few neighbours in the direction the frames are being read.
+        """
+        reverse = self.last_frame_idx is not None and frame_idx < self.last_frame_idx
+        if reverse:
+            wanted = range(max(0, frame_idx - self.read_ahead + 1), frame_idx + 1)
+        else:
+            wanted = range(frame_idx, min(len(self), frame_idx + self.read_ahead))
+        wanted = [i for i in wanted if i == frame_idx or i not in self.frames]
+
+        if self.video_file is not None:
+            source_indices = [self.source_frame_indices[i] for i in wanted]
+            decoded = {wanted[i]: frame for i, frame in iter_video_frames(self.video_file, source_indices)}
+        else:
+            decoded = {}
+            for i in wanted:
+                frame = cv2.imread(os.path.join(self.frame_folder, self.frame_names[i]))
+                if frame is not None:
+                    decoded[i] = frame
+
+        if frame_idx not in decoded:
+            raise ValueError(f"Frame {frame_idx} could not be decoded")
+
+        # Insert the read-ahead frames farthest first, so they are evicted before the ones needed next,
+        # and the requested frame last, as the most recently used one
+        for i in sorted(decoded, key=lambda i: abs(i - frame_idx), reverse=True):
+            self.frames[i] = preprocess_frame(decoded[i], self.image_size).to(self.device)
+            self.frames.move_to_end(i)
+        self._evict()
+
+    def _evict(self):
+        """
+        Drop least recently used unpinned frames until the window fits.
+        """
+        unpinned = [i for i in self.frames if i not in self.pinned]
+        for frame_idx in unpinned[:max(0, len(unpinned) - self.window_size)]:
+            del self.frames[frame_idx]
+            if self.on_evict is not None:
+                self.on_evict(frame_idx)
@@ -0,0 +1,184 @@
+import os
+import time
+import logging
+from contextlib import nullcontext
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Model sizes: name -> (SAM2 config, checkpoint file name). The large model keeps the config shipped
+# next to the app, the others use the configs packaged with SAM2.
+MODEL_SIZES = {
+    'tiny': ('configs/sam2/sam2_hiera_t.yaml', 'sam2_hiera_tiny.pt'),
+    'small': ('configs/sam2/sam2_hiera_s.yaml', 'sam2_hiera_small.pt'),
+    'base_plus': ('configs/sam2/sam2_hiera_b+.yaml', 'sam2_hiera_base_plus.pt'),
+    'large': ('sam2_hiera_l.yaml', 'sam2_hiera_large.pt')
+}
+DEFAULT_MODEL_SIZE = 'large'
+
+# Autocast dtypes per precision, and the devices each one runs on
+PRECISIONS = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16
+}
+PRECISION_DEVICES = {
+    'bf16': ('cpu', 'cuda'),
+    'fp16': ('cuda', 'mps')
+}
+
+# torch.compile modes the image encoder can be compiled with, '' leaves it uncompiled
+COMPILE_MODES = ('', 'default', 'reduce-overhead', 'max-autotune')
+
+
+def resolve_device(device):
+    """
+    Turn 'auto' into the best available device.
+    """
+    if device != 'auto':
+        return torch.device(device)
+    if torch.cuda.is_available():
+        return torch.device('cuda')
+    if torch.backends.mps.is_available():
+        return torch.device('mps')
+    return torch.device('cpu')
+
+
+# Inference profile
+class InferenceProfile:
+    def __init__(self, model_size=DEFAULT_MODEL_SIZE, model_folder='.', model_cfg=None, checkpoint=None,
+                 device='cpu', precision=None, compile_mode='', num_threads=None, warmup_runs=1):
+        """
+        How the SAM2 model is loaded and run in this deployment, to trade accuracy for latency: the model size,
+        the device, the autocast precision, compilation of the image encoder and the number of CPU threads.
+
+        Args:
+            model_size (str): One of MODEL_SIZES.
+            model_folder (str): Folder of the checkpoints (and of the large model's config).
+            model_cfg (str): Optional. Config to use instead of the one of model_size.
+            checkpoint (str): Optional. Checkpoint to use instead of the one of model_size.
+            device (str): 'cpu', 'cuda', 'mps' or 'auto'.
+            precision (str): One of PRECISIONS, applied with torch.autocast around every model call. Defaults
+                to bf16 on CUDA, as SAM2 is run there, and fp32 elsewhere.
+            compile_mode (str): One of COMPILE_MODES.
+            num_threads (int): Optional. Number of intra-op CPU threads torch may use.
+            warmup_runs (int): Number of warm-up passes run by warm_up().
+        """
+        if model_size not in MODEL_SIZES:
+            raise ValueError(f"Unknown model size '{model_size}', expected one of {list(MODEL_SIZES)}")
+        self.device = resolve_device(device)
+        if precision is None:
+            precision = 'bf16' if self.device.type == 'cuda' else 'fp32'
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {list(PRECISIONS)}")
+        if compile_mode not in COMPILE_MODES:
+            raise ValueError(f"Unknown compile mode '{compile_mode}', expected one of {list(COMPILE_MODES)}")
+
+        default_cfg, default_checkpoint = MODEL_SIZES[model_size]
+        if model_cfg is None:
+            # Packaged configs are looked up by SAM2's hydra search path, the local one by its path
+            model_cfg = default_cfg if default_cfg.startswith('configs/') else os.path.join(model_folder, default_cfg)
+
+        self.model_size = model_size
+        self.model_cfg = model_cfg
+        self.checkpoint = checkpoint or os.path.join(model_folder, default_checkpoint)
+        self.precision = precision
+        self.compile_mode = compile_mode
+        self.num_threads = num_threads
+        self.warmup_runs = warmup_runs
+        self.warmup_seconds = []
+        self.load_seconds = None
+
+        if precision != 'fp32' and self.device.type not in PRECISION_DEVICES[precision]:
+            raise ValueError(f"{precision} is not supported on {self.device.type}, "
+                             f"use one of {list(PRECISION_DEVICES[precision])}")
+
+    def cache_variant(self):
+        """
+        Part of the feature cache key: features computed under autocast differ from the fp32 ones.
+        """
+        return None if self.precision == 'fp32' else self.precision
+
+    def apply_settings(self):
+        """
+        Process-wide torch settings of the profile.
+        """
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+
+        if self.device.type == "cuda":
+            # turn on tfloat32 for Ampere GPUs (https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices)
+            if torch.cuda.get_device_properties(0).major >= 8:
+                torch.backends.cuda.matmul.allow_tf32 = True
+                torch.backends.cudnn.allow_tf32 = True
+        elif self.device.type == "mps":
+            logger.warning(
+                "Support for MPS devices is preliminary. SAM 2 is trained with CUDA and might "
+                "give numerically different outputs and sometimes degraded performance on MPS. "
+                "See e.g. https://github.com/pytorch/pytorch/issues/84936 for a discussion."
+            )
+
+    def autocast(self):
+        """
+        Context the model calls run in. Autocast is thread-local, so it is entered around every call
+        instead of once at startup.
+        """
+        dtype = PRECISIONS[self.precision]
+        if dtype is None:
+            return nullcontext()
+        return torch.autocast(self.device.type, dtype=dtype)
+
+    def build_predictor(self):
+        """
+        Load the SAM2 video predictor of the profile and compile its image encoder if requested.
+        """
+        from sam2.build_sam import build_sam2_video_predictor
+
+        self.apply_settings()
+        start = time.time()
+        predictor = build_sam2_video_predictor(self.model_cfg, self.checkpoint, device=self.device)
+
+        if self.compile_mode:
+            # Compile the forward function (not the module) so the checkpoint keys stay the same
+            predictor.image_encoder.forward = torch.compile(predictor.image_encoder.forward, mode=self.compile_mode,
+                                                            dynamic=False)
+        self.load_seconds = time.time() - start
+        logger.info(f"Loaded the {self.model_size} SAM2 model on {self.device} in {self.load_seconds:.2f}s "
+                    f"({self.precision}{', compiled ' + self.compile_mode if self.compile_mode else ''})")
+        return predictor
+
+    def warm_up(self, predictor, runs=None):
+        """
+        Run a click and a one-frame propagation on a blank two-frame video, so lazy initialization (and
+        compilation) happens at startup instead of on the first user's click.
+        """
+        from .Annotation import _INIT_STATE_LOCK, preloaded_video_frames
+
+        runs = self.warmup_runs if runs is None else runs
+        image_size = predictor.image_size
+        images = torch.zeros((2, 3, image_size, image_size), dtype=torch.float32, device=self.device)
+
+        for _ in range(runs):
+            start = time.time()
+            with _INIT_STATE_LOCK, preloaded_video_frames(images, image_size, image_size), self.autocast():
+                inference_state = predictor.init_state(video_path="warm-up")
+            with self.autocast():
+                predictor.add_new_points_or_box(inference_state=inference_state, frame_idx=0, obj_id=1,
+                                                points=[[image_size / 2, image_size / 2]], labels=[1])
+                for _ in predictor.propagate_in_video(inference_state, max_frame_num_to_track=1):
+                    pass
+            self.warmup_seconds.append(time.time() - start)
+            logger.info(f"Warm-up pass {len(self.warmup_seconds)} took {self.warmup_seconds[-1]:.2f}s")
+
+    def describe(self):
+        return {
+            'model_size': self.model_size,
+            'model_cfg': self.model_cfg,
+            'checkpoint': os.path.basename(self.checkpoint),
+            'device': str(self.device),
+            'precision': self.precision,
+            'compile_mode': self.compile_mode or None,
+            'num_threads': torch.get_num_threads(),
+            'load_seconds': self.load_seconds,
+            'warmup_seconds': self.warmup_seconds
+        }
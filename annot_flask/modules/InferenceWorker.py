@@ -0,0 +1,176 @@
+import time
+import queue
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from contextlib import nullcontext
+import torch
+from .Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Requests arriving within this many seconds of the first one of a batch share its forward pass
+DEFAULT_BATCH_WINDOW = 0.005
+DEFAULT_MAX_BATCH_SIZE = 8
+
+
+def split_backbone_out(backbone_out, count):
+    """
+    Split a batched SAM2 backbone output ({'vision_features': tensor, 'backbone_fpn': [tensors], ...}) into
+    one output of batch size 1 per image. The parts are copied, so a cached output does not keep the
+    whole batch alive.
+    """
+    if count == 1:
+        return [backbone_out]
+
+    outputs = [{} for _ in range(count)]
+    for key, value in backbone_out.items():
+        for i, output in enumerate(outputs):
+            if torch.is_tensor(value):
+                output[key] = value[i:i + 1].clone()
+            elif isinstance(value, (list, tuple)):
+                output[key] = [tensor[i:i + 1].clone() for tensor in value]
+            else:
+                output[key] = value
+    return outputs
+
+
+# Encode request
+class EncodeRequest:
+    def __init__(self, predictor, image):
+        self.predictor = predictor
+        self.image = image
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+
+
+# Inference worker
+class InferenceWorker:
+    def __init__(self, inference_context=None, batch_window=DEFAULT_BATCH_WINDOW, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 num_threads=None):
+        """
+        Dedicated thread running the SAM2 image encoder for all sessions. Once installed on the predictor,
+        every frame SAM2 encodes, for a prompt as well as during propagation, sparse or incremental tracking,
+        is queued here while the calling thread waits; the worker collects the requests arriving within
+        batch_window of each other, up to max_batch_size, and encodes them in a single forward pass. Frames
+        nobody has encoded yet thus cost one batched backbone run instead of one run per caller, and encoder
+        passes never run side by side competing for the same CPU threads.
+
+        Only the encoder goes through the worker: the memory attention and mask decoder of concurrent prompts
+        and propagations still run on their own threads, in parallel with the encoder. Torch's intra-op
+        thread pool is process-wide, so num_threads applies to all of them.
+
+        Args:
+            inference_context (callable): Optional. Returns the context the forward passes run in, e.g.
+                InferenceProfile.autocast. Autocast is thread-local, so the worker enters it itself.
+            batch_window (float): Seconds to wait for more requests after the first one of a batch.
+            max_batch_size (int): Most images encoded in one forward pass.
+            num_threads (int): Optional. Number of intra-op CPU threads torch may use, set by the worker
+                thread when it starts.
+        """
+        self.inference_context = inference_context or nullcontext
+        self.batch_window = batch_window
+        self.max_batch_size = max(1, max_batch_size)
+        self.num_threads = num_threads
+        self.requests = queue.Queue()
+        self.batch_sizes = Counter()  # batch size -> number of forward passes
+        self.encoded = 0
+        self.thread = threading.Thread(target=self._run, name="inference-worker", daemon=True)
+        self.thread.start()
+
+    def encode(self, predictor, image):
+        """
+        Run the image encoder on one preprocessed frame, batched with the concurrent requests.
+
+        Args:
+            predictor: The SAM2 predictor (or a DeferredPredictor) to run.
+            image (torch.Tensor): Frame of shape (1, 3, S, S), on the predictor's device.
+
+        Returns:
+            dict: The backbone output of the frame, as SAM2's forward_image returns it.
+        """
+        request = EncodeRequest(predictor, image)
+        self.requests.put(request)
+        return request.future.result()
+
+    def install(self, predictor):
+        """
+        Route the encoder passes of the predictor through the worker. SAM2 encodes a frame in
+        _get_image_feature when it is not the one held in the inference state's single-entry feature cache;
+        the frame is encoded here instead and put in that cache, where SAM2 then finds it.
+        """
+        original_get_image_feature = predictor._get_image_feature
+
+        def batched_get_image_feature(inference_state, frame_idx, batch_size):
+            if frame_idx not in inference_state["cached_features"]:
+                # Same preprocessing as SAM2's _get_image_feature
+                image = inference_state["images"][frame_idx].to(inference_state["device"]).float().unsqueeze(0)
+                inference_state["cached_features"] = {frame_idx: (image, self.encode(predictor, image))}
+            return original_get_image_feature(inference_state, frame_idx, batch_size)
+
+        predictor._get_image_feature = batched_get_image_feature
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    def _collect(self):
+        """
+        Block for a request, then gather those arriving within the batch window.
+        """
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        while True:
+            batch = self._collect()
+            # Only images of the same model, device and size can share a forward pass
+            groups = {}
+            for request in batch:
+                key = (id(request.predictor), request.image.device, request.image.dtype, tuple(request.image.shape[1:]))
+                groups.setdefault(key, []).append(request)
+            for requests in groups.values():
+                self._encode_batch(requests)
+
+    @torch.inference_mode()
+    def _encode_batch(self, requests):
+        start = time.perf_counter()
+        for request in requests:
+            metrics.observe('encoder_queue_wait', start - request.queued_at)
+
+        try:
+            with metrics.time('encoder_batch'), self.inference_context():
+                images = torch.cat([request.image for request in requests])
+                outputs = split_backbone_out(requests[0].predictor.forward_image(images), len(requests))
+        except Exception as e:
+            logger.error(f"Error encoding a batch of {len(requests)} frames: {str(e)}")
+            for request in requests:
+                request.future.set_exception(e)
+            return
+
+        self.batch_sizes[len(requests)] += 1
+        self.encoded += len(requests)
+        for request, output in zip(requests, outputs):
+            request.future.set_result(output)
+
+    def describe(self):
+        passes = sum(self.batch_sizes.values())
+        return {
+            'queue_depth': self.queue_depth(),
+            'batch_window': self.batch_window,
+            'max_batch_size': self.max_batch_size,
+            'num_threads': torch.get_num_threads(),
+            'frames_encoded': self.encoded,
+            'forward_passes': passes,
+            'mean_batch_size': round(self.encoded / passes, 2) if passes else None,
+            'batch_sizes': dict(sorted(self.batch_sizes.items()))
+        }
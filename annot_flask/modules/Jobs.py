@@ -0,0 +1,225 @@
+import os
+import logging
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """
+    Raised by a job function when it stops early because its job was cancelled.
+    """
+
+
+# Background job
+class Job:
+    def __init__(self, kind, session_id=None, job_id=None):
+        """
+        A unit of background work (propagation, video export, ...) with progress reporting and cancellation.
+
+        Args:
+            kind (str): What the job does, e.g. 'propagate' or 'download_video'.
+            session_id (str): The annotation session the job belongs to.
+            job_id (str): Optional. Reuse an existing ID, used when loading persisted jobs.
+        """
+        self.job_id = job_id or uuid.uuid4().hex
+        self.kind = kind
+        self.session_id = session_id
+        self.status = QUEUED
+        self.frames_done = 0
+        self.frames_total = None
+        self.error = None
+        self.result_path = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+
+    def report_progress(self, frames_done, frames_total=None):
+        """
+        Progress callback handed to the job function, called with the number of frames done so far.
+        """
+        self.frames_done = frames_done
+        if frames_total is not None:
+            self.frames_total = frames_total
+
+    def is_finished(self):
+        return self.status in FINISHED_STATES
+
+    def to_dict(self):
+        progress = None
+        if self.frames_total:
+            progress = round(100.0 * self.frames_done / self.frames_total, 1)
+
+        return {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'session_id': self.session_id,
+            'status': self.status,
+            'frames_done': self.frames_done,
+            'frames_total': self.frames_total,
+            'progress': progress,
+            'error': self.error,
+            'has_result': self.result_path is not None and os.path.exists(self.result_path),
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data['kind'], session_id=data.get('session_id'), job_id=data['job_id'])
+        for key in ('status', 'frames_done', 'frames_total', 'error', 'created_at', 'started_at', 'finished_at'):
+            setattr(job, key, data.get(key))
+        return job
+
+
+# Job manager
+class JobManager:
+    def __init__(self, results_folder, max_workers=2):
+        """
+        Run jobs on a thread pool and persist their status and results under results_folder/<job_id>/,
+        so finished results can still be downloaded after a restart.
+
+        Args:
+            results_folder (str): Folder where job metadata and results are written.
+            max_workers (int): Number of jobs that may run at the same time.
+        """
+        self.results_folder = results_folder
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="annot-job")
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.results_folder):
+            os.makedirs(self.results_folder)
+
+        self.load_persisted_jobs()
+
+    def job_folder(self, job_id):
+        return os.path.join(self.results_folder, job_id)
+
+    def submit(self, kind, func, session_id=None):
+        """
+        Queue a job. The function is called with the Job so it can report progress, check
+        job.cancel_event and write its result into the job folder.
+
+        Args:
+            kind (str): What the job does.
+            func (callable): func(job, job_folder) -> path of the result file.
+            session_id (str): The annotation session the job belongs to.
+
+        Returns:
+            Job: The queued job.
+        """
+        job = Job(kind, session_id=session_id)
+        os.makedirs(self.job_folder(job.job_id), exist_ok=True)
+
+        with self.lock:
+            self.jobs[job.job_id] = job
+        self.persist(job)
+
+        self.executor.submit(self._run, job, func)
+        return job
+
+    def _run(self, job, func):
+        if job.cancel_event.is_set():
+            job.status = CANCELLED
+            job.finished_at = time.time()
+            self.persist(job)
+            return
+
+        job.status = RUNNING
+        job.started_at = time.time()
+        self.persist(job)
+
+        try:
+            job.result_path = func(job, self.job_folder(job.job_id))
+            job.status = CANCELLED if job.cancel_event.is_set() else COMPLETED
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            if job.cancel_event.is_set():
+                # The function gave up because of the cancellation
+                job.status = CANCELLED
+                return
+            logger.error(f"Error in {job.kind} job {job.job_id}: {str(e)}")
+            job.status = FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            self.persist(job)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self, session_id=None):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return [job for job in jobs if session_id is None or job.session_id == session_id]
+
+    def active_sessions(self):
+        """
+        Return the IDs of the sessions that have queued or running jobs.
+        """
+        with self.lock:
+            return {job.session_id for job in self.jobs.values() if not job.is_finished()}
+
+    def cancel(self, job_id):
+        """
+        Request cancellation of a job. Queued jobs never start, running jobs stop at their next check.
+        """
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(f"Unknown job {job_id}")
+        if not job.is_finished():
+            job.cancel_event.set()
+        return job
+
+    def persist(self, job):
+        """
+        Write the job metadata next to its result.
+        """
+        data = job.to_dict()
+        data['result_path'] = job.result_path
+        metadata_path = os.path.join(self.job_folder(job.job_id), "job.json")
+        with open(metadata_path, "w") as f:
+            json.dump(data, f)
+
+    def load_persisted_jobs(self):
+        """
+        Reload the jobs of previous runs. Jobs that were still queued or running when the server
+        stopped are marked as failed.
+        """
+        for job_id in os.listdir(self.results_folder):
+            metadata_path = os.path.join(self.job_folder(job_id), "job.json")
+            if not os.path.exists(metadata_path):
+                continue
+
+            try:
+                with open(metadata_path) as f:
+                    data = json.load(f)
+                job = Job.from_dict(data)
+                job.result_path = data.get('result_path')
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Skipping unreadable job metadata {metadata_path}: {e}")
+                continue
+
+            if not job.is_finished():
+                job.status = FAILED
+                job.error = "Server stopped before the job finished"
+                self.persist(job)
+
+            self.jobs[job.job_id] = job
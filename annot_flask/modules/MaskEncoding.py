@@ -0,0 +1,142 @@
+import base64
+import cv2
+import numpy as np
+from .Metrics import metrics
+
+# Wire formats a client can negotiate for binary masks.
+#   list - nested JSON list of booleans (legacy format, kept for compatibility)
+#   rle  - COCO-style uncompressed run-length encoding (column-major counts)
+#   bits - bit-packed mask, base64 encoded
+#   png  - single-channel PNG, base64 encoded
+MASK_FORMATS = ("list", "rle", "bits", "png")
+DEFAULT_MASK_FORMAT = "list"
+
+
+def rle_encode(mask):
+    """
+    Run-length encode a binary mask the way COCO does: the mask is flattened in
+    column-major (Fortran) order and the counts alternate between runs of zeros
+    and runs of ones, always starting with a (possibly empty) run of zeros.
+
+    Args:
+        mask (np.array): 2D binary mask of shape (H, W).
+
+    Returns:
+        dict: {'size': [H, W], 'counts': [int, ...]}
+    """
+    mask = np.asarray(mask, dtype=bool)
+    h, w = mask.shape
+    flat = mask.ravel(order="F")
+
+    if flat.size == 0:
+        return {"size": [h, w], "counts": []}
+
+    # Positions where the value changes mark the run boundaries
+    boundaries = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate(([0], boundaries, [flat.size]))
+    counts = np.diff(boundaries)
+
+    # COCO counts always start with the number of zeros
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+
+    return {"size": [h, w], "counts": counts.tolist()}
+
+
+def rle_decode(rle):
+    """
+    Decode a COCO-style uncompressed RLE back into a binary mask.
+
+    Args:
+        rle (dict): {'size': [H, W], 'counts': [int, ...]}
+
+    Returns:
+        np.array: Boolean mask of shape (H, W).
+    """
+    h, w = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+
+    # Runs alternate 0, 1, 0, 1, ... starting with zeros
+    values = (np.arange(counts.size) % 2).astype(bool)
+    flat = np.repeat(values, counts)
+
+    if flat.size != h * w:
+        raise ValueError(f"RLE counts sum to {flat.size}, expected {h * w} for size {[h, w]}")
+
+    return flat.reshape((h, w), order="F")
+
+
+def encode_mask(mask, mask_format=DEFAULT_MASK_FORMAT):
+    """
+    Encode a binary mask for the JSON wire format negotiated with the client.
+
+    Args:
+        mask (np.array): 2D binary mask of shape (H, W).
+        mask_format (str): One of MASK_FORMATS.
+
+    Returns:
+        list or dict: The nested list for 'list', otherwise a dict tagged with its 'format'.
+    """
+    with metrics.time('serialize'):
+        return _encode_mask(mask, mask_format)
+
+
+def _encode_mask(mask, mask_format):
+    if mask_format == "list":
+        return np.asarray(mask).tolist()
+
+    mask = np.asarray(mask, dtype=bool)
+    if mask.ndim != 2:
+        raise ValueError(f"Expected a 2D mask, got shape {mask.shape}")
+    h, w = mask.shape
+
+    if mask_format == "rle":
+        encoded = rle_encode(mask)
+    elif mask_format == "bits":
+        packed = np.packbits(mask.ravel())
+        encoded = {"size": [h, w], "data": base64.b64encode(packed.tobytes()).decode("ascii")}
+    elif mask_format == "png":
+        # Bilevel PNGs are 1 bit per pixel, which keeps the payload small
+        params = [cv2.IMWRITE_PNG_BILEVEL, 1] if hasattr(cv2, "IMWRITE_PNG_BILEVEL") else []
+        success, buffer = cv2.imencode(".png", mask.astype(np.uint8) * 255, params)
+        if not success:
+            raise ValueError("Could not encode mask as PNG")
+        encoded = {"size": [h, w], "data": base64.b64encode(buffer.tobytes()).decode("ascii")}
+    else:
+        raise ValueError(f"Unknown mask format '{mask_format}', expected one of {MASK_FORMATS}")
+
+    encoded["format"] = mask_format
+    return encoded
+
+
+def decode_mask(payload):
+    """
+    Decode a mask received from the client. The format is detected from the payload:
+    plain nested lists are the legacy format, dicts carry their 'format' tag
+    (a dict with 'counts' and no tag is treated as COCO RLE).
+
+    Args:
+        payload (list or dict): The encoded mask.
+
+    Returns:
+        np.array: Boolean mask of shape (H, W).
+    """
+    if not isinstance(payload, dict):
+        return np.asarray(payload).astype(bool)
+
+    mask_format = payload.get("format", "rle" if "counts" in payload else None)
+    h, w = payload["size"]
+
+    if mask_format == "rle":
+        return rle_decode(payload)
+    elif mask_format == "bits":
+        packed = np.frombuffer(base64.b64decode(payload["data"]), dtype=np.uint8)
+        return np.unpackbits(packed, count=h * w).astype(bool).reshape(h, w)
+    elif mask_format == "png":
+        buffer = np.frombuffer(base64.b64decode(payload["data"]), dtype=np.uint8)
+        mask = cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+        if mask is None or mask.shape != (h, w):
+            raise ValueError(f"Could not decode PNG mask of size {[h, w]}")
+        return mask > 0
+    else:
+        raise ValueError(f"Unknown mask format '{mask_format}', expected one of {MASK_FORMATS}")
@@ -0,0 +1,219 @@
+import os
+import zlib
+import threading
+import numpy as np
+from .MaskEncoding import rle_encode, rle_decode
+
+
+# Mask store
+class MaskStore:
+    def __init__(self, video_key=None):
+        """
+        Server-side store of the binary masks of one video, indexed by (obj_id, frame_idx). Masks are kept
+        as COCO-style run-length counts, zlib compressed, so a full propagation of a long video takes a few
+        megabytes instead of a byte per pixel. Prompts and propagation write into it, the fetch endpoints
+        and the video export read from it.
+
+        Args:
+            video_key (str): Optional. Identifies the video the masks belong to, checked when loading.
+        """
+        self.video_key = video_key
+        self.frames = {}  # frame_idx -> {obj_id: (height, width, compressed uint32 counts)}
+        self.count = 0
+        self.nbytes = 0
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _compress(mask):
+        rle = rle_encode(mask)
+        height, width = rle['size']
+        counts = zlib.compress(np.asarray(rle['counts'], dtype=np.uint32).tobytes(), 1)
+        return height, width, counts
+
+    @staticmethod
+    def _decompress(entry):
+        height, width, counts = entry
+        counts = np.frombuffer(zlib.decompress(counts), dtype=np.uint32)
+        return rle_decode({'size': [height, width], 'counts': counts})
+
+    def put(self, obj_id, frame_idx, mask):
+        """
+        Store the mask of an object on a frame, replacing any previous one.
+
+        Args:
+            mask (np.array): Binary mask of shape (H, W) or (1, H, W).
+        """
+        mask = np.asarray(mask)
+        if mask.ndim == 3:
+            mask = mask[0]
+        entry = self._compress(mask)
+
+        with self.lock:
+            frame_masks = self.frames.setdefault(int(frame_idx), {})
+            previous = frame_masks.get(int(obj_id))
+            if previous is not None:
+                self.nbytes -= len(previous[2])
+                self.count -= 1
+            frame_masks[int(obj_id)] = entry
+            self.nbytes += len(entry[2])
+            self.count += 1
+
+    def put_frame(self, frame_idx, obj_ids, masks):
+        """
+        Store the masks of several objects on one frame, e.g. a SAM2 output.
+        """
+        for obj_id, mask in zip(obj_ids, masks):
+            self.put(obj_id, frame_idx, mask)
+
+    def get(self, obj_id, frame_idx):
+        """
+        Returns:
+            np.array: The boolean mask of shape (H, W), or None if there is none.
+        """
+        with self.lock:
+            entry = self.frames.get(int(frame_idx), {}).get(int(obj_id))
+        return None if entry is None else self._decompress(entry)
+
+    def get_frame(self, frame_idx, obj_ids=None):
+        """
+        Return {obj_id: mask} for every stored object (or the given ones) on a frame.
+        """
+        with self.lock:
+            entries = [(obj_id, entry) for obj_id, entry in self.frames.get(int(frame_idx), {}).items()
+                       if obj_ids is None or obj_id in obj_ids]
+        return {obj_id: self._decompress(entry) for obj_id, entry in sorted(entries)}
+
+    def remove(self, obj_id=None, frame_idx=None):
+        """
+        Drop the masks of an object, of a frame, of one (obj_id, frame_idx) pair, or all of them.
+        """
+        with self.lock:
+            frame_indices = list(self.frames) if frame_idx is None else [int(frame_idx)]
+            for idx in frame_indices:
+                frame_masks = self.frames.get(idx, {})
+                for key in [key for key in frame_masks if obj_id is None or key == int(obj_id)]:
+                    self.nbytes -= len(frame_masks.pop(key)[2])
+                    self.count -= 1
+                if not frame_masks:
+                    self.frames.pop(idx, None)
+
+    def object_entries(self, obj_id):
+        """
+        Return {frame_idx: compressed entry} of an object, e.g. to snapshot it. Entries are immutable, so
+        they can be shared with the snapshot.
+        """
+        with self.lock:
+            return {frame_idx: frame_masks[int(obj_id)] for frame_idx, frame_masks in self.frames.items()
+                    if int(obj_id) in frame_masks}
+
+    def replace_object(self, obj_id, entries):
+        """
+        Replace all masks of an object with entries returned by object_entries().
+        """
+        with self.lock:
+            self.remove(obj_id=obj_id)
+            for frame_idx, entry in entries.items():
+                self.frames.setdefault(frame_idx, {})[int(obj_id)] = entry
+                self.nbytes += len(entry[2])
+                self.count += 1
+
+    def clear(self, video_key=None):
+        with self.lock:
+            self.frames = {}
+            self.count = 0
+            self.nbytes = 0
+            self.video_key = video_key
+
+    def object_ids(self):
+        with self.lock:
+            return sorted({obj_id for frame_masks in self.frames.values() for obj_id in frame_masks})
+
+    def frame_indices(self, obj_id=None):
+        with self.lock:
+            return sorted(frame_idx for frame_idx, frame_masks in self.frames.items()
+                          if obj_id is None or int(obj_id) in frame_masks)
+
+    def __len__(self):
+        return self.count
+
+    def masks_by_frame(self):
+        """
+        Return a lazy {frame_idx: [(obj_id, mask entry), ...]} index for the video export. The entries are
+        decompressed with decode() when the frame is rendered.
+        """
+        with self.lock:
+            return {frame_idx: list(frame_masks.items()) for frame_idx, frame_masks in self.frames.items()}
+
+    def decode(self, entry):
+        return self._decompress(entry)
+
+    def describe(self):
+        with self.lock:
+            objects = {}
+            for frame_idx, frame_masks in self.frames.items():
+                for obj_id in frame_masks:
+                    objects.setdefault(obj_id, []).append(frame_idx)
+            return {
+                'video_key': self.video_key,
+                'masks': self.count,
+                'nbytes': self.nbytes,
+                'objects': [{
+                    'obj_id': obj_id,
+                    'frames': len(frames),
+                    'first_frame': min(frames),
+                    'last_frame': max(frames)
+                } for obj_id, frames in sorted(objects.items())]
+            }
+
+    def save(self, path):
+        """
+        Write the store to a single .npz file: an index of (obj_id, frame_idx, height, width, offset, length)
+        rows and all compressed counts concatenated. The file is written under a temporary name and renamed.
+        """
+        with self.lock:
+            keys = sorted((obj_id, frame_idx) for frame_idx, frame_masks in self.frames.items() for obj_id in frame_masks)
+            index = np.zeros((len(keys), 6), dtype=np.int64)
+            chunks = []
+            offset = 0
+            for row, (obj_id, frame_idx) in enumerate(keys):
+                height, width, counts = self.frames[frame_idx][obj_id]
+                index[row] = (obj_id, frame_idx, height, width, offset, len(counts))
+                chunks.append(counts)
+                offset += len(counts)
+            data = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+            video_key = self.video_key or ""
+
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, index=index, data=data, video_key=np.array(video_key))
+        os.replace(temp_path, path)
+
+    def load(self, path, video_key=None):
+        """
+        Replace the content of the store with a file written by save().
+
+        Returns:
+            bool: False if the file is missing or belongs to another video.
+        """
+        if not os.path.exists(path):
+            return False
+
+        with np.load(path) as saved:
+            saved_key = str(saved['video_key']) or None
+            if video_key is not None and saved_key != video_key:
+                return False
+            index = saved['index']
+            data = saved['data'].tobytes()
+
+        frames = {}
+        nbytes = 0
+        for obj_id, frame_idx, height, width, offset, length in index.tolist():
+            frames.setdefault(frame_idx, {})[obj_id] = (height, width, data[offset:offset + length])
+            nbytes += length
+
+        with self.lock:
+            self.frames = frames
+            self.count = len(index)
+            self.nbytes = nbytes
+            self.video_key = saved_key
+        return True
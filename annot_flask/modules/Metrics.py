@@ -0,0 +1,207 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+# Histogram
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Cumulative latency histogram in the Prometheus sense: a count per bucket upper bound, plus the
+        total count and sum of the observed values.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is the +Inf bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by linear interpolation inside its bucket, as Prometheus' histogram_quantile does.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+# Metrics registry
+class MetricsRegistry:
+    def __init__(self, namespace="annot", buckets=DEFAULT_BUCKETS):
+        """
+        Process-wide timing metrics. Every timed stage of the pipeline (upload, frame extraction, init_state,
+        prompts, propagation per frame, thresholding, serialization, export per frame) feeds a histogram,
+        HTTP requests feed another one per endpoint, and gauges are read from callbacks when the metrics
+        are rendered. The stages timed on the thread handling a request are also collected for that request,
+        for its Server-Timing header.
+
+        Args:
+            namespace (str): Prefix of the metric names.
+            buckets (tuple): Upper bounds of the histogram buckets, in seconds.
+        """
+        self.namespace = namespace
+        self.buckets = buckets
+        self.stages = {}    # stage -> Histogram
+        self.requests = {}  # (endpoint, method, status) -> Histogram
+        self.gauges = {}    # name -> (help, callback returning a number or {label value: number}, label name)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def observe(self, stage, seconds):
+        """
+        Record the duration of one run of a pipeline stage.
+        """
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+        timings = getattr(self.local, 'timings', None)
+        if timings is not None:
+            total, count = timings.get(stage, (0.0, 0))
+            timings[stage] = (total + seconds, count + 1)
+
+    @contextmanager
+    def time(self, stage):
+        """
+        Time the body of a with block as one run of a stage, also when it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe_request(self, endpoint, method, status, seconds):
+        key = (endpoint, method, str(status))
+        with self.lock:
+            histogram = self.requests.get(key)
+            if histogram is None:
+                histogram = self.requests[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def register_gauge(self, name, help_text, callback, label=None):
+        """
+        Add a gauge read when the metrics are rendered.
+
+        Args:
+            name (str): Metric name, without the namespace.
+            help_text (str): Description of the metric.
+            callback (callable): Returns the value, or {label value: value} when label is given.
+            label (str): Optional. Name of the label of a multi-valued gauge.
+        """
+        self.gauges[name] = (help_text, callback, label)
+
+    def begin_request(self):
+        """
+        Start collecting the stages timed on the current thread.
+        """
+        self.local.timings = {}
+
+    def end_request(self):
+        """
+        Stop collecting and return the stages timed on the current thread since begin_request().
+
+        Returns:
+            dict: {stage: (total seconds, number of runs)}
+        """
+        timings = getattr(self.local, 'timings', None) or {}
+        self.local.timings = None
+        return timings
+
+    @staticmethod
+    def server_timing(timings):
+        """
+        Format collected timings as a Server-Timing header value, durations in milliseconds.
+        """
+        entries = []
+        for stage, (total, count) in timings.items():
+            entry = f"{stage};dur={total * 1000:.1f}"
+            if count > 1:
+                entry += f';desc="{count} runs"'
+            entries.append(entry)
+        return ", ".join(entries)
+
+    def _render_histograms(self, lines, name, help_text, histograms):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in histograms:
+            label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+            cumulative = 0
+            for upper, bucket_count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += bucket_count
+                le = "+Inf" if upper == float('inf') else _format_value(upper)
+                lines.append(f'{name}_bucket{{{label_text},le="{le}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{label_text}}} {histogram.sum}")
+            lines.append(f"{name}_count{{{label_text}}} {histogram.count}")
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            stages = [((('stage', stage),), histogram) for stage, histogram in sorted(self.stages.items())]
+            requests = [((('endpoint', endpoint), ('method', method), ('status', status)), histogram)
+                        for (endpoint, method, status), histogram in sorted(self.requests.items())]
+
+        lines = []
+        self._render_histograms(lines, f"{self.namespace}_stage_duration_seconds",
+                                "Time spent in each stage of the annotation pipeline.", stages)
+        self._render_histograms(lines, f"{self.namespace}_request_duration_seconds",
+                                "Time spent handling HTTP requests.", requests)
+
+        for gauge, (help_text, callback, label) in sorted(self.gauges.items()):
+            try:
+                value = callback()
+            except Exception:
+                continue
+            name = f"{self.namespace}_{gauge}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            if label is None:
+                lines.append(f"{name} {value}")
+            else:
+                for label_value, label_metric in sorted(value.items()):
+                    lines.append(f'{name}{{{label}="{_escape(label_value)}"}} {label_metric}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Count, mean, p50 and p95 (from the histogram buckets) of every stage, in seconds.
+        """
+        with self.lock:
+            return {stage: {
+                'count': histogram.count,
+                'mean': histogram.sum / histogram.count if histogram.count else None,
+                'p50': histogram.quantile(0.5),
+                'p95': histogram.quantile(0.95)
+            } for stage, histogram in sorted(self.stages.items())}
+
+
+# The registry every module reports to
+metrics = MetricsRegistry()
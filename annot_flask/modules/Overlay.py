@@ -0,0 +1,116 @@
+import cv2
+import numpy as np
+
+# Opacity of the mask colors over the frame
+DEFAULT_ALPHA = 0.3
+
+# Color of objects without an entry in the color table (RGB)
+DEFAULT_COLOR = (128, 128, 128)
+
+
+def build_color_lut(colors, default_color=DEFAULT_COLOR):
+    """
+    Precompute a BGR color lookup table indexed by object ID from a {obj_id: [r, g, b]} dict, shaped
+    (256, 1, 3) for cv2.LUT. Entry 0 is the background.
+    """
+    lut = np.empty((256, 1, 3), dtype=np.uint8)
+    lut[:] = default_color[::-1]
+    lut[0] = 0
+    for obj_id, color in colors.items():
+        if 0 < int(obj_id) < 256:
+            lut[int(obj_id), 0] = np.array(color, dtype=np.uint8)[::-1]
+    return lut
+
+
+# Overlay renderer
+class OverlayRenderer:
+    def __init__(self, colors, alpha=DEFAULT_ALPHA, default_color=DEFAULT_COLOR):
+        """
+        Draw the masks of many objects over a frame in one pass: the masks are combined into a single
+        label map (later objects win where masks overlap), the label map is turned into a color image
+        through a precomputed lookup table, and only the labelled pixels take the blend, so every object
+        gets the same opacity and the rest of the frame is left untouched.
+
+        Args:
+            colors (dict): {obj_id: [r, g, b]} colors of the objects.
+            alpha (float): Opacity of the mask colors.
+            default_color (tuple): RGB color of objects without an entry in colors.
+        """
+        self.alpha = alpha
+        self.default_color = default_color
+        self.lut = build_color_lut(colors, default_color)
+
+    def color_of(self, obj_id):
+        obj_id = int(obj_id)
+        if 0 < obj_id < 256:
+            return self.lut[obj_id, 0]
+        return np.array(self.default_color[::-1], dtype=np.uint8)
+
+    def label_map(self, masks, frame_shape):
+        """
+        Combine the masks of a frame into one label map.
+
+        Args:
+            masks (list): [(obj_id, mask), ...] with binary masks of shape (H, W) or (1, H, W).
+            frame_shape (tuple): Shape of the frame, masks of another size are resized to it.
+
+        Returns:
+            tuple: (labels, lut) where labels is a uint8 map with 0 for the background, and lut the
+                (256, 1, 3) BGR table of the labels. Labels are the object IDs when they fit in 1..255
+                (using the precomputed table), otherwise the position of the object in masks plus one.
+        """
+        height, width = frame_shape[:2]
+        by_obj_id = len(masks) < 256 and all(0 < int(obj_id) < 256 for obj_id, _ in masks)
+        if by_obj_id:
+            lut = self.lut
+        else:
+            # Too many objects or IDs out of range, fall back to a per-frame table
+            masks = masks[-255:]
+            lut = np.zeros((256, 1, 3), dtype=np.uint8)
+
+        labels = np.zeros((height, width), dtype=np.uint8)
+        for i, (obj_id, mask) in enumerate(masks):
+            mask = np.asarray(mask)
+            if mask.ndim == 3:
+                mask = mask[0]
+            if mask.shape != (height, width):
+                mask = cv2.resize(mask.astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST)
+
+            label = int(obj_id) if by_obj_id else i + 1
+            np.copyto(labels, label, where=mask.astype(bool, copy=False))
+            if not by_obj_id:
+                lut[label, 0] = self.color_of(obj_id)
+        return labels, lut
+
+    def render(self, frame, masks, contours=False, contour_thickness=2):
+        """
+        Overlay the masks of a frame.
+
+        Args:
+            frame (np.array): BGR frame, left unchanged.
+            masks (list): [(obj_id, mask), ...] with binary masks of shape (H, W) or (1, H, W).
+            contours (bool): Also outline every object, in its color at full opacity.
+            contour_thickness (int): Outline thickness in pixels.
+
+        Returns:
+            np.array: The BGR frame with the overlay.
+        """
+        output = frame.copy()
+        if not masks:
+            return output
+
+        labels, lut = self.label_map(masks, frame.shape)
+        foreground = (labels != 0).view(np.uint8)
+
+        # One table lookup and one blend for all objects, copied back only where there is a mask
+        color_image = cv2.LUT(cv2.merge([labels, labels, labels]), lut)
+        blended = cv2.addWeighted(frame, 1.0 - self.alpha, color_image, self.alpha, 0)
+        cv2.copyTo(blended, foreground, output)
+
+        if contours:
+            for label in np.flatnonzero(np.bincount(labels.ravel(), minlength=256)[1:]) + 1:
+                object_mask = (labels == label).view(np.uint8)
+                found, _ = cv2.findContours(object_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+                cv2.drawContours(output, found, -1, lut[label, 0].tolist(), contour_thickness)
+
+        return output
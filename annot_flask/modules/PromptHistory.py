@@ -0,0 +1,194 @@
+import time
+import logging
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Entries of a SAM2 inference state that hold one value per object, keyed by the object's index
+OBJECT_STATE_KEYS = ("point_inputs_per_obj", "mask_inputs_per_obj", "output_dict_per_obj",
+                     "temp_output_dict_per_obj", "frames_tracked_per_obj")
+
+DEFAULT_HISTORY_BYTES = 256 * 1024 * 1024
+
+
+def copy_structure(value):
+    """
+    Copy the dicts and lists of a nested structure while sharing its tensors. SAM2 replaces the outputs
+    of a state rather than writing into their tensors, so such a copy stays valid while the state moves
+    on, and only tensors the state has since dropped cost memory (copy-on-write).
+    """
+    if isinstance(value, dict):
+        return {key: copy_structure(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(copy_structure(item) for item in value)
+    return value
+
+
+def iter_tensors(value):
+    if torch.is_tensor(value):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from iter_tensors(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from iter_tensors(item)
+
+
+def storage_sizes(tensors):
+    """
+    Return {storage: bytes} of the given tensors, so tensors sharing memory are counted once.
+    """
+    sizes = {}
+    for tensor in tensors:
+        storage = tensor.untyped_storage()
+        sizes[(tensor.device.type, tensor.device.index, storage.data_ptr())] = storage.nbytes()
+    return sizes
+
+
+# Object snapshot
+class ObjectSnapshot:
+    def __init__(self, object_state, masks, prompt=None, dirty_frames=None):
+        """
+        One object at one point of its history: its entries of the SAM2 inference state (inputs, outputs and
+        tracked frames), its compressed masks from the mask store, its last click prompt and the frames
+        prompted since it was last propagated. Tensors and masks are shared with the state, not copied.
+
+        Args:
+            object_state (dict): {key of OBJECT_STATE_KEYS: structure copied with copy_structure}.
+            masks (dict): {frame_idx: compressed mask entry} from MaskStore.object_entries().
+            prompt (tuple): Optional. (points, labels) of the last click prompt.
+            dirty_frames (set): Optional. Frames prompted since the last propagation.
+        """
+        self.object_state = object_state
+        self.masks = masks
+        self.prompt = prompt
+        self.dirty_frames = set(dirty_frames or ())
+
+    def tensors(self):
+        return iter_tensors(self.object_state)
+
+
+# Prompt history
+class PromptHistory:
+    def __init__(self, max_bytes=DEFAULT_HISTORY_BYTES):
+        """
+        Undo and redo history of the prompts of every object. Each entry holds the snapshot of the object
+        before and after one prompt, so undo and redo restore a snapshot instead of running the model again.
+        The memory the snapshots keep alive beyond the live inference state is capped: past max_bytes, the
+        oldest entries are dropped. Not thread-safe, used under the annotator's state lock.
+
+        Args:
+            max_bytes (int): Memory the snapshots may hold on to in tensors no longer used by the state.
+        """
+        self.max_bytes = max_bytes
+        self.entries = {}  # obj_id -> [(description, before, after)], oldest first
+        self.cursors = {}  # obj_id -> number of entries currently applied
+        self.sequence = 0
+        self.retained_bytes = 0
+        self.dropped = 0
+
+    def record(self, obj_id, description, before, after):
+        """
+        Append a prompt to the history of an object, dropping the entries it could have redone.
+
+        Args:
+            description (dict): What the prompt was, e.g. {'op': 'points', 'frame_idx': 3}.
+            before (ObjectSnapshot): The object before the prompt, None if it did not exist.
+            after (ObjectSnapshot): The object after the prompt.
+        """
+        self.sequence += 1
+        description = {**description, 'seq': self.sequence, 'time': time.time()}
+        entries = self.entries.setdefault(obj_id, [])
+        del entries[self.cursors.get(obj_id, 0):]
+        entries.append((description, before, after))
+        self.cursors[obj_id] = len(entries)
+
+    def can_undo(self, obj_id):
+        return self.cursors.get(obj_id, 0) > 0
+
+    def can_redo(self, obj_id):
+        return self.cursors.get(obj_id, 0) < len(self.entries.get(obj_id, ()))
+
+    def undo(self, obj_id):
+        """
+        Step back over the last applied prompt of an object.
+
+        Returns:
+            tuple: (description of the undone prompt, snapshot to restore, None to remove the object)
+        """
+        if not self.can_undo(obj_id):
+            raise ValueError(f"Nothing to undo for object {obj_id}")
+        self.cursors[obj_id] -= 1
+        description, before, _ = self.entries[obj_id][self.cursors[obj_id]]
+        return description, before
+
+    def redo(self, obj_id):
+        """
+        Step forward over the next undone prompt of an object.
+
+        Returns:
+            tuple: (description of the redone prompt, snapshot to restore)
+        """
+        if not self.can_redo(obj_id):
+            raise ValueError(f"Nothing to redo for object {obj_id}")
+        description, _, after = self.entries[obj_id][self.cursors[obj_id]]
+        self.cursors[obj_id] += 1
+        return description, after
+
+    def clear(self, obj_id=None):
+        if obj_id is None:
+            self.entries = {}
+            self.cursors = {}
+        else:
+            self.entries.pop(obj_id, None)
+            self.cursors.pop(obj_id, None)
+        self.retained_bytes = 0
+
+    def snapshots(self):
+        for entries in self.entries.values():
+            for _, before, after in entries:
+                for snapshot in (before, after):
+                    if snapshot is not None:
+                        yield snapshot
+
+    def measure(self, inference_state):
+        """
+        Return the bytes of the tensors held by the snapshots but no longer by the inference state.
+        """
+        live = storage_sizes(tensor for key in OBJECT_STATE_KEYS for tensor in iter_tensors(inference_state.get(key)))
+        held = storage_sizes(tensor for snapshot in self.snapshots() for tensor in snapshot.tensors())
+        return sum(size for key, size in held.items() if key not in live)
+
+    def enforce_budget(self, inference_state):
+        """
+        Drop entries until the snapshots fit in max_bytes: the oldest undoable entries first, then the
+        redoable entries furthest from the current state.
+        """
+        self.retained_bytes = self.measure(inference_state)
+        while self.retained_bytes > self.max_bytes and any(self.entries.values()):
+            undoable = [(entries[0][0]['seq'], obj_id) for obj_id, entries in self.entries.items()
+                        if self.cursors[obj_id] > 0]
+            if undoable:
+                _, obj_id = min(undoable)
+                self.entries[obj_id].pop(0)
+                self.cursors[obj_id] -= 1
+            else:
+                _, obj_id = max((entries[-1][0]['seq'], obj_id) for obj_id, entries in self.entries.items() if entries)
+                self.entries[obj_id].pop()
+            self.dropped += 1
+            self.retained_bytes = self.measure(inference_state)
+        return self.retained_bytes
+
+    def describe(self):
+        return {
+            'objects': {obj_id: {
+                'entries': [description for description, _, _ in entries],
+                'position': self.cursors.get(obj_id, 0),
+                'can_undo': self.can_undo(obj_id),
+                'can_redo': self.can_redo(obj_id)
+            } for obj_id, entries in self.entries.items()},
+            'retained_bytes': self.retained_bytes,
+            'max_bytes': self.max_bytes,
+            'dropped_entries': self.dropped
+        }
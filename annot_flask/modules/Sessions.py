@@ -0,0 +1,341 @@
+import os
+import re
+import logging
+import time
+import threading
+from collections import OrderedDict
+import torch
+from .Annotation import AnnotationModule, check_tracking_api
+from .PromptHistory import DEFAULT_HISTORY_BYTES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSION_ID = "default"
+
+# Session IDs come from the clients and name the files of the offload folder, so only these are accepted
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+# Lifecycle of the shared model
+MODEL_LOADING = "loading"
+MODEL_READY = "ready"
+MODEL_FAILED = "failed"
+
+
+def state_nbytes(obj):
+    """
+    Estimate the memory held by an inference state by summing the sizes of all tensors
+    reachable from it (nested dicts, lists and tuples included).
+    """
+    if torch.is_tensor(obj):
+        return obj.element_size() * obj.nelement()
+    if callable(getattr(obj, "nbytes", None)):
+        # Lazily loaded frames report their resident size
+        return obj.nbytes()
+    if isinstance(obj, dict):
+        return sum(state_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(state_nbytes(v) for v in obj)
+    return 0
+
+
+def validate_session_id(session_id):
+    """
+    Return the session ID if it matches SESSION_ID_PATTERN, raise ValueError otherwise.
+    """
+    if not isinstance(session_id, str) or SESSION_ID_PATTERN.fullmatch(session_id) is None:
+        raise ValueError("Invalid session ID, expected 1 to 64 letters, digits, '_' or '-'")
+    return session_id
+
+
+# Deferred predictor
+class DeferredPredictor:
+    def __init__(self, load):
+        """
+        Stand-in for the SAM2 predictor while it is loaded, so the server can answer health checks, take
+        uploads and extract frames before the weights are in memory. Attribute lookups are forwarded to the
+        loaded predictor and block until it is ready, or raise if loading failed.
+
+        Args:
+            load (callable): Builds and returns the predictor.
+        """
+        self.model_loader = load
+        self.loaded_predictor = None
+        self.model_status = MODEL_LOADING
+        self.model_error = None
+        self.model_load_seconds = None
+        self.model_loading_started = None
+        self.model_loaded = threading.Event()  # Set once loading succeeded or failed
+
+    def load_model(self):
+        self.model_loading_started = time.time()
+        try:
+            self.loaded_predictor = self.model_loader()
+            self.model_status = MODEL_READY
+        except Exception as e:
+            logger.error(f"Error loading the SAM2 model: {e}")
+            self.model_error = str(e)
+            self.model_status = MODEL_FAILED
+            raise
+        finally:
+            self.model_load_seconds = time.time() - self.model_loading_started
+            self.model_loaded.set()
+
+    def start_loading(self):
+        def load():
+            try:
+                self.load_model()
+            except Exception:
+                pass  # Reported through model_status
+
+        threading.Thread(target=load, name="annot-model-loader", daemon=True).start()
+
+    def wait_until_loaded(self, timeout=None):
+        """
+        Returns:
+            bool: True once the predictor is ready, False on timeout or if loading failed.
+        """
+        self.model_loaded.wait(timeout)
+        return self.model_status == MODEL_READY
+
+    def describe_model(self):
+        load_seconds = self.model_load_seconds
+        if load_seconds is None and self.model_loading_started is not None:
+            load_seconds = time.time() - self.model_loading_started  # Still loading
+        return {'status': self.model_status, 'error': self.model_error, 'load_seconds': load_seconds}
+
+    def __getattr__(self, name):
+        # Only called for attributes not set in __init__, i.e. those of the predictor
+        if not self.wait_until_loaded():
+            raise RuntimeError(f"The SAM2 model failed to load: {self.model_error}")
+        return getattr(self.loaded_predictor, name)
+
+
+# Session manager
+class SessionManager:
+    def __init__(self, model_cfg, checkpoint, device, memory_budget_bytes, offload_folder, feature_cache=None,
+                 inference_profile=None, load_in_background=False, history_memory_bytes=DEFAULT_HISTORY_BYTES,
+                 inference_worker=None, job_manager=None):
+        """
+        Keep one AnnotationModule per annotation session. All sessions share a single SAM2 predictor,
+        so the model weights are only loaded once, while each session keeps its own inference state,
+        frames and prompts.
+
+        Args:
+            model_cfg (str): Path to the SAM2 model config.
+            checkpoint (str): Path to the SAM2 checkpoint.
+            device (str): Device the predictor runs on.
+            memory_budget_bytes (int): Total memory the inference states may use before idle sessions
+                are offloaded to disk, least recently used first.
+            offload_folder (str): Folder where offloaded inference states and the prompt history logs
+                of the sessions are written.
+            feature_cache (FeatureCache): Optional. Cache of image features shared by all sessions.
+            inference_profile (InferenceProfile): Optional. Loads and warms up the predictor and sets the
+                precision the sessions run it at.
+            load_in_background (bool): Optional. Load the model on a background thread. Sessions can be
+                created meanwhile, their model calls wait for it (see DeferredPredictor).
+            history_memory_bytes (int): Optional. Memory the undo/redo snapshots of each session may hold.
+            inference_worker (InferenceWorker): Optional. Runs the image encoder passes of all sessions,
+                batching the concurrent ones.
+            job_manager (JobManager): Optional. Sessions with queued or running jobs are never offloaded,
+                the jobs keep using their inference state.
+        """
+        self.model_cfg = model_cfg
+        self.checkpoint = checkpoint
+        self.device = device
+        self.memory_budget_bytes = memory_budget_bytes
+        self.offload_folder = offload_folder
+        self.inference_profile = inference_profile
+        self.feature_cache = feature_cache
+        self.history_memory_bytes = history_memory_bytes
+        self.inference_worker = inference_worker
+        self.job_manager = job_manager
+        self.predictor = DeferredPredictor(self.load_predictor)
+        if load_in_background:
+            self.predictor.start_loading()
+        else:
+            self.predictor.load_model()
+        self.sessions = OrderedDict()  # session_id -> AnnotationModule, least recently used first
+        self.last_used = {}  # session_id -> timestamp of the last access
+        self.in_use = {}  # session_id -> number of requests using the session, see get(pin=True) and release()
+        self.lock = threading.RLock()
+
+        if not os.path.exists(self.offload_folder):
+            os.makedirs(self.offload_folder)
+
+    def load_predictor(self):
+        """
+        Build the shared predictor, route its encoder passes through the inference worker and the feature
+        cache, and warm it up.
+        """
+        if self.inference_profile is not None:
+            predictor = self.inference_profile.build_predictor()
+        else:
+            from sam2.build_sam import build_sam2_video_predictor
+            predictor = build_sam2_video_predictor(self.model_cfg, self.checkpoint, device=self.device)
+
+        # Installed first, so features found in the cache never reach the worker
+        if self.inference_worker is not None:
+            self.inference_worker.install(predictor)
+        if self.feature_cache is not None:
+            self.feature_cache.install(predictor)
+        if self.inference_profile is not None:
+            self.inference_profile.warm_up(predictor)
+
+        tracking_api_problems = check_tracking_api(predictor)
+        if tracking_api_problems:
+            logger.warning("This SAM2 version lacks the internals incremental and sparse propagation use, they "
+                           f"fall back to full propagation: {'; '.join(tracking_api_problems)}")
+        return predictor
+
+    def get(self, session_id=DEFAULT_SESSION_ID, pin=False):
+        """
+        Return the annotator of a session, creating it on first use and restoring its inference
+        state if it was offloaded. Accessing a session marks it as most recently used.
+
+        Args:
+            session_id (str): Optional. ID of the session.
+            pin (bool): Optional. Keep the session from being offloaded until release() is called, for
+                callers using its inference state over a whole request.
+        """
+        validate_session_id(session_id)
+        with self.lock:
+            annotator = self.sessions.get(session_id)
+            if annotator is None:
+                logger.info(f"Creating annotation session {session_id}")
+                annotator = AnnotationModule(self.model_cfg, self.checkpoint, self.device, predictor=self.predictor,
+                                             feature_cache=self.feature_cache, inference_profile=self.inference_profile,
+                                             history_max_bytes=self.history_memory_bytes,
+                                             history_log_path=self.history_log_path(session_id))
+                self.sessions[session_id] = annotator
+
+            self.sessions.move_to_end(session_id)
+            self.last_used[session_id] = time.time()
+            if pin:
+                # Taken before the restore below, so the restored state cannot be offloaded again meanwhile
+                self.in_use[session_id] = self.in_use.get(session_id, 0) + 1
+
+        if annotator.is_offloaded():
+            try:
+                self.restore(session_id)
+            except Exception:
+                if pin:
+                    self.release(session_id)
+                raise
+
+        return annotator
+
+    def release(self, session_id):
+        """
+        Undo one get(pin=True) of a session.
+        """
+        with self.lock:
+            count = self.in_use.get(session_id, 0) - 1
+            if count > 0:
+                self.in_use[session_id] = count
+            else:
+                self.in_use.pop(session_id, None)
+
+    def history_log_path(self, session_id):
+        return os.path.join(self.offload_folder, f"{validate_session_id(session_id)}.history.jsonl")
+
+    def memory_usage(self):
+        """
+        Return the estimated memory of the resident inference states, and of the tensors only their
+        prompt history still holds, per session.
+        """
+        with self.lock:
+            return {session_id: state_nbytes(annotator.inference_state) + annotator.prompt_history.retained_bytes
+                    for session_id, annotator in self.sessions.items()}
+
+    def enforce_budget(self, keep=None):
+        """
+        Offload idle sessions, least recently used first, until the resident inference states fit in the
+        memory budget. The session given in 'keep' and sessions busy with a request or a job are never evicted.
+        """
+        with self.lock:
+            usage = self.memory_usage()
+            total = sum(usage.values())
+            busy = self.busy_sessions()
+
+            for session_id in list(self.sessions.keys()):
+                if total <= self.memory_budget_bytes:
+                    break
+                if session_id == keep or session_id in busy or usage[session_id] == 0:
+                    continue
+                if self.offload(session_id):
+                    total -= usage[session_id]
+
+            return total
+
+    def offload(self, session_id):
+        """
+        Write the inference state of a session to disk and free it from memory. Sessions that are busy,
+        or whose inference state is in use, are left in memory.
+
+        Returns:
+            bool: True if the session was offloaded, False if it was busy or had nothing to offload.
+        """
+        with self.lock:
+            annotator = self.sessions.get(session_id)
+            if annotator is None:
+                raise KeyError(f"Unknown session {session_id}")
+            if session_id in self.busy_sessions():
+                return False
+
+            # Under the lock, so no request can pin the session between the check and the offload, and without
+            # waiting for the state lock, so a long propagation never holds up the other sessions
+            return annotator.offload_inference_state(self.offload_path(session_id), blocking=False)
+
+    def offload_path(self, session_id):
+        return os.path.join(self.offload_folder, f"{validate_session_id(session_id)}.pt")
+
+    def busy_sessions(self):
+        """
+        Return the IDs of the sessions whose inference state a request or a queued or running job will read.
+        """
+        with self.lock:
+            busy = set(self.in_use)
+        if self.job_manager is not None:
+            busy |= self.job_manager.active_sessions()
+        return busy
+
+    def restore(self, session_id):
+        """
+        Load an offloaded inference state back into memory, making room for it first.
+        """
+        with self.lock:
+            annotator = self.sessions.get(session_id)
+        if annotator is None:
+            raise KeyError(f"Unknown session {session_id}")
+
+        annotator.restore_inference_state()
+        self.enforce_budget(keep=session_id)
+
+    def remove(self, session_id):
+        """
+        Drop a session and its offloaded state, if any.
+        """
+        history_log_path = self.history_log_path(session_id)
+        with self.lock:
+            annotator = self.sessions.pop(session_id, None)
+            self.last_used.pop(session_id, None)
+        if annotator is None:
+            raise KeyError(f"Unknown session {session_id}")
+
+        annotator.discard_offloaded_state()
+        if os.path.exists(history_log_path):
+            os.remove(history_log_path)
+
+    def describe(self):
+        """
+        Summarize all sessions for the /sessions endpoint.
+        """
+        with self.lock:
+            usage = self.memory_usage()
+            return [{
+                'session_id': session_id,
+                'video': annotator.current_video_path,
+                'state_bytes': usage[session_id],
+                'offloaded': annotator.is_offloaded(),
+                'last_used': self.last_used.get(session_id)
+            } for session_id, annotator in self.sessions.items()]
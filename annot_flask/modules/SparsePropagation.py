@@ -0,0 +1,107 @@
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# How sparse propagation picks its keyframes, the frames the model runs on:
+#   stride - every keyframe_stride frames
+#   motion - also earlier, as soon as the frames changed by more than the motion budget since the last keyframe
+KEYFRAME_MODES = ("stride", "motion")
+DEFAULT_KEYFRAME_MODE = "motion"
+DEFAULT_KEYFRAME_STRIDE = 8
+
+# Quality knob of sparse propagation, between 0 and 1. The masks of two consecutive keyframes must overlap by
+# at least this IoU, otherwise keyframes are added in between, so the interpolated masks never stray further
+# from both ends than that. 0 keeps the keyframes as picked, 1 runs the model on nearly every frame.
+DEFAULT_SPARSE_QUALITY = 0.9
+
+# Accumulated mean absolute difference of the normalized frames (about 57 gray levels per unit) allowed between
+# keyframes in motion mode, at quality 0; it shrinks linearly to 0 at quality 1
+MOTION_BUDGET = 1.0
+
+# Side of the downscaled grayscale frames the motion is measured on
+MOTION_THUMBNAIL_SIZE = 32
+
+
+def motion_thumbnail(image):
+    """
+    Downscaled grayscale copy of a preprocessed frame of shape (3, S, S), to measure motion on.
+    """
+    gray = image.float().mean(dim=0, keepdim=True).unsqueeze(0)
+    return F.adaptive_avg_pool2d(gray, MOTION_THUMBNAIL_SIZE)[0, 0]
+
+
+def frame_difference(thumbnail_a, thumbnail_b):
+    return float((thumbnail_a - thumbnail_b).abs().mean())
+
+
+def signed_distance(mask):
+    """
+    Distance of every pixel to the outline of a binary mask, positive inside and negative outside.
+    """
+    mask = mask.astype(np.uint8)
+    inside = cv2.distanceTransform(mask, cv2.DIST_L2, 3)
+    outside = cv2.distanceTransform(1 - mask, cv2.DIST_L2, 3)
+    return inside - outside
+
+
+def interpolate_mask(mask_a, mask_b, weight, distance_a=None, distance_b=None):
+    """
+    Mask between two keyframe masks, weight going from 0 (mask_a) to 1 (mask_b). The signed distances of
+    both outlines are blended, so the shape morphs from one to the other instead of cross-fading. When the
+    object is missing from one side, the nearest keyframe's mask is used.
+
+    Args:
+        distance_a, distance_b (np.array): Optional. signed_distance() of the masks, if already computed.
+    """
+    if not mask_a.any() or not mask_b.any():
+        return (mask_a if weight < 0.5 else mask_b).copy()
+    if distance_a is None:
+        distance_a = signed_distance(mask_a)
+    if distance_b is None:
+        distance_b = signed_distance(mask_b)
+    return (1.0 - weight) * distance_a + weight * distance_b > 0
+
+
+# Keyframe memory
+class KeyframeMemory(dict):
+    def __init__(self, output_dict, frame_idx, keyframes, reverse):
+        """
+        The output dict of one object as SAM2's memory attention sees it from a frame of a sparse propagation.
+        SAM2 looks its memories up at the frames right before the current one (frame_idx - 1, - 2, ...);
+        here the n-th frame before holds the outputs of the n-th keyframe before, so the memory bank holds the
+        same number of recent frames as in a dense propagation, as if the video only had its keyframes.
+
+        The non-conditioning outputs are copied into a plain dict for the frame, so lookups, membership tests
+        and iteration all agree whichever way SAM2 reads them. The copy shares the output tensors; tracking
+        results are stored in output_dict itself.
+
+        Args:
+            output_dict (dict): The object's entry of the inference state's output_dict_per_obj.
+            frame_idx (int): Frame being tracked.
+            keyframes (list): Keyframes already tracked in this pass, in processing order.
+            reverse (bool): Whether the pass runs backwards.
+        """
+        non_cond_outputs = output_dict["non_cond_frame_outputs"]
+        memory_outputs = dict(non_cond_outputs)
+        for offset, keyframe in enumerate(reversed(keyframes), 1):
+            memory_frame_idx = frame_idx + offset if reverse else frame_idx - offset
+            if keyframe in non_cond_outputs:
+                memory_outputs[memory_frame_idx] = non_cond_outputs[keyframe]
+            else:
+                memory_outputs.pop(memory_frame_idx, None)  # A prompted keyframe, SAM2 reads it as conditioning
+        super().__init__(output_dict, non_cond_frame_outputs=memory_outputs)
+
+
+def tracking_order(start_frame_idx, max_frame_num_to_track, num_frames, reverse):
+    """
+    Frames a SAM2 propagate_in_video call with the same arguments processes, in order.
+    """
+    if max_frame_num_to_track is None:
+        max_frame_num_to_track = num_frames
+    if reverse:
+        end_frame_idx = max(start_frame_idx - max_frame_num_to_track, 0)
+        # SAM2 does not track backwards from frame 0
+        return list(range(start_frame_idx, end_frame_idx - 1, -1)) if start_frame_idx > 0 else []
+    end_frame_idx = min(start_frame_idx + max_frame_num_to_track, num_frames - 1)
+    return list(range(start_frame_idx, end_frame_idx + 1))
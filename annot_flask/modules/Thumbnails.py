@@ -0,0 +1,79 @@
+import os
+import threading
+import cv2
+import numpy as np
+
+# Widths thumbnails are made at. Requested widths are rounded up to one of them, so a few files per frame
+# cover every zoom level of the timeline and the disk cache stays bounded.
+THUMBNAIL_WIDTHS = (64, 128, 256, 512)
+THUMBNAIL_QUALITY = 80
+
+# Sprite sheets pack SPRITE_FRAMES thumbnails in rows of SPRITE_COLUMNS
+SPRITE_FRAMES = 100
+SPRITE_COLUMNS = 10
+
+
+def thumbnail_width(width):
+    """
+    Round a requested width up to the nearest available thumbnail width.
+    """
+    if width is None or width <= 0:
+        raise ValueError(f"width must be one of {list(THUMBNAIL_WIDTHS)} or smaller")
+    return next((w for w in THUMBNAIL_WIDTHS if w >= width), THUMBNAIL_WIDTHS[-1])
+
+
+def thumbnail_size(frame_size, width):
+    """
+    (width, height) of the thumbnails of frames of the given (width, height), keeping the aspect ratio.
+    Frames narrower than the thumbnail width are not upscaled.
+    """
+    frame_width, frame_height = frame_size
+    width = min(width, frame_width)
+    return width, max(1, round(frame_height * width / frame_width))
+
+
+def resize_frame(frame, size):
+    if (frame.shape[1], frame.shape[0]) == tuple(size):
+        return frame
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+
+def write_jpeg(path, image, quality=95):
+    """
+    Encode an image as JPEG and write it under a temporary name first, so concurrent requests never serve
+    a partial file.
+
+    Returns:
+        bool: False if the image could not be encoded.
+    """
+    success, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not success:
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(buffer.tobytes())
+    os.replace(temp_path, path)
+    return True
+
+
+def sprite_sheet(tiles, tile_size, columns=SPRITE_COLUMNS):
+    """
+    Pack thumbnails into one image, left to right and top to bottom. Missing tiles stay black.
+
+    Args:
+        tiles (list): BGR thumbnails of size tile_size, or None.
+        tile_size (tuple): (width, height) of a tile.
+        columns (int): Tiles per row.
+    """
+    tile_width, tile_height = tile_size
+    rows = max(1, -(-len(tiles) // columns))
+    sheet = np.zeros((rows * tile_height, min(columns, max(len(tiles), 1)) * tile_width, 3), dtype=np.uint8)
+    for i, tile in enumerate(tiles):
+        if tile is None:
+            continue
+        row, column = divmod(i, columns)
+        sheet[row * tile_height:(row + 1) * tile_height, column * tile_width:(column + 1) * tile_width] = \
+            resize_frame(tile, tile_size)
+    return sheet
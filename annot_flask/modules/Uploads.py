@@ -0,0 +1,328 @@
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from .Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks request bodies are read, hashed and written in
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Name of the stored video in its content folder, followed by the extension of the first uploaded file
+STORED_VIDEO_NAME = "source"
+
+_SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class UploadOffsetError(Exception):
+    """
+    Raised when a chunk does not start where the upload currently ends, e.g. after a lost response.
+    The client resumes from the upload's offset.
+    """
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+
+def video_extension(filename):
+    """
+    Lower-cased extension of an uploaded file name, only kept if it is a plain alphanumeric one.
+    """
+    extension = os.path.splitext(filename or "")[1].lower()
+    return extension if re.match(r"^\.[a-z0-9]{1,8}$", extension) else ".mp4"
+
+
+# Chunked upload
+class ChunkedUpload:
+    def __init__(self, upload_id, filename, total_size=None, created_at=None, existing_hash=None):
+        """
+        A resumable upload: chunks are appended at the current offset and hashed as they are written, so the
+        content hash is known as soon as the last chunk arrives.
+
+        Args:
+            upload_id (str): ID of the upload.
+            filename (str): Name of the file on the client, only its extension is kept.
+            total_size (int): Optional. Announced size of the file, chunks past it are refused.
+            created_at (float): Optional. Start time, kept when the upload is reloaded after a restart.
+            existing_hash (str): Optional. Set when the client announced a hash that is already stored,
+                no chunks are needed then.
+        """
+        self.upload_id = upload_id
+        self.filename = filename
+        self.total_size = total_size
+        self.created_at = created_at or time.time()
+        self.existing_hash = existing_hash
+        self.offset = 0
+        self.digest = hashlib.sha256()
+        self.lock = threading.Lock()  # Held while a chunk is written
+
+    def to_dict(self):
+        return {
+            'upload_id': self.upload_id,
+            'filename': self.filename,
+            'offset': self.offset,
+            'total_size': self.total_size,
+            'exists': self.existing_hash is not None,
+            'created_at': self.created_at
+        }
+
+
+# Upload store
+class UploadStore:
+    def __init__(self, folder, upload_ttl=24 * 3600):
+        """
+        Content-addressed storage of the uploaded videos. Every video is stored once under folder/<sha256>/,
+        next to the frames extracted from it, whatever its name on the client, so uploading the same video
+        twice reuses the stored file, its frames and (through the content hash) its cached image features,
+        and different videos with the same name never overwrite each other.
+
+        Videos arrive either in one request (store_stream) or as a resumable chunked upload (begin, append,
+        complete), whose partial data lives in folder/partial/ until it is complete.
+
+        Args:
+            folder (str): Folder of the stored videos.
+            upload_ttl (float): Seconds after which unfinished chunked uploads are discarded.
+        """
+        self.folder = folder
+        self.partial_folder = os.path.join(folder, "partial")
+        self.upload_ttl = upload_ttl
+        self.uploads = {}  # upload_id -> ChunkedUpload
+        self.lock = threading.Lock()
+
+        os.makedirs(self.partial_folder, exist_ok=True)
+
+    def video_folder(self, video_hash):
+        return os.path.join(self.folder, video_hash)
+
+    def find(self, video_hash):
+        """
+        Return the path of the stored video with the given content hash, or None if it was never uploaded.
+        """
+        if not _SHA256_PATTERN.match(video_hash or ""):
+            return None
+        folder = self.video_folder(video_hash)
+        if not os.path.isdir(folder):
+            return None
+        for name in os.listdir(folder):
+            if os.path.splitext(name)[0] == STORED_VIDEO_NAME and os.path.isfile(os.path.join(folder, name)):
+                return os.path.join(folder, name)
+        return None
+
+    def commit(self, temp_path, video_hash, filename):
+        """
+        Move a fully received file to its content folder, or drop it if the same content is already stored.
+
+        Returns:
+            tuple: (video_path, deduplicated)
+        """
+        with self.lock:
+            video_path = self.find(video_hash)
+            if video_path is not None:
+                os.remove(temp_path)
+                logger.info(f"Upload of {filename} matches stored video {video_hash[:12]}, reusing it")
+                return video_path, True
+
+            folder = self.video_folder(video_hash)
+            os.makedirs(folder, exist_ok=True)
+            video_path = os.path.join(folder, STORED_VIDEO_NAME + video_extension(filename))
+            os.replace(temp_path, video_path)
+            logger.info(f"Stored upload of {filename} as video {video_hash[:12]}")
+            return video_path, False
+
+    def store_stream(self, stream, filename):
+        """
+        Store a video sent in a single request, hashing it while it is written.
+
+        Returns:
+            tuple: (video_path, video_hash, deduplicated)
+        """
+        temp_path = os.path.join(self.partial_folder, f"{uuid.uuid4().hex}.part")
+        digest = hashlib.sha256()
+        try:
+            with metrics.time('upload_save'), open(temp_path, "wb") as f:
+                for block in iter(lambda: stream.read(UPLOAD_BLOCK_SIZE), b""):
+                    f.write(block)
+                    digest.update(block)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        video_hash = digest.hexdigest()
+        video_path, deduplicated = self.commit(temp_path, video_hash, filename)
+        return video_path, video_hash, deduplicated
+
+    def part_path(self, upload_id):
+        return os.path.join(self.partial_folder, f"{upload_id}.part")
+
+    def metadata_path(self, upload_id):
+        return os.path.join(self.partial_folder, f"{upload_id}.json")
+
+    def begin(self, filename, total_size=None, sha256=None):
+        """
+        Start a chunked upload. When the client already knows the hash of its file and that content is
+        stored, the upload is complete right away and no chunks need to be sent.
+
+        Returns:
+            ChunkedUpload: The new upload.
+        """
+        if total_size is not None and total_size < 0:
+            raise ValueError("size must not be negative")
+        self.remove_stale()
+
+        existing_hash = sha256.lower() if sha256 and self.find(sha256.lower()) is not None else None
+        upload = ChunkedUpload(uuid.uuid4().hex, filename, total_size=total_size, existing_hash=existing_hash)
+
+        if existing_hash is None:
+            open(self.part_path(upload.upload_id), "wb").close()
+        with open(self.metadata_path(upload.upload_id), "w") as f:
+            json.dump({'filename': filename, 'total_size': total_size, 'created_at': upload.created_at,
+                       'existing_hash': existing_hash}, f)
+
+        with self.lock:
+            self.uploads[upload.upload_id] = upload
+        return upload
+
+    def get(self, upload_id):
+        """
+        Return an unfinished upload, reloading it from disk if it was started before a restart (its hash
+        is then recomputed from the data received so far).
+
+        Raises:
+            KeyError: If there is no such upload.
+        """
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is not None:
+                return upload
+
+            metadata_path = self.metadata_path(upload_id)
+            if not re.match(r"^[0-9a-f]{32}$", upload_id) or not os.path.exists(metadata_path):
+                raise KeyError(f"Unknown upload {upload_id}")
+
+            with open(metadata_path) as f:
+                data = json.load(f)
+            upload = ChunkedUpload(upload_id, data.get('filename'), total_size=data.get('total_size'),
+                                   created_at=data.get('created_at'), existing_hash=data.get('existing_hash'))
+            part_path = self.part_path(upload_id)
+            if upload.existing_hash is None and os.path.exists(part_path):
+                with open(part_path, "rb") as f:
+                    for block in iter(lambda: f.read(UPLOAD_BLOCK_SIZE), b""):
+                        upload.digest.update(block)
+                        upload.offset += len(block)
+            self.uploads[upload_id] = upload
+            return upload
+
+    def append(self, upload_id, offset, stream):
+        """
+        Write a chunk read from a stream at the given offset. If the stream breaks off, the bytes received
+        so far are kept and the client resumes from the upload's new offset.
+
+        Returns:
+            ChunkedUpload: The upload, with its offset advanced.
+
+        Raises:
+            UploadOffsetError: If offset is not where the upload ends.
+        """
+        upload = self.get(upload_id)
+        if not upload.lock.acquire(blocking=False):
+            raise UploadOffsetError(f"A chunk of upload {upload_id} is already being written", upload.offset)
+
+        try:
+            if upload.existing_hash is not None:
+                raise UploadOffsetError("The file is already stored, complete the upload instead", upload.offset)
+            if offset != upload.offset:
+                raise UploadOffsetError(f"Chunk starts at byte {offset} but the upload is at byte {upload.offset}",
+                                        upload.offset)
+
+            with metrics.time('upload_chunk'), open(self.part_path(upload_id), "r+b") as f:
+                f.seek(upload.offset)
+                try:
+                    for block in iter(lambda: stream.read(UPLOAD_BLOCK_SIZE), b""):
+                        if upload.total_size is not None and upload.offset + len(block) > upload.total_size:
+                            raise ValueError(f"Chunk goes past the announced size of {upload.total_size} bytes")
+                        f.write(block)
+                        upload.digest.update(block)
+                        upload.offset += len(block)
+                finally:
+                    # Drop anything written past the last hashed block
+                    f.truncate(upload.offset)
+            return upload
+        finally:
+            upload.lock.release()
+
+    def complete(self, upload_id, sha256=None):
+        """
+        Finish a chunked upload and move it to the content-addressed storage.
+
+        Args:
+            upload_id (str): ID of the upload.
+            sha256 (str): Optional. Hash computed by the client, checked against the received data.
+
+        Returns:
+            tuple: (video_path, video_hash, deduplicated)
+        """
+        upload = self.get(upload_id)
+        with upload.lock:
+            if upload.existing_hash is not None:
+                video_path = self.find(upload.existing_hash)
+                if video_path is None:
+                    raise ValueError("The stored video was removed, upload the file again")
+                self.discard(upload_id)
+                return video_path, upload.existing_hash, True
+
+            if upload.total_size is not None and upload.offset != upload.total_size:
+                raise ValueError(f"Upload is incomplete: {upload.offset} of {upload.total_size} bytes received")
+            if upload.offset == 0:
+                raise ValueError("Upload is empty")
+
+            video_hash = upload.digest.hexdigest()
+            if sha256 and sha256.lower() != video_hash:
+                raise ValueError(f"Content hash mismatch: received data hashes to {video_hash}")
+
+            video_path, deduplicated = self.commit(self.part_path(upload_id), video_hash, upload.filename)
+            self.discard(upload_id)
+            return video_path, video_hash, deduplicated
+
+    def discard(self, upload_id):
+        """
+        Forget an upload and delete its partial data.
+        """
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+        for path in (self.part_path(upload_id), self.metadata_path(upload_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def remove_stale(self):
+        """
+        Discard unfinished uploads older than upload_ttl.
+        """
+        deadline = time.time() - self.upload_ttl
+        for name in os.listdir(self.partial_folder):
+            upload_id, extension = os.path.splitext(name)
+            if extension != ".json":
+                continue  # Partial data of single-request uploads is removed by store_stream
+            try:
+                # The partial data is modified by every chunk
+                paths = [self.metadata_path(upload_id), self.part_path(upload_id)]
+                if max(os.path.getmtime(path) for path in paths if os.path.exists(path)) >= deadline:
+                    continue
+            except OSError:
+                continue
+
+            with self.lock:
+                upload = self.uploads.get(upload_id)
+                if upload is not None and upload.lock.locked():
+                    continue  # A chunk is being written right now
+            logger.info(f"Discarding unfinished upload {upload_id}")
+            self.discard(upload_id)
+
+    def describe(self):
+        with self.lock:
+            return [upload.to_dict() for upload in self.uploads.values()]
@@ -0,0 +1,161 @@
+import os
+import logging
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from .Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Codecs a video can be exported with: name -> (fourcc, file extension, OpenCV backend)
+# The built-in MJPEG writer honours the quality setting; the FFmpeg backed codecs use their defaults.
+VIDEO_CODECS = {
+    'mp4v': ('mp4v', '.mp4', cv2.CAP_ANY),
+    'avc1': ('avc1', '.mp4', cv2.CAP_ANY),  # H.264, only if OpenCV was built with an H.264 encoder
+    'xvid': ('XVID', '.avi', cv2.CAP_ANY),
+    'mjpg': ('MJPG', '.avi', cv2.CAP_OPENCV_MJPEG),
+    'vp80': ('VP80', '.webm', cv2.CAP_ANY),
+    'vp90': ('VP90', '.webm', cv2.CAP_ANY)
+}
+DEFAULT_VIDEO_CODEC = 'mp4v'
+DEFAULT_VIDEO_QUALITY = 90
+
+# Overlays run on threads: OpenCV releases the GIL in the blend and lookup calls
+DEFAULT_EXPORT_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+_END = object()
+
+
+def video_extension(codec):
+    if codec not in VIDEO_CODECS:
+        raise ValueError(f"Unknown codec '{codec}', expected one of {list(VIDEO_CODECS)}")
+    return VIDEO_CODECS[codec][1]
+
+
+def open_video_writer(output_video_path, codec, fps, frame_size, quality=DEFAULT_VIDEO_QUALITY):
+    """
+    Open a cv2.VideoWriter for one of VIDEO_CODECS.
+
+    Args:
+        output_video_path (str): Where to write the video.
+        codec (str): Key of VIDEO_CODECS.
+        fps (float): Frame rate of the video.
+        frame_size (tuple): (width, height) of the frames.
+        quality (int): 0-100, used by codecs whose writer supports it.
+
+    Returns:
+        cv2.VideoWriter: The opened writer.
+    """
+    video_extension(codec)
+    fourcc, _, backend = VIDEO_CODECS[codec]
+    video_writer = cv2.VideoWriter(output_video_path, backend, cv2.VideoWriter_fourcc(*fourcc), fps, frame_size)
+    if not video_writer.isOpened():
+        raise ValueError(f"Codec '{codec}' is not available in this OpenCV build")
+    if quality is not None:
+        video_writer.set(cv2.VIDEOWRITER_PROP_QUALITY, quality)
+    return video_writer
+
+
+def export_video(frames, render, output_video_path, fps, codec=DEFAULT_VIDEO_CODEC, quality=DEFAULT_VIDEO_QUALITY,
+                 num_workers=None, queue_size=None, progress_callback=None, cancel_event=None, frames_total=None):
+    """
+    Write a video through a three stage pipeline: a reader thread pulls frames from the iterator, a pool
+    of workers renders them, and the calling thread writes them in order. The queue between reader and
+    writer is bounded, so at most queue_size frames are decoded or rendered ahead of the writer.
+
+    Args:
+        frames (iterable): (frame_idx, BGR frame) pairs in output order. Frames that are None are skipped.
+        render (callable): render(frame_idx, frame) -> BGR frame to write, called on the worker threads.
+        output_video_path (str): Where to write the video.
+        fps (float): Frame rate of the video.
+        codec (str): Key of VIDEO_CODECS.
+        quality (int): 0-100, used by codecs whose writer supports it.
+        num_workers (int): Number of render workers.
+        queue_size (int): Number of frames in flight between the reader and the writer.
+        progress_callback (callable): Optional. Called as progress_callback(frames_done, frames_total).
+        cancel_event (threading.Event): Optional. Stops the export and removes the partial video when set.
+        frames_total (int): Optional. Number of frames, for progress reporting.
+
+    Returns:
+        int: Number of frames written.
+    """
+    num_workers = num_workers or DEFAULT_EXPORT_WORKERS
+    pending = queue.Queue(maxsize=queue_size or 2 * num_workers)
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="annot-export")
+
+    def put(item):
+        # Give up when the writer stopped, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def timed_render(frame_idx, frame):
+        with metrics.time('export_render'):
+            return render(frame_idx, frame)
+
+    def read_frames():
+        try:
+            for frame_idx, frame in frames:
+                if stop.is_set():
+                    return
+                if frame is None:
+                    logger.error(f"Error: Could not read frame {frame_idx}")
+                    continue
+                if not put(executor.submit(timed_render, frame_idx, frame)):
+                    return
+            put(_END)
+        except Exception as e:
+            put(e)
+
+    reader = threading.Thread(target=read_frames, name="annot-export-reader", daemon=True)
+    reader.start()
+
+    video_writer = None
+    frames_written = 0
+    start_time = time.time()
+    try:
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise InterruptedError("Annotated video export was cancelled")
+
+            item = pending.get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            frame = item.result()
+            if video_writer is None:
+                height, width = frame.shape[:2]
+                video_writer = open_video_writer(output_video_path, codec, fps, (width, height), quality)
+            with metrics.time('export_write'):
+                video_writer.write(frame)
+
+            frames_written += 1
+            if progress_callback is not None:
+                progress_callback(frames_written, frames_total)
+    except BaseException:
+        if video_writer is not None:
+            video_writer.release()
+            video_writer = None
+            if os.path.exists(output_video_path):
+                os.remove(output_video_path)
+        raise
+    finally:
+        stop.set()
+        reader.join()
+        executor.shutdown(wait=True, cancel_futures=True)
+        if video_writer is not None:
+            video_writer.release()
+
+    elapsed = time.time() - start_time
+    logger.info(f"Exported {frames_written} frames with {codec} at {fps:.2f} fps in {elapsed:.2f}s "
+                f"({frames_written / elapsed if elapsed else 0:.1f} frames/s)")
+    return frames_written
@@ -0,0 +1,140 @@
+import os
+import sys
+from collections import OrderedDict
+import pytest
+import torch
+
+# The server imports its modules as the top-level 'modules' package, from the annot_flask folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.Annotation import AnnotationModule  # noqa: E402
+
+
+# Tracking predictor
+class TrackingPredictor:
+    # Frames around a prompt where the tracked mask still follows the prompt rather than the object's path
+    PROMPT_REACH = 2
+
+    def __init__(self, num_frames=40, height=48, width=160, radius=8):
+        """
+        Stand-in for SAM2VideoPredictor with the internals incremental and sparse propagation call. Every
+        object is a disc moving right by a pixel per frame; a click puts the disc where it was clicked, on
+        its frame and the PROMPT_REACH frames around it.
+        """
+        self.num_frames = num_frames
+        self.height = height
+        self.width = width
+        self.radius = radius
+        self.clear_non_cond_mem_around_input = False
+        self.memory_temporal_stride_for_eval = 1
+        self.num_maskmem = 7
+        self.tracked = []  # (obj_id, frame_idx, reverse) of every tracking step
+
+    def init_state(self):
+        return {
+            "images": torch.zeros((self.num_frames, 3, 8, 8)),
+            "num_frames": self.num_frames,
+            "video_height": self.height,
+            "video_width": self.width,
+            "device": torch.device("cpu"),
+            "point_inputs_per_obj": {},
+            "mask_inputs_per_obj": {},
+            "obj_id_to_idx": OrderedDict(),
+            "obj_idx_to_id": OrderedDict(),
+            "obj_ids": [],
+            "output_dict_per_obj": {},
+            "temp_output_dict_per_obj": {},
+            "frames_tracked_per_obj": {},
+            "cached_features": {}
+        }
+
+    def path(self, obj_id, frame_idx):
+        return 10 + frame_idx, 10 + 20 * (obj_id - 1)
+
+    def disc(self, x, y):
+        ys = torch.arange(self.height, dtype=torch.float32).view(self.height, 1)
+        xs = torch.arange(self.width, dtype=torch.float32).view(1, self.width)
+        inside = (xs - x) ** 2 + (ys - y) ** 2 < self.radius ** 2
+        return (inside.float() * 20.0 - 10.0).view(1, 1, self.height, self.width)
+
+    def _obj_id_to_idx(self, inference_state, obj_id):
+        obj_idx = inference_state["obj_id_to_idx"].get(obj_id)
+        if obj_idx is None:
+            obj_idx = len(inference_state["obj_id_to_idx"])
+            inference_state["obj_id_to_idx"][obj_id] = obj_idx
+            inference_state["obj_idx_to_id"][obj_idx] = obj_id
+            inference_state["obj_ids"] = list(inference_state["obj_id_to_idx"])
+            for key in ("point_inputs_per_obj", "mask_inputs_per_obj", "frames_tracked_per_obj"):
+                inference_state[key][obj_idx] = {}
+            for key in ("output_dict_per_obj", "temp_output_dict_per_obj"):
+                inference_state[key][obj_idx] = {"cond_frame_outputs": {}, "non_cond_frame_outputs": {}}
+        return obj_idx
+
+    def _track(self, obj_id, output_dict, frame_idx):
+        prompted = output_dict["cond_frame_outputs"]
+        nearest = min(prompted, key=lambda t: abs(t - frame_idx), default=None)
+        if nearest is not None and abs(nearest - frame_idx) <= self.PROMPT_REACH:
+            x, y = prompted[nearest]["click"]
+        else:
+            x, y = self.path(obj_id, frame_idx)
+        return {"obj_id": obj_id, "pred_masks": self.disc(x, y)}
+
+    def add_new_points_or_box(self, inference_state, frame_idx, obj_id, points=None, labels=None, **kwargs):
+        obj_idx = self._obj_id_to_idx(inference_state, obj_id)
+        inference_state["point_inputs_per_obj"][obj_idx][frame_idx] = (points, labels)
+        x, y = (float(value) for value in points[0])
+        inference_state["output_dict_per_obj"][obj_idx]["cond_frame_outputs"][frame_idx] = {
+            "obj_id": obj_id, "click": (x, y), "pred_masks": self.disc(x, y)}
+        return frame_idx, list(inference_state["obj_ids"]), self._all_masks(inference_state, frame_idx)
+
+    def _all_masks(self, inference_state, frame_idx):
+        return torch.cat([self._track(obj_id, inference_state["output_dict_per_obj"][obj_idx], frame_idx)["pred_masks"]
+                          for obj_id, obj_idx in inference_state["obj_id_to_idx"].items()])
+
+    def propagate_in_video_preflight(self, inference_state):
+        if not inference_state["obj_ids"]:
+            raise RuntimeError("No input points or masks are provided for any object; please add inputs first.")
+
+    def propagate_in_video(self, inference_state, start_frame_idx=None, max_frame_num_to_track=None, reverse=False):
+        self.propagate_in_video_preflight(inference_state)
+        if start_frame_idx is None:
+            start_frame_idx = min(t for output_dict in inference_state["output_dict_per_obj"].values()
+                                  for t in output_dict["cond_frame_outputs"])
+        if max_frame_num_to_track is None:
+            max_frame_num_to_track = self.num_frames
+        if reverse:
+            end_frame_idx = max(start_frame_idx - max_frame_num_to_track, 0)
+            processing_order = range(start_frame_idx, end_frame_idx - 1, -1) if start_frame_idx > 0 else []
+        else:
+            end_frame_idx = min(start_frame_idx + max_frame_num_to_track, self.num_frames - 1)
+            processing_order = range(start_frame_idx, end_frame_idx + 1)
+        for frame_idx in processing_order:
+            for obj_id in inference_state["obj_ids"]:
+                self.tracked.append((obj_id, frame_idx, reverse))
+            yield frame_idx, list(inference_state["obj_ids"]), self._all_masks(inference_state, frame_idx)
+
+    def _run_single_frame_inference(self, inference_state, output_dict, frame_idx, batch_size, is_init_cond_frame,
+                                    point_inputs, mask_inputs, reverse, run_mem_encoder):
+        obj_id = next(iter(output_dict["cond_frame_outputs"].values()))["obj_id"]
+        self.tracked.append((obj_id, frame_idx, reverse))
+        current_out = self._track(obj_id, output_dict, frame_idx)
+        return current_out, current_out["pred_masks"]
+
+    def _get_orig_video_res_output(self, inference_state, any_res_masks):
+        # The masks are made at the video resolution already
+        return any_res_masks, any_res_masks
+
+
+@pytest.fixture
+def tracking_predictor():
+    return TrackingPredictor()
+
+
+@pytest.fixture
+def tracking_annotator(tracking_predictor):
+    """
+    AnnotationModule on the TrackingPredictor, with an inference state ready for prompts.
+    """
+    annotator = AnnotationModule(None, None, 'cpu', predictor=tracking_predictor)
+    annotator.inference_state = tracking_predictor.init_state()
+    return annotator
@@ -0,0 +1,130 @@
+import io
+import json
+import zipfile
+import threading
+import numpy as np
+import pytest
+from PIL import Image
+from modules.MaskEncoding import rle_decode
+from modules.MaskStore import MaskStore
+from modules.DatasetExport import DATASET_FORMATS, FRAMES_PER_TASK, export_dataset, mask_polygons, class_indices
+
+WIDTH, HEIGHT = 40, 30
+
+
+def box_mask(x, y, w, h):
+    mask = np.zeros((HEIGHT, WIDTH), dtype=bool)
+    mask[y:y + h, x:x + w] = True
+    return mask
+
+
+def make_store(num_frames):
+    """
+    Two objects, object 1 on every frame and object 2 on the odd ones, both moving right by a pixel per frame.
+    """
+    store = MaskStore()
+    for frame_idx in range(num_frames):
+        store.put(1, frame_idx, box_mask(frame_idx % 20, 2, 8, 6))
+        if frame_idx % 2:
+            store.put(2, frame_idx, box_mask(frame_idx % 20, 15, 10, 10))
+    return store
+
+
+def export(tmp_path, dataset_format, num_frames=5, **kwargs):
+    path = str(tmp_path / f"{dataset_format}.zip")
+    frame_names = [f"{i:05d}.jpg" for i in range(num_frames)]
+    count = export_dataset(path, dataset_format, make_store(num_frames).masks_by_frame(), frame_names, (WIDTH, HEIGHT),
+                           {2: "artery", 1: "organ"}, {1: [0, 0, 255], 2: [255, 0, 0]}, **kwargs)
+    assert count == num_frames
+    return zipfile.ZipFile(path)
+
+
+def test_mask_polygons():
+    polygons = mask_polygons(box_mask(5, 5, 10, 4))
+    assert len(polygons) == 1
+    points = np.asarray(polygons[0]).reshape(-1, 2)
+    assert points.min(axis=0).tolist() == [5, 5] and points.max(axis=0).tolist() == [14, 8]
+    assert mask_polygons(np.zeros((5, 5), dtype=bool)) == []
+
+
+def test_class_indices_put_named_classes_first():
+    assert class_indices({7: "a", 3: "b"}, [1, 3, 9]) == {3: 0, 7: 1, 1: 2, 9: 3}
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_coco_rle(tmp_path, num_workers):
+    # More frames than one task, so the threads take part
+    num_frames = FRAMES_PER_TASK * 2 + 3
+    with export(tmp_path, "coco_rle", num_frames=num_frames, num_workers=num_workers) as archive:
+        coco = json.loads(archive.read("annotations.json"))
+        assert json.loads(archive.read("classes.json")) == {"1": "organ", "2": "artery"}
+
+    assert [image['frame_index'] for image in coco['images']] == list(range(num_frames))
+    assert [category['id'] for category in coco['categories']] == [1, 2]
+    assert [annotation['id'] for annotation in coco['annotations']] == list(range(1, len(coco['annotations']) + 1))
+    assert len(coco['annotations']) == num_frames + num_frames // 2
+
+    store = make_store(num_frames)
+    for annotation in coco['annotations']:
+        frame_idx = annotation['image_id'] - 1
+        expected = store.get(annotation['category_id'], frame_idx)
+        np.testing.assert_array_equal(rle_decode(annotation['segmentation']), expected)
+        assert annotation['area'] == expected.sum()
+        assert annotation['bbox'][2:] == ([8, 6] if annotation['category_id'] == 1 else [10, 10])
+
+
+def test_coco_polygon(tmp_path):
+    with export(tmp_path, "coco_polygon") as archive:
+        coco = json.loads(archive.read("annotations.json"))
+    annotation = coco['annotations'][0]
+    assert annotation['category_id'] == 1 and annotation['bbox'] == [0, 2, 8, 6]
+    assert len(annotation['segmentation']) == 1
+
+
+def test_yolo_seg(tmp_path):
+    with export(tmp_path, "yolo_seg") as archive:
+        labels = archive.read("labels/00001.txt").decode().splitlines()
+        data = archive.read("data.yaml").decode()
+        assert archive.read("labels/00000.txt").decode().count("\n") == 1
+
+    assert "nc: 2" in data and '0: "organ"' in data
+    assert [line.split()[0] for line in labels] == ["0", "1"]
+    coords = np.asarray(labels[0].split()[1:], dtype=float)
+    assert 0 <= coords.min() and coords.max() <= 1
+
+
+def test_png_label_maps(tmp_path):
+    with export(tmp_path, "png") as archive:
+        image = Image.open(io.BytesIO(archive.read("masks/00001.png")))
+    assert image.mode == "P" and image.size == (WIDTH, HEIGHT)
+    label_map = np.asarray(image)
+    assert (label_map == 1).sum() == 48 and (label_map == 2).sum() == 100
+    assert image.getpalette()[3:9] == [0, 0, 255, 255, 0, 0]
+
+
+def test_png_rejects_large_object_ids(tmp_path):
+    store = MaskStore()
+    store.put(300, 0, box_mask(0, 0, 2, 2))
+    with pytest.raises(ValueError):
+        export_dataset(str(tmp_path / "out.zip"), "png", store.masks_by_frame(), ["00000.jpg"], (WIDTH, HEIGHT), {}, {})
+
+
+def test_images_are_included(tmp_path):
+    frames = ((i, np.full((HEIGHT, WIDTH, 3), i * 10, dtype=np.uint8)) for i in range(5))
+    with export(tmp_path, "yolo_seg", frames=frames) as archive:
+        names = archive.namelist()
+    assert [name for name in names if name.startswith("images/")] == [f"images/{i:05d}.jpg" for i in range(5)]
+
+
+def test_cancel_removes_the_archive(tmp_path):
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(InterruptedError):
+        export(tmp_path, "coco_rle", cancel_event=cancel)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_unknown_format(tmp_path):
+    assert "coco_rle" in DATASET_FORMATS
+    with pytest.raises(ValueError):
+        export(tmp_path, "voc")
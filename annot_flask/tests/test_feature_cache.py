@@ -0,0 +1,210 @@
+import os
+import hashlib
+import pytest
+import torch
+import torch.nn.functional as F
+from modules.FeatureCache import FeatureCache, model_cache_key, hash_file
+
+VIDEO_KEY = "a" * 16
+
+
+class FakeModel:
+    """
+    Predictor with SAM2's forward_image and _get_image_feature, on a three-level feature pyramid.
+    """
+    def __init__(self):
+        self.encoded = 0
+
+    def forward_image(self, image):
+        self.encoded += 1
+        fpn = [F.adaptive_avg_pool2d(image, size).repeat(1, channels // 3 + 1, 1, 1)[:, :channels]
+               for size, channels in ((16, 4), (8, 8), (4, 16))]
+        pos = [torch.arange(t[0].numel(), dtype=torch.float32).view(t[0].shape).unsqueeze(0) for t in fpn]
+        return {'vision_features': fpn[-1], 'vision_pos_enc': pos, 'backbone_fpn': fpn}
+
+    def _get_image_feature(self, inference_state, frame_idx, batch_size):
+        # Same lookup and expansion as SAM2VideoPredictor._get_image_feature
+        image, backbone_out = inference_state["cached_features"].get(frame_idx, (None, None))
+        if backbone_out is None:
+            image = inference_state["images"][frame_idx].to(inference_state["device"]).float().unsqueeze(0)
+            backbone_out = self.forward_image(image)
+            inference_state["cached_features"] = {frame_idx: (image, backbone_out)}
+        return (image.expand(batch_size, -1, -1, -1),
+                [feat.expand(batch_size, -1, -1, -1) for feat in backbone_out["backbone_fpn"]],
+                [pos.expand(batch_size, -1, -1, -1) for pos in backbone_out["vision_pos_enc"]])
+
+
+def frame(seed):
+    return torch.rand((3, 32, 32), generator=torch.Generator().manual_seed(seed))
+
+
+def backbone_out(seed):
+    return FakeModel().forward_image(frame(seed).unsqueeze(0))
+
+
+def make_cache(tmp_path, model_key="model", max_memory_bytes=1 << 30, max_disk_bytes=1 << 30):
+    return FeatureCache(str(tmp_path), model_key, max_memory_bytes, max_disk_bytes)
+
+
+def assert_same_output(actual, expected):
+    assert sorted(actual) == sorted(expected)
+    for key, value in expected.items():
+        if torch.is_tensor(value):
+            torch.testing.assert_close(actual[key], value, rtol=0, atol=0)
+        else:
+            assert len(actual[key]) == len(value)
+            for a, b in zip(actual[key], value):
+                torch.testing.assert_close(a, b, rtol=0, atol=0)
+
+
+def test_model_cache_key(tmp_path):
+    checkpoint = tmp_path / "model.pt"
+    checkpoint.write_bytes(b"weights")
+    key = model_cache_key("configs/sam2_hiera_t.yaml", str(checkpoint))
+    assert key == model_cache_key("other/folder/sam2_hiera_t.yaml", str(checkpoint))
+    assert key != model_cache_key("configs/sam2_hiera_l.yaml", str(checkpoint))
+
+    # Other weights under the same name
+    checkpoint.write_bytes(b"other weights")
+    assert key != model_cache_key("configs/sam2_hiera_t.yaml", str(checkpoint))
+
+
+def test_hash_file(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"x" * 3000)
+    assert hash_file(str(path), chunk_size=1000) == hashlib.sha256(b"x" * 3000).hexdigest()
+
+
+def test_memory_and_disk_round_trip(tmp_path):
+    cache = make_cache(tmp_path)
+    expected = backbone_out(0)
+    cache.put(VIDEO_KEY, 3, expected)
+    assert_same_output(cache.get(VIDEO_KEY, 3, "cpu"), expected)
+    assert cache.get_stats()['memory_hits'] == 1
+    cache.flush()
+
+    # After a restart, the entry comes from disk
+    restarted = make_cache(tmp_path)
+    assert_same_output(restarted.get(VIDEO_KEY, 3, "cpu"), expected)
+    assert restarted.get_stats()['disk_hits'] == 1 and restarted.get_stats()['disk_entries'] == 1
+
+
+def test_keys_do_not_mix(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put(VIDEO_KEY, 3, backbone_out(0))
+    assert cache.get(VIDEO_KEY, 4, "cpu") is None
+    assert cache.get("b" * 16, 3, "cpu") is None
+    assert make_cache(tmp_path, model_key="other model").get(VIDEO_KEY, 3, "cpu") is None
+    assert cache.get_stats()['misses'] == 2
+
+
+def test_memory_is_bounded(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put(VIDEO_KEY, 0, backbone_out(0))
+    entry_bytes = cache.get_stats()['memory_bytes']
+
+    cache = make_cache(tmp_path / "bounded", max_memory_bytes=2 * entry_bytes)
+    for frame_idx in range(3):
+        cache.put(VIDEO_KEY, frame_idx, backbone_out(frame_idx))
+    cache.flush()
+    stats = cache.get_stats()
+    assert stats['memory_entries'] == 2 and stats['evictions'] == 1
+
+    # The evicted entry is still on disk
+    assert_same_output(cache.get(VIDEO_KEY, 0, "cpu"), backbone_out(0))
+    assert cache.get_stats()['disk_hits'] == 1
+
+
+def test_disk_is_bounded(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put(VIDEO_KEY, 0, backbone_out(0))
+    cache.flush()
+    entry_bytes = cache.get_stats()['disk_bytes']
+
+    cache = make_cache(tmp_path / "bounded", max_memory_bytes=0, max_disk_bytes=2 * entry_bytes)
+    for frame_idx in range(3):
+        cache.put(VIDEO_KEY, frame_idx, backbone_out(frame_idx))
+    cache.flush()
+    assert cache.get_stats()['disk_entries'] == 2
+    assert not os.path.exists(cache.entry_folder(VIDEO_KEY, 0))
+    assert os.path.exists(cache.entry_folder(VIDEO_KEY, 2))
+
+
+def test_entries_hold_only_the_feature_pyramid(tmp_path):
+    cache = make_cache(tmp_path)
+    for frame_idx in range(3):
+        cache.put(VIDEO_KEY, frame_idx, backbone_out(frame_idx))
+    cache.flush()
+
+    pyramid_bytes = sum(t.element_size() * t.nelement() for t in backbone_out(0)['backbone_fpn'])
+    stats = cache.get_stats()
+    assert stats['memory_bytes'] == 3 * pyramid_bytes
+    assert stats['position_encodings'] == 1
+    # On disk, the .npy headers and the manifest come on top of the tensors
+    assert 3 * pyramid_bytes <= stats['disk_bytes'] < 3 * (pyramid_bytes + 4096)
+    entry_files = os.listdir(cache.entry_folder(VIDEO_KEY, 0))
+    assert sorted(entry_files) == ["backbone_fpn.0.npy", "backbone_fpn.1.npy", "backbone_fpn.2.npy", "manifest.json"]
+
+    # The positional encodings are written once, for all entries
+    position_folders = os.listdir(os.path.join(cache.cache_folder, "position_encodings"))
+    assert len(position_folders) == 1
+
+
+def test_round_trip_gives_the_same_image_features(tmp_path):
+    image = frame(0).unsqueeze(0)
+    expected = FakeModel()._get_image_feature({"cached_features": {0: (image, backbone_out(0))}}, 0, 2)
+
+    cache = make_cache(tmp_path)
+    cache.put(VIDEO_KEY, 0, backbone_out(0))
+    cache.flush()
+    restarted = make_cache(tmp_path)
+    for source in (cache, restarted):
+        cached = source.get(VIDEO_KEY, 0, "cpu")
+        assert cached['vision_features'] is cached['backbone_fpn'][-1]
+        actual = FakeModel()._get_image_feature({"cached_features": {0: (image, cached)}}, 0, 2)
+        for a, b in zip(actual[1] + actual[2], expected[1] + expected[2]):
+            torch.testing.assert_close(a, b, rtol=0, atol=0)
+    assert cache.get_stats()['memory_hits'] == 1 and restarted.get_stats()['disk_hits'] == 1
+
+
+def test_interrupted_writes_are_removed(tmp_path):
+    cache = make_cache(tmp_path)
+    temp_folder = cache.entry_folder(VIDEO_KEY, 5) + ".123.tmp"
+    os.makedirs(temp_folder)
+    make_cache(tmp_path)
+    assert not os.path.exists(temp_folder)
+
+
+def test_bfloat16(tmp_path):
+    expected = {key: [t.bfloat16() for t in value] if isinstance(value, list) else value.bfloat16()
+                for key, value in backbone_out(0).items()}
+    cache = make_cache(tmp_path)
+    cache.put(VIDEO_KEY, 0, expected)
+    cache.flush()
+    actual = make_cache(tmp_path).get(VIDEO_KEY, 0, "cpu")
+    assert actual['vision_features'].dtype == torch.bfloat16
+    assert_same_output(actual, expected)
+
+
+def test_installed_cache_skips_the_encoder(tmp_path):
+    images = torch.stack([frame(seed) for seed in range(4)])
+    reference = FakeModel()
+    state = {"images": images, "device": torch.device("cpu"), "cached_features": {}}
+    expected = [reference._get_image_feature(state, frame_idx, 2) for frame_idx in range(4)]
+
+    cache = make_cache(tmp_path)
+    for attempt in range(2):
+        model = FakeModel()
+        cache.install(model)
+        # The frames of the state are source frames 10, 11, ... of the video
+        state = {"images": images, "device": torch.device("cpu"), "cached_features": {},
+                 "feature_cache_keys": (VIDEO_KEY, list(range(10, 14)))}
+        for frame_idx in (0, 1, 2, 3, 1):
+            image, fpn, pos = model._get_image_feature(state, frame_idx, 2)
+            torch.testing.assert_close(image, expected[frame_idx][0])
+            for actual, reference_level in zip(fpn + pos, expected[frame_idx][1] + expected[frame_idx][2]):
+                torch.testing.assert_close(actual, reference_level, rtol=0, atol=0)
+        assert model.encoded == (4 if attempt == 0 else 0)
+        if attempt == 0:
+            cache.flush()
+            cache = make_cache(tmp_path)  # The second attempt reads the entries from disk
@@ -0,0 +1,117 @@
+import numpy as np
+from modules.Annotation import CONVERGENCE_FRAMES, mask_iou, check_tracking_api
+
+
+def click(annotator, obj_id, frame_idx, dy=0):
+    x, y = annotator.predictor.path(obj_id, frame_idx)
+    annotator.predict_mask(frame_idx, obj_id, [[x, y + dy]], [1])
+
+
+def path_mask(annotator, obj_id, frame_idx):
+    predictor = annotator.predictor
+    return (predictor.disc(*predictor.path(obj_id, frame_idx)) > 0).numpy()[0, 0]
+
+
+def propagated(annotator, **options):
+    """
+    Run a propagation, returning {obj_id: frames} of its result and the tracking steps the model ran.
+    """
+    annotator.predictor.tracked.clear()
+    segments = annotator.propagate_segmentation(annotator.inference_state, **options)
+    return {obj_id: sorted(frames) for obj_id, frames in segments.items()}, list(annotator.predictor.tracked)
+
+
+def test_only_the_edited_object_is_propagated_around_its_edit(tracking_annotator):
+    annotator = tracking_annotator
+    click(annotator, 1, 0)
+    click(annotator, 2, 0)
+    propagated(annotator)
+    assert annotator.dirty_frames == {}
+    assert annotator.mask_store.frame_indices() == list(range(40))
+
+    # A click off the object's path on frame 20: the masks differ within the prompt's reach, then agree again
+    click(annotator, 1, 20, dy=8)
+    reach = annotator.predictor.PROMPT_REACH
+    segments, tracked = propagated(annotator, incremental=True)
+
+    forward = list(range(21, 21 + reach + CONVERGENCE_FRAMES))
+    backward = list(range(19, 19 - reach - CONVERGENCE_FRAMES, -1))
+    assert tracked == [(1, frame_idx, False) for frame_idx in forward] + [(1, frame_idx, True) for frame_idx in backward]
+    assert list(segments) == [1]
+    assert segments[1] == list(range(backward[-1], forward[-1] + 1))
+
+    # The new masks are merged into the store, the other frames and objects are left as they were
+    assert mask_iou(annotator.mask_store.get(1, 21), path_mask(annotator, 1, 21)) < 0.5
+    np.testing.assert_array_equal(annotator.mask_store.get(1, 30), path_mask(annotator, 1, 30))
+    np.testing.assert_array_equal(annotator.mask_store.get(2, 20), path_mask(annotator, 2, 20))
+    assert annotator.dirty_frames == {}
+
+
+def test_several_edits_of_an_object(tracking_annotator):
+    annotator = tracking_annotator
+    click(annotator, 1, 0)
+    propagated(annotator)
+
+    click(annotator, 1, 10, dy=8)
+    click(annotator, 1, 30, dy=8)
+    _, tracked = propagated(annotator, incremental=True)
+
+    # Both passes run over the frames between the edits, and only stop past the last edit on their way
+    forward = [frame_idx for _, frame_idx, reverse in tracked if not reverse]
+    backward = [frame_idx for _, frame_idx, reverse in tracked if reverse]
+    assert forward[0] == 11 and forward[-1] == 30 + annotator.predictor.PROMPT_REACH + CONVERGENCE_FRAMES
+    assert backward[0] == 29 and backward[-1] == 10 - annotator.predictor.PROMPT_REACH - CONVERGENCE_FRAMES
+
+
+def test_new_objects_run_to_both_ends(tracking_annotator):
+    annotator = tracking_annotator
+    click(annotator, 1, 0)
+    propagated(annotator)
+
+    click(annotator, 2, 10)
+    segments, tracked = propagated(annotator, incremental=True)
+    assert {obj_id for obj_id, _, _ in tracked} == {2}
+    assert segments == {2: list(range(40))}
+    np.testing.assert_array_equal(annotator.mask_store.get(2, 39), path_mask(annotator, 2, 39))
+
+
+def test_every_frame_is_yielded_once_per_object(tracking_annotator):
+    annotator = tracking_annotator
+    click(annotator, 1, 0)
+    propagated(annotator)
+
+    click(annotator, 1, 20, dy=8)
+    click(annotator, 2, 10)
+    yielded = [(obj_id, frame_idx) for frame_idx, obj_ids, _ in annotator.iter_incremental_propagation(
+        annotator.inference_state) for obj_id in obj_ids]
+    assert len(yielded) == len(set(yielded))
+    assert sorted(frame_idx for obj_id, frame_idx in yielded if obj_id == 2) == list(range(40))
+
+    # Both passes run over the frames between the edits, progress counts each frame once
+    click(annotator, 1, 10, dy=8)
+    click(annotator, 1, 30, dy=8)
+    progress = []
+    segments = annotator.propagate_segmentation(annotator.inference_state, incremental=True,
+                                                progress_callback=lambda done, total: progress.append((done, total)))
+    assert all(done <= total for done, total in progress)
+    assert progress[-1] == (len(segments[1]), 40)
+
+
+def test_nothing_to_do(tracking_annotator):
+    annotator = tracking_annotator
+    click(annotator, 1, 0)
+    propagated(annotator)
+    assert propagated(annotator, incremental=True) == ({}, [])
+
+
+def test_falls_back_to_a_full_propagation_without_the_sam2_internals(tracking_annotator):
+    annotator = tracking_annotator
+    click(annotator, 1, 0)
+    click(annotator, 2, 0)
+    propagated(annotator)
+
+    del annotator.predictor.num_maskmem
+    assert check_tracking_api(annotator.predictor) == ["attribute num_maskmem is missing"]
+    click(annotator, 1, 20, dy=8)
+    segments, _ = propagated(annotator, incremental=True)
+    assert segments == {1: list(range(40)), 2: list(range(40))}
@@ -0,0 +1,122 @@
+import threading
+import pytest
+import torch
+from modules.InferenceWorker import InferenceWorker, split_backbone_out
+
+
+class FakeEncoder:
+    """
+    Predictor with SAM2's forward_image and _get_image_feature, encoding an image as simple functions of it.
+    """
+    def __init__(self):
+        self.forward_batches = []
+        self.direct_encodes = 0
+
+    def forward_image(self, images):
+        self.forward_batches.append(len(images))
+        if (images < 0).any():
+            raise RuntimeError("negative pixels")
+        return {'vision_features': images * 2, 'backbone_fpn': [images + 1, images + 2], 'vision_pos_enc': None}
+
+    def _get_image_feature(self, inference_state, frame_idx, batch_size):
+        # Like SAM2: use the single cached frame if it is the right one, otherwise encode it
+        image, backbone_out = inference_state["cached_features"].get(frame_idx, (None, None))
+        if backbone_out is None:
+            self.direct_encodes += 1
+            image = inference_state["images"][frame_idx].float().unsqueeze(0)
+            backbone_out = self.forward_image(image)
+            inference_state["cached_features"] = {frame_idx: (image, backbone_out)}
+        return image, backbone_out
+
+
+def image(value, size=4):
+    return torch.full((1, 3, size, size), float(value))
+
+
+def encode_concurrently(worker, predictor, images):
+    results = [None] * len(images)
+    errors = [None] * len(images)
+
+    def encode(i):
+        try:
+            results[i] = worker.encode(predictor, images[i])
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=encode, args=(i,)) for i in range(len(images))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_split_backbone_out():
+    images = torch.arange(3.0).view(3, 1, 1, 1)
+    outputs = split_backbone_out(FakeEncoder().forward_image(images), 3)
+    assert len(outputs) == 3
+    for i, output in enumerate(outputs):
+        assert output['vision_features'].shape == (1, 1, 1, 1) and output['vision_features'].item() == 2 * i
+        assert [level.item() for level in output['backbone_fpn']] == [i + 1, i + 2]
+        assert output['vision_pos_enc'] is None
+    # The parts are copies, not views of the batch
+    assert outputs[1]['vision_features'].untyped_storage().nbytes() == 4
+
+
+def test_concurrent_requests_share_a_forward_pass():
+    predictor = FakeEncoder()
+    worker = InferenceWorker(batch_window=0.2, max_batch_size=8)
+    results, errors = encode_concurrently(worker, predictor, [image(i) for i in range(3)])
+
+    assert errors == [None] * 3
+    assert predictor.forward_batches == [3]
+    assert [result['vision_features'][0, 0, 0, 0].item() for result in results] == [0, 2, 4]
+    assert worker.describe()['batch_sizes'] == {3: 1}
+    assert worker.encoded == 3
+
+
+def test_batches_are_capped_and_grouped_by_shape():
+    predictor = FakeEncoder()
+    worker = InferenceWorker(batch_window=0.2, max_batch_size=2)
+    results, errors = encode_concurrently(worker, predictor, [image(1), image(2), image(3, size=8)])
+
+    assert errors == [None] * 3
+    assert sum(predictor.forward_batches) == 3 and max(predictor.forward_batches) <= 2
+    assert results[2]['vision_features'].shape == (1, 3, 8, 8)
+
+
+def test_errors_reach_the_callers():
+    worker = InferenceWorker(batch_window=0.2)
+    results, errors = encode_concurrently(worker, FakeEncoder(), [image(1), image(-1)])
+    assert results == [None, None]
+    assert all(isinstance(error, RuntimeError) for error in errors)
+
+    # The worker keeps running
+    assert worker.encode(FakeEncoder(), image(1))['vision_features'].sum().item() == 2 * 3 * 16
+
+
+def test_install_routes_the_encoder_through_the_worker():
+    predictor = FakeEncoder()
+    worker = InferenceWorker(batch_window=0)
+    worker.install(predictor)
+    state = {"images": torch.arange(2.0).view(2, 1, 1, 1).expand(2, 3, 4, 4), "device": torch.device("cpu"),
+             "cached_features": {}}
+
+    image_out, backbone_out = predictor._get_image_feature(state, 1, 1)
+    assert predictor.direct_encodes == 0 and worker.encoded == 1
+    assert image_out.shape == (1, 3, 4, 4) and backbone_out['vision_features'].sum().item() == 2 * 3 * 16
+    assert list(state["cached_features"]) == [1]
+
+    # A frame already in the cache is not encoded again
+    predictor._get_image_feature(state, 1, 1)
+    assert worker.encoded == 1
+
+
+def test_num_threads():
+    threads = torch.get_num_threads()
+    try:
+        worker = InferenceWorker(num_threads=1)
+        worker.encode(FakeEncoder(), image(0))
+        assert worker.describe()['num_threads'] == 1
+    finally:
+        torch.set_num_threads(threads)
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from modules.MaskEncoding import MASK_FORMATS, rle_encode, rle_decode, encode_mask, decode_mask
+
+
+def random_mask(h=37, w=53, seed=0):
+    return np.random.default_rng(seed).random((h, w)) > 0.5
+
+
+@pytest.mark.parametrize("fmt", MASK_FORMATS)
+def test_round_trip(fmt):
+    mask = random_mask()
+    decoded = decode_mask(encode_mask(mask, fmt))
+    assert decoded.dtype == bool
+    np.testing.assert_array_equal(decoded, mask)
+
+
+@pytest.mark.parametrize("fmt", MASK_FORMATS)
+@pytest.mark.parametrize("fill", [False, True])
+def test_round_trip_uniform(fmt, fill):
+    mask = np.full((8, 5), fill)
+    np.testing.assert_array_equal(decode_mask(encode_mask(mask, fmt)), mask)
+
+
+def test_rle_counts_are_column_major_and_start_with_zeros():
+    mask = np.array([[1, 0, 0],
+                     [1, 1, 0]], dtype=bool)
+    # Column-major: 1, 1, 0, 1, 0, 0
+    assert rle_encode(mask) == {'size': [2, 3], 'counts': [0, 2, 1, 1, 2]}
+    assert rle_encode(np.ones((4, 4), dtype=bool))['counts'] == [0, 16]
+    assert rle_encode(np.zeros((4, 4), dtype=bool))['counts'] == [16]
+
+
+def test_rle_empty_mask():
+    rle = rle_encode(np.zeros((0, 3), dtype=bool))
+    assert rle == {'size': [0, 3], 'counts': []}
+    assert rle_decode(rle).shape == (0, 3)
+
+
+def test_rle_decode_rejects_wrong_size():
+    with pytest.raises(ValueError):
+        rle_decode({'size': [2, 2], 'counts': [1, 2]})
+
+
+def test_decode_rle_without_format():
+    mask = random_mask(seed=1)
+    np.testing.assert_array_equal(decode_mask(rle_encode(mask)), mask)
+
+
+def test_bits_payload_is_packed():
+    import base64
+    payload = encode_mask(random_mask(3, 5), 'bits')
+    assert payload['format'] == 'bits'
+    assert payload['size'] == [3, 5]
+    assert len(base64.b64decode(payload['data'])) == 2  # 15 bits
+
+
+def test_rle_matches_pycocotools():
+    mask_utils = pytest.importorskip("pycocotools.mask")
+    mask = random_mask(seed=2)
+    counts = rle_encode(mask)['counts']
+    expected = mask_utils.frPyObjects({'size': [37, 53], 'counts': counts}, 37, 53)
+    np.testing.assert_array_equal(mask_utils.decode(expected).astype(bool), mask)
+
+
+def test_errors():
+    with pytest.raises(ValueError):
+        encode_mask(random_mask(), 'jpeg')
+    with pytest.raises(ValueError):
+        encode_mask(np.zeros((1, 4, 4), dtype=bool), 'rle')
+    with pytest.raises(ValueError):
+        decode_mask({'format': 'jpeg', 'size': [1, 1], 'data': ''})
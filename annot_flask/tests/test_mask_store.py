@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+from modules.MaskStore import MaskStore
+
+
+def random_mask(seed, h=24, w=31):
+    return np.random.default_rng(seed).random((h, w)) > 0.5
+
+
+@pytest.fixture
+def store():
+    store = MaskStore(video_key="video-a")
+    for obj_id in (1, 2):
+        for frame_idx in range(3):
+            store.put(obj_id, frame_idx, random_mask(obj_id * 10 + frame_idx))
+    return store
+
+
+def test_put_and_get(store):
+    np.testing.assert_array_equal(store.get(2, 1), random_mask(21))
+    assert store.get(3, 0) is None
+    assert store.get(1, 5) is None
+    assert len(store) == 6
+    assert store.object_ids() == [1, 2]
+    assert store.frame_indices() == [0, 1, 2]
+
+
+def test_put_accepts_sam2_output_shape():
+    store = MaskStore()
+    mask = random_mask(0)
+    store.put(1, 0, mask[None])
+    np.testing.assert_array_equal(store.get(1, 0), mask)
+
+
+def test_replacing_a_mask_keeps_the_bookkeeping(store):
+    nbytes = store.nbytes - len(store.frames[0][1][2])
+    store.put(1, 0, np.zeros((24, 31), dtype=bool))
+    assert len(store) == 6
+    assert store.nbytes == nbytes + len(store.frames[0][1][2])
+    assert not store.get(1, 0).any()
+
+
+def test_masks_are_compressed():
+    store = MaskStore()
+    mask = np.zeros((1080, 1920), dtype=bool)
+    mask[200:700, 300:1100] = True
+    store.put(1, 0, mask)
+    assert store.nbytes < mask.size // 100
+    np.testing.assert_array_equal(store.get(1, 0), mask)
+
+
+def test_get_frame(store):
+    masks = store.get_frame(2)
+    assert list(masks) == [1, 2]
+    np.testing.assert_array_equal(masks[1], random_mask(12))
+    assert list(store.get_frame(2, obj_ids=[2])) == [2]
+    assert store.get_frame(7) == {}
+
+
+def test_remove(store):
+    store.remove(obj_id=1, frame_idx=0)
+    assert store.get(1, 0) is None and store.get(2, 0) is not None
+    store.remove(frame_idx=1)
+    assert store.frame_indices() == [0, 2]
+    store.remove(obj_id=2)
+    assert store.object_ids() == [1] and store.frame_indices() == [2]
+    store.remove()
+    assert len(store) == 0 and store.nbytes == 0 and store.frames == {}
+
+
+def test_object_entries_round_trip(store):
+    entries = store.object_entries(1)
+    nbytes = store.nbytes
+    store.put(1, 5, random_mask(99))
+    store.remove(obj_id=1, frame_idx=0)
+    store.replace_object(1, entries)
+    assert store.frame_indices(obj_id=1) == [0, 1, 2]
+    assert len(store) == 6 and store.nbytes == nbytes
+    np.testing.assert_array_equal(store.get(1, 0), random_mask(10))
+
+
+def test_save_and_load(store, tmp_path):
+    path = str(tmp_path / "masks.npz")
+    store.save(path)
+    assert [p.name for p in tmp_path.iterdir()] == ["masks.npz"]
+
+    loaded = MaskStore()
+    assert loaded.load(path, video_key="video-a")
+    assert loaded.video_key == "video-a"
+    assert len(loaded) == len(store) and loaded.nbytes == store.nbytes
+    for obj_id in (1, 2):
+        for frame_idx in range(3):
+            np.testing.assert_array_equal(loaded.get(obj_id, frame_idx), store.get(obj_id, frame_idx))
+
+
+def test_load_checks_the_video(store, tmp_path):
+    path = str(tmp_path / "masks.npz")
+    store.save(path)
+    loaded = MaskStore()
+    assert not loaded.load(path, video_key="video-b")
+    assert not loaded.load(str(tmp_path / "missing.npz"))
+    assert len(loaded) == 0
+
+
+def test_save_and_load_empty(tmp_path):
+    path = str(tmp_path / "masks.npz")
+    MaskStore().save(path)
+    loaded = MaskStore(video_key="stale")
+    assert loaded.load(path)
+    assert len(loaded) == 0 and loaded.video_key is None
@@ -0,0 +1,164 @@
+from collections import OrderedDict
+import numpy as np
+import pytest
+import torch
+from modules.Annotation import AnnotationModule
+from modules.PromptHistory import PromptHistory, ObjectSnapshot, copy_structure, iter_tensors
+from benchmarks.pipeline_benchmark import StubPredictor
+
+
+def tensor_state(*values):
+    """
+    Inference state of one object whose outputs hold one (1, 256) float32 tensor (1 KiB) per value.
+    """
+    outputs = {frame_idx: {'maskmem_features': torch.full((1, 256), float(value))}
+               for frame_idx, value in enumerate(values)}
+    return {'output_dict_per_obj': {0: {'cond_frame_outputs': outputs, 'non_cond_frame_outputs': {}}}}
+
+
+def snapshot_of(state):
+    return ObjectSnapshot({'output_dict_per_obj': copy_structure(state['output_dict_per_obj'][0])}, {})
+
+
+def test_copy_structure_shares_the_tensors():
+    state = tensor_state(1, 2)
+    copy = copy_structure(state)
+    assert copy == state and copy is not state
+    assert copy['output_dict_per_obj'][0] is not state['output_dict_per_obj'][0]
+    assert [t.data_ptr() for t in iter_tensors(copy)] == [t.data_ptr() for t in iter_tensors(state)]
+
+    state['output_dict_per_obj'][0]['cond_frame_outputs'][0] = {'maskmem_features': torch.zeros(1)}
+    assert copy['output_dict_per_obj'][0]['cond_frame_outputs'][0]['maskmem_features'][0, 0] == 1
+
+
+def test_undo_and_redo():
+    history = PromptHistory()
+    history.record(1, {'op': 'points', 'frame_idx': 0}, None, 'a')
+    history.record(1, {'op': 'points', 'frame_idx': 4}, 'a', 'b')
+    history.record(2, {'op': 'mask', 'frame_idx': 2}, None, 'c')
+
+    description, snapshot = history.undo(1)
+    assert (description['frame_idx'], snapshot) == (4, 'a')
+    assert history.undo(1)[1] is None
+    assert not history.can_undo(1) and history.can_undo(2)
+    with pytest.raises(ValueError):
+        history.undo(1)
+
+    assert history.redo(1)[1] == 'a'
+    assert history.redo(1)[1] == 'b'
+    with pytest.raises(ValueError):
+        history.redo(1)
+    assert history.describe()['objects'][1]['position'] == 2
+
+
+def test_recording_after_undo_drops_the_redo_entries():
+    history = PromptHistory()
+    history.record(1, {'op': 'points', 'frame_idx': 0}, None, 'a')
+    history.record(1, {'op': 'points', 'frame_idx': 1}, 'a', 'b')
+    history.undo(1)
+    history.record(1, {'op': 'points', 'frame_idx': 2}, 'a', 'c')
+    assert not history.can_redo(1)
+    assert [entry['frame_idx'] for entry in history.describe()['objects'][1]['entries']] == [0, 2]
+
+
+def test_measure_only_counts_tensors_the_state_dropped():
+    history = PromptHistory()
+    state = tensor_state(1, 2)
+    history.record(1, {'op': 'points', 'frame_idx': 0}, None, snapshot_of(state))
+    assert history.measure(state) == 0
+
+    state['output_dict_per_obj'][0]['cond_frame_outputs'][1] = {'maskmem_features': torch.zeros((1, 256))}
+    assert history.measure(state) == 1024
+
+
+def test_enforce_budget_drops_the_oldest_entries():
+    history = PromptHistory(max_bytes=2048)
+    state = tensor_state(0)
+    for value in range(1, 5):
+        before = snapshot_of(state)
+        state = tensor_state(value)
+        history.record(1, {'op': 'points', 'frame_idx': 0}, before, snapshot_of(state))
+        history.enforce_budget(state)
+
+    # Every entry holds the tensor it replaced: only the last two fit
+    assert history.retained_bytes <= 2048
+    assert history.dropped == 2
+    description, snapshot = history.undo(1)
+    assert description['seq'] == 4
+    assert next(snapshot.tensors())[0, 0] == 3
+    assert history.undo(1)[0]['seq'] == 3
+    assert not history.can_undo(1)
+
+
+@pytest.fixture
+def annotator():
+    predictor = StubPredictor(image_size=64)
+    annotator = AnnotationModule(None, None, 'cpu', predictor=predictor)
+    annotator.inference_state = {
+        "images": torch.zeros((4, 3, 64, 64)),
+        "num_frames": 4,
+        "video_height": 48,
+        "video_width": 64,
+        "device": predictor.device,
+        "point_inputs_per_obj": {},
+        "mask_inputs_per_obj": {},
+        "obj_id_to_idx": OrderedDict(),
+        "obj_idx_to_id": OrderedDict(),
+        "obj_ids": [],
+        "output_dict_per_obj": {},
+        "temp_output_dict_per_obj": {},
+        "frames_tracked_per_obj": {},
+        "cached_features": {},
+        "stub_centers": {}
+    }
+    return annotator
+
+
+def object_masks(annotator, obj_id):
+    return {frame_idx: annotator.mask_store.get(obj_id, frame_idx)
+            for frame_idx in annotator.mask_store.frame_indices(obj_id)}
+
+
+def test_undo_and_redo_restore_the_object(annotator):
+    annotator.predict_mask(0, 1, [[10, 10]], [1])
+    annotator.predict_mask(0, 2, [[50, 30]], [1])
+    first_masks = object_masks(annotator, 1)
+    first_state = annotator.snapshot_object(1).object_state
+
+    annotator.predict_mask(2, 1, [[40, 20]], [1])
+    second_masks = object_masks(annotator, 1)
+    other_masks = object_masks(annotator, 2)
+    assert list(second_masks) == [0, 2]
+
+    assert annotator.undo_prompt(1)['frame_idx'] == 2
+    restored = object_masks(annotator, 1)
+    assert list(restored) == [0]
+    np.testing.assert_array_equal(restored[0], first_masks[0])
+    assert annotator.snapshot_object(1).object_state == first_state
+    assert annotator.prompts[1][0].tolist() == [[10, 10]]
+    assert annotator.dirty_frames[1] == {0}
+
+    annotator.redo_prompt(1)
+    restored = object_masks(annotator, 1)
+    assert list(restored) == [0, 2]
+    np.testing.assert_array_equal(restored[2], second_masks[2])
+    assert annotator.dirty_frames[1] == {0, 2}
+
+    # The other object is left alone
+    for frame_idx, mask in object_masks(annotator, 2).items():
+        np.testing.assert_array_equal(mask, other_masks[frame_idx])
+
+
+def test_undoing_the_first_prompt_removes_the_object(annotator):
+    annotator.predict_mask(0, 1, [[10, 10]], [1])
+    annotator.predict_mask(1, 2, [[50, 30]], [1])
+
+    annotator.undo_prompt(1)
+    assert annotator.inference_state["obj_ids"] == [2]
+    assert annotator.mask_store.object_ids() == [2]
+    assert 1 not in annotator.prompts and 1 not in annotator.dirty_frames
+
+    annotator.redo_prompt(1)
+    assert annotator.inference_state["obj_ids"] == [2, 1]
+    assert annotator.mask_store.object_ids() == [1, 2]
+    assert annotator.inference_state["point_inputs_per_obj"][1].keys() == {0}
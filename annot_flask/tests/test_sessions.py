@@ -0,0 +1,71 @@
+from contextlib import nullcontext
+import os
+import threading
+import pytest
+from modules.Sessions import SessionManager
+from conftest import TrackingPredictor
+
+
+class TrackingProfile:
+    """
+    Inference profile building the TrackingPredictor, so the manager loads no SAM2 weights.
+    """
+    autocast = staticmethod(nullcontext)
+
+    def build_predictor(self):
+        return TrackingPredictor()
+
+    def warm_up(self, predictor):
+        pass
+
+
+@pytest.fixture
+def session_manager(tmp_path):
+    # No budget: every idle session with an inference state is offloaded
+    return SessionManager(None, None, 'cpu', memory_budget_bytes=0, offload_folder=str(tmp_path),
+                          inference_profile=TrackingProfile())
+
+
+def open_session(session_manager, session_id, pin=False):
+    annotator = session_manager.get(session_id, pin=pin)
+    annotator.inference_state = TrackingPredictor().init_state()
+    return annotator
+
+
+def test_pinned_sessions_are_not_offloaded(session_manager):
+    pinned = open_session(session_manager, "pinned", pin=True)
+    idle = open_session(session_manager, "idle")
+    assert session_manager.busy_sessions() == {"pinned"}
+
+    session_manager.enforce_budget()
+    assert idle.is_offloaded() and os.path.exists(session_manager.offload_path("idle"))
+    assert not pinned.is_offloaded()
+    assert session_manager.offload("pinned") is False
+
+    # Pinned by two requests, offloadable once both are done
+    session_manager.get("pinned", pin=True)
+    session_manager.release("pinned")
+    assert session_manager.offload("pinned") is False
+    session_manager.release("pinned")
+    assert session_manager.busy_sessions() == set()
+    assert session_manager.offload("pinned") is True and pinned.is_offloaded()
+
+
+def test_sessions_in_use_are_not_offloaded(session_manager):
+    annotator = open_session(session_manager, "session")
+    locked, done = threading.Event(), threading.Event()
+
+    def use_state():
+        with annotator.state_lock:
+            locked.set()
+            done.wait()
+
+    user = threading.Thread(target=use_state)
+    user.start()
+    locked.wait()
+    try:
+        assert session_manager.offload("session") is False
+    finally:
+        done.set()
+        user.join()
+    assert session_manager.offload("session") is True
@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+import torch
+from modules.Annotation import mask_iou
+from modules.SparsePropagation import (KeyframeMemory, interpolate_mask, signed_distance, tracking_order,
+                                       motion_thumbnail, frame_difference)
+
+
+def disc(x, y, radius, shape=(40, 60)):
+    ys, xs = np.mgrid[:shape[0], :shape[1]]
+    return (xs - x) ** 2 + (ys - y) ** 2 < radius ** 2
+
+
+@pytest.mark.parametrize("start, max_frames, reverse, expected", [
+    (3, None, False, list(range(3, 10))),
+    (3, 2, False, [3, 4, 5]),
+    (3, None, True, [3, 2, 1, 0]),
+    (5, 2, True, [5, 4, 3]),
+    (0, None, True, []),
+])
+def test_tracking_order_matches_sam2(start, max_frames, reverse, expected):
+    assert tracking_order(start, max_frames, 10, reverse) == expected
+
+
+def test_signed_distance():
+    mask = disc(30, 20, 10)
+    distance = signed_distance(mask)
+    assert (distance[mask] > 0).all() and (distance[~mask] <= 0).all()
+    assert distance[20, 30] == pytest.approx(10, abs=1.5)
+
+
+def test_interpolate_mask_morphs_between_the_keyframes():
+    mask_a, mask_b = disc(20, 20, 8), disc(30, 20, 8)
+    np.testing.assert_array_equal(interpolate_mask(mask_a, mask_b, 0.0), mask_a)
+    np.testing.assert_array_equal(interpolate_mask(mask_a, mask_b, 1.0), mask_b)
+
+    # Halfway, the shape is in between: centered between both, inside their union and larger than their overlap
+    halfway = interpolate_mask(mask_a, mask_b, 0.5)
+    assert np.nonzero(halfway)[1].mean() == pytest.approx(25, abs=0.5)
+    assert not (halfway & ~(mask_a | mask_b)).any()
+    assert halfway.sum() > (mask_a & mask_b).sum()
+    distances = signed_distance(mask_a), signed_distance(mask_b)
+    np.testing.assert_array_equal(interpolate_mask(mask_a, mask_b, 0.25, *distances),
+                                  interpolate_mask(mask_a, mask_b, 0.25))
+
+
+def test_interpolate_mask_with_a_missing_object():
+    mask, empty = disc(20, 20, 8), np.zeros((40, 60), dtype=bool)
+    np.testing.assert_array_equal(interpolate_mask(mask, empty, 0.4), mask)
+    np.testing.assert_array_equal(interpolate_mask(mask, empty, 0.6), empty)
+
+
+def test_frame_difference():
+    image = torch.zeros((3, 64, 64))
+    shifted = image.clone()
+    shifted[:, :, 32:] = 1.0
+    assert motion_thumbnail(image).shape == (32, 32)
+    assert frame_difference(motion_thumbnail(image), motion_thumbnail(image)) == 0
+    assert frame_difference(motion_thumbnail(image), motion_thumbnail(shifted)) == pytest.approx(0.5)
+
+
+def test_keyframe_memory_presents_the_keyframes_as_the_previous_frames():
+    output_dict = {"cond_frame_outputs": {0: "prompt"},
+                   "non_cond_frame_outputs": {4: "four", 8: "eight", 9: "nine"}}
+    memory = KeyframeMemory(output_dict, 12, [0, 4, 8], reverse=False)
+    assert memory["cond_frame_outputs"] is output_dict["cond_frame_outputs"]
+    non_cond = memory["non_cond_frame_outputs"]
+    assert non_cond[11] == "eight" and non_cond[10] == "four"
+    assert 9 not in non_cond  # Keyframe 0 was prompted, SAM2 reads it from the conditioning outputs
+    assert dict(non_cond) == {4: "four", 8: "eight", 10: "four", 11: "eight"}
+    assert output_dict["non_cond_frame_outputs"] == {4: "four", 8: "eight", 9: "nine"}
+
+    memory = KeyframeMemory(output_dict, 0, [8, 4], reverse=True)
+    assert memory["non_cond_frame_outputs"][1] == "four" and memory["non_cond_frame_outputs"][2] == "eight"
+
+
+def dense_run(annotator):
+    return {frame_idx: masks for frame_idx, _, masks in annotator.iter_propagation(annotator.inference_state)}
+
+
+def sparse_run(annotator, **options):
+    annotator.predictor.tracked.clear()
+    frames = [(frame_idx, masks) for frame_idx, _, masks in
+              annotator.iter_propagation(annotator.inference_state, sparse=True, **options)]
+    return frames, sorted({frame_idx for _, frame_idx, _ in annotator.predictor.tracked})
+
+
+@pytest.mark.parametrize("quality", [0.5, 0.9])
+def test_sparse_propagation_runs_the_model_on_keyframes(tracking_annotator, quality):
+    annotator = tracking_annotator
+    predictor = annotator.predictor
+    for obj_id in (1, 2):
+        x, y = predictor.path(obj_id, 0)
+        annotator.predict_mask(0, obj_id, [[x, y]], [1])
+
+    dense = dense_run(annotator)
+    frames, keyframes = sparse_run(annotator, quality=quality, keyframe_stride=8, keyframe_mode="stride")
+    assert [frame_idx for frame_idx, _ in frames] == list(range(40))
+    assert len(keyframes) < 40 and keyframes[-1] == 39
+
+    # Interpolated masks stay close to what the model gives on every frame
+    for frame_idx, masks in frames:
+        for i, obj_id in enumerate((1, 2)):
+            assert mask_iou(masks[i], dense[frame_idx][i]) >= quality
+            np.testing.assert_array_equal(annotator.mask_store.get(obj_id, frame_idx), masks[i])
+
+    # The model's outputs on interpolated frames are dropped from the inference state
+    for obj_idx in range(2):
+        assert sorted(annotator.inference_state["output_dict_per_obj"][obj_idx]["non_cond_frame_outputs"]) == keyframes
+
+
+def test_higher_quality_adds_keyframes(tracking_annotator):
+    annotator = tracking_annotator
+    x, y = annotator.predictor.path(1, 0)
+    annotator.predict_mask(0, 1, [[x, y]], [1])
+    _, low = sparse_run(annotator, quality=0.2, keyframe_stride=8, keyframe_mode="stride")
+    _, high = sparse_run(annotator, quality=0.9, keyframe_stride=8, keyframe_mode="stride")
+    assert len(low) < len(high)
+
+
+def test_prompted_frames_are_keyframes(tracking_annotator):
+    annotator = tracking_annotator
+    predictor = annotator.predictor
+    for frame_idx in (0, 13):
+        x, y = predictor.path(1, frame_idx)
+        annotator.predict_mask(frame_idx, 1, [[x, y]], [1])
+    frames, _ = sparse_run(annotator, quality=0.0, keyframe_stride=8, keyframe_mode="stride")
+    masks = dict(frames)
+    np.testing.assert_array_equal(masks[13][0], (predictor.disc(*predictor.path(1, 13)) > 0).numpy()[0, 0])
+
+
+def test_sparse_falls_back_without_the_sam2_internals(tracking_annotator):
+    annotator = tracking_annotator
+    x, y = annotator.predictor.path(1, 0)
+    annotator.predict_mask(0, 1, [[x, y]], [1])
+    del annotator.predictor.num_maskmem
+    frames, tracked = sparse_run(annotator, quality=0.2)
+    assert [frame_idx for frame_idx, _ in frames] == tracked == list(range(40))
@@ -0,0 +1,153 @@
+import io
+import os
+import time
+import hashlib
+import pytest
+from modules import Uploads
+from modules.Uploads import UploadStore, UploadOffsetError, video_extension
+
+DATA = bytes(range(256)) * 40
+DATA_HASH = hashlib.sha256(DATA).hexdigest()
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # Small blocks, so a chunk spans several of them
+    monkeypatch.setattr(Uploads, "UPLOAD_BLOCK_SIZE", 1000)
+    return UploadStore(str(tmp_path))
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_video_extension():
+    assert video_extension("Clip.MOV") == ".mov"
+    assert video_extension("clip") == ".mp4"
+    assert video_extension(None) == ".mp4"
+    assert video_extension("clip.m p4") == ".mp4"
+
+
+def test_store_stream_hashes_and_deduplicates(store):
+    path, video_hash, deduplicated = store.store_stream(io.BytesIO(DATA), "clip.mov")
+    assert video_hash == DATA_HASH and not deduplicated
+    assert path == os.path.join(store.folder, DATA_HASH, "source.mov")
+    assert read(path) == DATA
+    assert store.find(DATA_HASH) == path
+
+    assert store.store_stream(io.BytesIO(DATA), "other.mp4") == (path, DATA_HASH, True)
+    assert os.listdir(store.partial_folder) == []
+
+
+def test_find_rejects_other_names(store):
+    assert store.find("../" + DATA_HASH) is None
+    assert store.find(DATA_HASH.upper()) is None
+    assert store.find(None) is None
+
+
+def test_chunked_upload(store):
+    upload = store.begin("clip.mp4", total_size=len(DATA))
+    store.append(upload.upload_id, 0, io.BytesIO(DATA[:3000]))
+    store.append(upload.upload_id, 3000, io.BytesIO(DATA[3000:]))
+    assert upload.offset == len(DATA)
+
+    path, video_hash, deduplicated = store.complete(upload.upload_id, sha256=DATA_HASH.upper())
+    assert video_hash == DATA_HASH and not deduplicated
+    assert read(path) == DATA
+    assert os.listdir(store.partial_folder) == []
+    with pytest.raises(KeyError):
+        store.get(upload.upload_id)
+
+
+def test_append_at_the_wrong_offset(store):
+    upload = store.begin("clip.mp4")
+    store.append(upload.upload_id, 0, io.BytesIO(DATA[:100]))
+    with pytest.raises(UploadOffsetError) as error:
+        store.append(upload.upload_id, 0, io.BytesIO(DATA[:100]))
+    assert error.value.offset == 100
+    assert upload.offset == 100
+
+
+def test_append_past_the_announced_size(store):
+    upload = store.begin("clip.mp4", total_size=2500)
+    with pytest.raises(ValueError):
+        store.append(upload.upload_id, 0, io.BytesIO(DATA))
+    # The whole blocks before the one going past the size are kept
+    assert upload.offset == 2000
+    assert read(store.part_path(upload.upload_id)) == DATA[:2000]
+
+
+def test_broken_stream_keeps_the_received_blocks(store):
+    class BrokenStream(io.BytesIO):
+        def read(self, size=-1):
+            if self.tell() >= 2000:
+                raise ConnectionError("client went away")
+            return super().read(size)
+
+    upload = store.begin("clip.mp4", total_size=len(DATA))
+    with pytest.raises(ConnectionError):
+        store.append(upload.upload_id, 0, BrokenStream(DATA))
+    assert upload.offset == 2000
+    store.append(upload.upload_id, 2000, io.BytesIO(DATA[2000:]))
+    assert store.complete(upload.upload_id)[1] == DATA_HASH
+
+
+def test_complete_checks_the_upload(store):
+    upload = store.begin("clip.mp4")
+    with pytest.raises(ValueError, match="empty"):
+        store.complete(upload.upload_id)
+
+    upload = store.begin("clip.mp4", total_size=len(DATA))
+    store.append(upload.upload_id, 0, io.BytesIO(DATA[:100]))
+    with pytest.raises(ValueError, match="incomplete"):
+        store.complete(upload.upload_id)
+
+    store.append(upload.upload_id, 100, io.BytesIO(DATA[100:]))
+    with pytest.raises(ValueError, match="mismatch"):
+        store.complete(upload.upload_id, sha256="0" * 64)
+    assert store.find(DATA_HASH) is None
+
+
+def test_known_hash_skips_the_chunks(store):
+    path, _, _ = store.store_stream(io.BytesIO(DATA), "clip.mp4")
+    upload = store.begin("copy.mp4", sha256=DATA_HASH)
+    assert upload.to_dict()['exists']
+    with pytest.raises(UploadOffsetError):
+        store.append(upload.upload_id, 0, io.BytesIO(DATA))
+    assert store.complete(upload.upload_id) == (path, DATA_HASH, True)
+
+    # An unknown hash is a regular upload
+    assert not store.begin("clip.mp4", sha256="0" * 64).to_dict()['exists']
+
+
+def test_upload_survives_a_restart(store):
+    upload = store.begin("clip.mp4", total_size=len(DATA))
+    store.append(upload.upload_id, 0, io.BytesIO(DATA[:2500]))
+
+    restarted = UploadStore(store.folder)
+    reloaded = restarted.get(upload.upload_id)
+    assert reloaded.offset == 2500 and reloaded.total_size == len(DATA)
+    restarted.append(upload.upload_id, 2500, io.BytesIO(DATA[2500:]))
+    assert restarted.complete(upload.upload_id, sha256=DATA_HASH)[1] == DATA_HASH
+
+
+def test_unknown_upload(store):
+    with pytest.raises(KeyError):
+        store.get("0" * 32)
+    with pytest.raises(KeyError):
+        store.get("../partial")
+    with pytest.raises(ValueError):
+        store.begin("clip.mp4", total_size=-1)
+
+
+def test_remove_stale(store):
+    stale = store.begin("clip.mp4")
+    fresh = store.begin("clip.mp4")
+    old = time.time() - 2 * store.upload_ttl
+    for path in (store.part_path(stale.upload_id), store.metadata_path(stale.upload_id)):
+        os.utime(path, (old, old))
+
+    store.remove_stale()
+    assert [upload['upload_id'] for upload in store.describe()] == [fresh.upload_id]
+    assert sorted(os.listdir(store.partial_folder)) == sorted([f"{fresh.upload_id}.json", f"{fresh.upload_id}.part"])